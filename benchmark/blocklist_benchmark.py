@@ -0,0 +1,105 @@
+"""Benchmark for the non-cabbage blocklist over recorded Flickr responses.
+
+Run from the repository root with "python -m benchmark.blocklist_benchmark".
+"""
+
+import glob
+import json
+import os
+import timeit
+
+from cabbage import blocklist
+from cabbage import joy
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), os.pardir, 'test',
+                            'testdata')
+REPEATS = 20
+
+
+def load_corpus():
+    """Load the text joy vets from the recorded Flickr responses.
+
+  Returns:
+    A list with the list of vetted lines from each response.
+  """
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(TESTDATA_DIR, '*.xml'))):
+        with open(path, encoding='utf-8') as response_file:
+            corpus.append([
+                line for line in response_file
+                if '<photo ' in line or '<tag ' in line
+            ])
+
+    return corpus
+
+
+def legacy_seems_like_cabbage(keywords, text):
+    """Check text the way joy used to: one substring scan per keyword."""
+    for keyword in keywords:
+        if keyword in text:
+            return False
+
+    return True
+
+
+def run():
+    """Run the blocklist benchmark.
+
+  Returns:
+    A dictionary of results.
+  """
+    corpus = load_corpus()
+    rules = blocklist.Blocklist()
+    with open(blocklist.DEFAULT_BLOCKLIST_PATH,
+              encoding='utf-8') as blocklist_file:
+        sections = blocklist.parse_blocklist(blocklist_file.read())
+    keywords = sections['words'] + sections['owners']
+
+    lines = [line for response in corpus for line in response]
+
+    def legacy():
+        for response in corpus:
+            for line in response:
+                legacy_seems_like_cabbage(list(keywords), line)
+
+    def compiled_lines():
+        for line in lines:
+            rules.blocks_text(line)
+
+    def compiled_responses():
+        # This is how joy vets getInfo responses: all lines in one pass.
+        for response in corpus:
+            rules.blocks_text(''.join(response))
+
+    titles = [line.lower() for line in lines]
+
+    def seems_like_cabbage():
+        for title in titles:
+            joy.seems_like_cabbage(title)
+
+    legacy_seconds = min(timeit.repeat(legacy, number=1, repeat=REPEATS))
+    lines_seconds = min(timeit.repeat(compiled_lines, number=1,
+                                      repeat=REPEATS))
+    responses_seconds = min(
+        timeit.repeat(compiled_responses, number=1, repeat=REPEATS))
+    seems_like_cabbage_seconds = min(
+        timeit.repeat(seems_like_cabbage, number=1, repeat=REPEATS))
+
+    return {
+        'corpus_responses': len(corpus),
+        'corpus_lines': len(lines),
+        'legacy_responses_per_second': len(corpus) / legacy_seconds,
+        'line_by_line_responses_per_second': len(corpus) / lines_seconds,
+        'responses_per_second': len(corpus) / responses_seconds,
+        'seems_like_cabbage_per_second':
+        len(titles) / seems_like_cabbage_seconds,
+    }
+
+
+def main():
+    """Print blocklist benchmark results."""
+    print(json.dumps(run(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
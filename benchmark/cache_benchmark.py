@@ -0,0 +1,89 @@
+"""Micro-benchmark for cabbage cache draws and memory use.
+
+Run from the repository root with "python -m benchmark.cache_benchmark".
+"""
+
+import json
+import random
+import timeit
+import tracemalloc
+
+from cabbage import cache
+
+CACHE_SIZES = [10000, 100000]
+DRAWS = 5000
+
+LEGACY_IMAGE_FORMAT = cache.CABBAGE_IMAGE_FORMAT
+
+
+def make_legacy_cache(size):
+    """Build a cache the way joy used to: a list of (link, diagnostic) tuples.
+
+  The diagnostic is shared so only the per-photo overhead is measured.
+  """
+    return [(LEGACY_IMAGE_FORMAT.format(photo_id=50000000000 + i,
+                                        secret='%010x' % i,
+                                        server='65535',
+                                        farm=66,
+                                        title='cabbage %d' % i), None)
+            for i in range(size)]
+
+
+def make_cabbage_cache(size):
+    """Build a CabbageColumns of compact cabbage records."""
+    return cache.CabbageColumns(
+        cache.CabbagePhoto(photo_id=50000000000 + i,
+                           secret='%010x' % i,
+                           server='65535',
+                           farm=66,
+                           title='cabbage %d' % i) for i in range(size))
+
+
+def measure_memory(factory, size):
+    """Measure the bytes allocated while building a cache."""
+    tracemalloc.start()
+    cabbages = factory(size)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del cabbages
+    return memory
+
+
+def legacy_draw(cabbages):
+    """Draw a cabbage the way joy used to."""
+    return cabbages.pop(random.randint(0, len(cabbages) - 1))
+
+
+def run():
+    """Run the cache benchmark.
+
+  Returns:
+    A dictionary of results, keyed by cache size.
+  """
+    results = {}
+    for size in CACHE_SIZES:
+        # Draws shrink the caches, so keep them well above the draw count.
+        legacy_cache = make_legacy_cache(size + DRAWS)
+        cabbage_cache = make_cabbage_cache(size + DRAWS)
+
+        legacy_seconds = timeit.timeit(lambda: legacy_draw(legacy_cache),
+                                       number=DRAWS)
+        cabbage_seconds = timeit.timeit(cabbage_cache.draw, number=DRAWS)
+
+        results[size] = {
+            'legacy_draw_ns': legacy_seconds / DRAWS * 1e9,
+            'draw_ns': cabbage_seconds / DRAWS * 1e9,
+            'legacy_memory_bytes': measure_memory(make_legacy_cache, size),
+            'memory_bytes': measure_memory(make_cabbage_cache, size),
+        }
+
+    return results
+
+
+def main():
+    """Print cache benchmark results."""
+    print(json.dumps(run(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
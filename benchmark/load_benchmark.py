@@ -0,0 +1,240 @@
+"""End-to-end load test of the bot commands, against a local fake Flickr.
+
+Commands registered on cabbagebot.bot are called directly with fake contexts,
+at a fixed concurrency, while a monitor measures how late the event loop
+wakes up. The cache starts out just above the low watermark, so it drains and
+a refill starts in the middle of the traffic, the way it does in production.
+
+Run from the repository root with "python -m benchmark.load_benchmark".
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import random
+import time
+import types
+from unittest import mock
+
+import cabbagebot
+from cabbage import client
+from cabbage import joy
+from cabbage import pools
+from cabbage import ratelimit
+from test import fake_flickr
+
+# (command, arguments, keyword arguments, weight) for a realistic mix of
+# traffic.
+TRAFFIC_MIX = [
+    ('cabbage', (), {}, 52),
+    ('cabbage', ('savoy', ), {}, 8),
+    ('CABBAGE', (), {}, 10),
+    ('roll', (), {
+        'formula': 'c20+5'
+    }, 10),
+    ('roll', (), {
+        'formula': '3c20+c6+4'
+    }, 6),
+    ('roll', (), {
+        'formula': '8c6'
+    }, 4),
+    ('roll', (), {
+        'formula': '6x 4c6'
+    }, 2),
+    ('roll', (), {
+        'formula': '1000000c6'
+    }, 1),
+    ('diag', (), {}, 2),
+    ('キャベツ', (), {}, 5),
+]
+COMMANDS = 5000
+CONCURRENCY = 50
+# Roughly what a Flickr API round trip costs from a home connection.
+FLICKR_LATENCY = 0.05
+# Roughly how long Discord takes to accept a message.
+DISCORD_LATENCY = 0.02
+# Cabbages served before the cache drains below the low watermark.
+CABBAGES_BEFORE_REFILL = 500
+# Commands come from this many users, spread over this many channels and
+# guilds.
+USERS = 1000
+CHANNELS = 100
+GUILDS = 10
+# How often the event loop monitor checks in, in seconds.
+LOOP_LAG_INTERVAL = 0.005
+
+
+class FakeContext(object):
+    """Just enough of a discord.py Context to run cabbagebot commands."""
+
+    def __init__(self, bot, command, user, send_latency=DISCORD_LATENCY):
+        self.bot = bot
+        self.command = command
+        self.author = types.SimpleNamespace(id=user,
+                                            mention='<@{}>'.format(user))
+        self.channel = types.SimpleNamespace(id=user % CHANNELS)
+        self.guild = types.SimpleNamespace(id=user % GUILDS)
+        self.send_latency = send_latency
+        self.messages = []
+
+    async def send(self, content):
+        """Record a message instead of sending it to Discord."""
+        # Sending is network I/O, so other commands get to run meanwhile.
+        await asyncio.sleep(self.send_latency)
+        self.messages.append(content)
+
+
+def percentiles(values, quantiles=(0.5, 0.95, 0.99)):
+    """Get percentiles of some values, without interpolation.
+
+  Returns:
+    A dictionary mapping names like "p95" to values, in milliseconds.
+  """
+    values = sorted(values)
+    if not values:
+        return {}
+
+    return {
+        'p%d' % round(q * 100):
+        values[min(len(values) - 1, int(q * len(values)))] * 1000
+        for q in quantiles
+    }
+
+
+async def monitor_loop_lag(lags, interval=LOOP_LAG_INTERVAL):
+    """Record how late the event loop wakes up from each short sleep."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started_at = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - started_at - interval))
+
+
+async def replay(traffic, concurrency, send_latency=DISCORD_LATENCY):
+    """Replay traffic through the bot commands.
+
+  Args:
+    traffic: A list of (command name, arguments, keyword arguments, user)
+      tuples.
+    concurrency: How many commands to run at once.
+    send_latency: How long each message takes to send, in seconds.
+
+  Returns:
+    A (latencies by command, event loop lags, messages sent) tuple.
+  """
+    latencies = {}
+    lags = []
+    messages = 0
+    queue = iter(traffic)
+
+    async def worker():
+        nonlocal messages
+        for name, args, kwargs, user in queue:
+            command = cabbagebot.bot.get_command(name)
+            ctx = FakeContext(cabbagebot.bot, command, user, send_latency)
+            started_at = time.perf_counter()
+            await command(ctx, *args, **kwargs)
+            latencies.setdefault(name,
+                                 []).append(time.perf_counter() - started_at)
+            messages += len(ctx.messages)
+
+    monitor = asyncio.create_task(monitor_loop_lag(lags))
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        monitor.cancel()
+
+    return latencies, lags, messages
+
+
+def make_traffic(commands=COMMANDS, seed=0):
+    """Make a stream of commands following the realistic mix."""
+    rng = random.Random(seed)
+    choices = [(name, args, kwargs) for name, args, kwargs, _ in TRAFFIC_MIX]
+    weights = [weight for _, _, _, weight in TRAFFIC_MIX]
+    return [
+        command + (rng.randrange(USERS), )
+        for command in rng.choices(choices, weights=weights, k=commands)
+    ]
+
+
+def run(commands=COMMANDS,
+        concurrency=CONCURRENCY,
+        flickr_latency=FLICKR_LATENCY,
+        discord_latency=DISCORD_LATENCY,
+        error_rate=0.0):
+    """Run the load test.
+
+  Returns:
+    A dictionary of results.
+  """
+    traffic = make_traffic(commands)
+    with fake_flickr.FakeFlickr(latency=flickr_latency,
+                                error_rate=error_rate) as server:
+        # Progress reports from refills would drown out the results. Each run
+        # gets a client of its own, so that the quota spent by earlier ones
+        # never cuts it short.
+        with contextlib.redirect_stdout(io.StringIO()), mock.patch.object(
+                joy, 'flickr_client', client.FlickrClient()):
+            cabbage_pools = pools.create_pools('key',
+                                               flickr_api_url=server.url)
+            cabbagebot.bot.cabbage_pools = cabbage_pools
+            # Replayed traffic is far denser than real traffic, so the limits
+            # are checked but never hit, to keep results comparable.
+            cabbagebot.bot.rate_limiter = ratelimit.RateLimiter({
+                scope: ratelimit.Limit(commands, 1)
+                for scope in ratelimit.SCOPES
+            })
+            cabbagebot.bot.coalescer = ratelimit.Coalescer()
+            cabbage_cache = cabbage_pools.default
+            cabbage_cache.load_cabbages()
+            cabbage_cache.low_watermark = (len(cabbage_cache) -
+                                           CABBAGES_BEFORE_REFILL)
+
+            started_at = time.perf_counter()
+            latencies, lags, messages = asyncio.run(
+                replay(traffic, concurrency, discord_latency))
+            seconds = time.perf_counter() - started_at
+            cabbage_pools.close()
+
+    all_latencies = [
+        latency for values in latencies.values() for latency in values
+    ]
+    return {
+        'commands': len(traffic),
+        'concurrency': concurrency,
+        'messages': messages,
+        'commands_per_second': len(traffic) / seconds,
+        'latency_ms': percentiles(all_latencies),
+        'latency_ms_by_command':
+        {name: percentiles(values)
+         for name, values in latencies.items()},
+        'loop_lag_ms': dict(percentiles(lags),
+                            max=max(lags, default=0) * 1000),
+        'flickr_requests': sum(server.requests.values()),
+    }
+
+
+def main():
+    """Print load test results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--commands', type=int, default=COMMANDS)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--flickr-latency', type=float, default=FLICKR_LATENCY)
+    parser.add_argument('--discord-latency',
+                        type=float,
+                        default=DISCORD_LATENCY)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    print(
+        json.dumps(run(args.commands, args.concurrency, args.flickr_latency,
+                       args.discord_latency, args.error_rate),
+                   indent=2,
+                   ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
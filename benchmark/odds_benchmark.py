@@ -0,0 +1,55 @@
+"""Benchmark for calculating the odds of polyhedral cabbage formulas.
+
+Run from the repository root with "python -m benchmark.odds_benchmark".
+"""
+
+import json
+import timeit
+
+from cabbage import odds
+
+# Everyday queries, and the worst cases the formula limits allow.
+QUERIES = [
+    '3c20+c6+4 >= 40',
+    '8c6 > 30',
+    '100c6 >= 400',
+    '40c100 >= 2000',
+    '20c100+20c100-c20 > 2000',
+    'c1000000000 >= 500000000',
+    '5c1000000000+4',
+    '1000c1000 < 500000',
+]
+
+
+def run():
+    """Run the odds benchmark.
+
+  Returns:
+    A dictionary of results, with the cold and memoized time for each query.
+  """
+    results = {}
+    for query in QUERIES:
+        odds._cached_count_distribution.cache_clear()
+        cold_seconds = timeit.timeit(lambda: odds.describe_odds(query),
+                                     number=1)
+        warm_seconds = timeit.timeit(lambda: odds.describe_odds(query),
+                                     number=1)
+        results[query] = {
+            'answer': odds.describe_odds(query),
+            'cold_ms': cold_seconds * 1000,
+            'warm_ms': warm_seconds * 1000,
+        }
+
+    return {
+        'numpy': odds.numpy is not None,
+        'queries': results,
+    }
+
+
+def main():
+    """Print odds benchmark results."""
+    print(json.dumps(run(), indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
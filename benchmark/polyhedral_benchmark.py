@@ -0,0 +1,83 @@
+"""Benchmark for compiling and rolling polyhedral cabbage formulas.
+
+Run from the repository root with "python -m benchmark.polyhedral_benchmark".
+"""
+
+import json
+import random
+import timeit
+
+from cabbage import polyhedral
+
+# A realistic mix of formulas, weighted by how often players roll them.
+FORMULA_MIX = [
+    ('c20', 30),
+    ('c20+5', 20),
+    ('c20 + 3', 10),
+    ('2c6+3', 8),
+    ('8c6', 6),
+    ('c8+c6+4', 6),
+    ('4c6', 5),
+    ('c100', 5),
+    ('c12-1', 4),
+    ('3c20+c6+4', 3),
+    ('10c10', 2),
+    ('1d20', 1),
+]
+ROLLS = 20000
+
+
+def make_traffic(rolls=ROLLS, seed=0):
+    """Make a stream of formulas following the realistic mix."""
+    formulas, weights = zip(*FORMULA_MIX)
+    return random.Random(seed).choices(formulas, weights=weights, k=rolls)
+
+
+def run():
+    """Run the polyhedral benchmark.
+
+  Returns:
+    A dictionary of results.
+  """
+    traffic = make_traffic()
+    valid_traffic = [
+        formula for formula in traffic
+        if not polyhedral.DICE_REGEX.search(formula)
+    ]
+    uncached_compile = polyhedral._compile_normalized_formula.__wrapped__
+    programs = [
+        polyhedral.compile_formula(formula) for formula in valid_traffic
+    ]
+
+    def parse():
+        for formula in valid_traffic:
+            uncached_compile(polyhedral.normalize_formula(formula))
+
+    parse_seconds = timeit.timeit(parse, number=1)
+    evaluate_seconds = timeit.timeit(
+        lambda: [polyhedral.evaluate_formula(terms) for terms in programs],
+        number=1)
+
+    polyhedral._compile_normalized_formula.cache_clear()
+    roll_seconds = timeit.timeit(
+        lambda: [polyhedral.roll_polyhedral_cabbage(f) for f in traffic],
+        number=1)
+    cache_info = polyhedral._compile_normalized_formula.cache_info()
+    lookups = max(1, cache_info.hits + cache_info.misses)
+
+    return {
+        'rolls': len(traffic),
+        'parse_us': parse_seconds / len(valid_traffic) * 1e6,
+        'evaluate_us': evaluate_seconds / len(valid_traffic) * 1e6,
+        'roll_us': roll_seconds / len(traffic) * 1e6,
+        'cache_hit_rate': cache_info.hits / lookups,
+    }
+
+
+def main():
+    """Print polyhedral benchmark results."""
+    print(json.dumps(run(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark for refilling the cabbage cache from a local fake Flickr.
+
+Run from the repository root with "python -m benchmark.refill_benchmark".
+"""
+
+import contextlib
+import io
+import json
+import time
+from unittest import mock
+
+from cabbage import client
+from cabbage import joy
+from test import fake_flickr
+
+# Roughly what a Flickr API round trip costs from a home connection.
+FLICKR_LATENCY = 0.02
+# (name, vetting mode, error rate) for each refill measured.
+SCENARIOS = [
+    ('search', joy.VETTING_FROM_SEARCH, 0.0),
+    ('search_flaky', joy.VETTING_FROM_SEARCH, 0.05),
+    ('getinfo', joy.VETTING_WITH_GET_INFO, 0.0),
+    ('getinfo_flaky', joy.VETTING_WITH_GET_INFO, 0.05),
+]
+
+
+def measure_refill(vetting_mode, error_rate, latency=FLICKR_LATENCY):
+    """Time one full refill against a fresh fake Flickr.
+
+  Returns:
+    A dictionary of results.
+  """
+    with fake_flickr.FakeFlickr(latency=latency,
+                                error_rate=error_rate,
+                                total=joy.CABBAGES_TO_REQUEST) as server:
+        # The per-page progress reports would drown out the results. Each
+        # refill gets a client of its own, so that the quota spent by earlier
+        # ones never cuts it short.
+        with contextlib.redirect_stdout(io.StringIO()), mock.patch.object(
+                joy, 'flickr_client', client.FlickrClient()):
+            cabbage_cache = joy.CabbageCache('key',
+                                             vetting_mode=vetting_mode,
+                                             flickr_api_url=server.url)
+            started_at = time.perf_counter()
+            cabbage_cache.load_cabbages()
+        seconds = time.perf_counter() - started_at
+        cabbage_cache.close()
+
+    return {
+        'refill_ms': seconds * 1000,
+        'first_cabbage_ms': cabbage_cache.time_to_first_cabbage * 1000,
+        'kept': len(cabbage_cache),
+        'photos_per_second': joy.CABBAGES_TO_REQUEST / seconds,
+        'kept_per_second': len(cabbage_cache) / seconds,
+        'requests': sum(server.requests.values()),
+    }
+
+
+def run():
+    """Run the refill benchmark.
+
+  Returns:
+    A dictionary of results for each scenario.
+  """
+    return {
+        name: measure_refill(vetting_mode, error_rate)
+        for name, vetting_mode, error_rate in SCENARIOS
+    }
+
+
+def main():
+    """Print refill benchmark results."""
+    print(json.dumps(run(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
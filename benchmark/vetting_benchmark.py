@@ -0,0 +1,77 @@
+"""Benchmark comparing the ways of vetting cabbages against recorded fixtures.
+
+Run from the repository root with "python -m benchmark.vetting_benchmark".
+"""
+
+import json
+import os
+import threading
+import time
+from unittest import mock
+
+from cabbage import error
+from cabbage import joy
+
+TESTDATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'test',
+                            'testdata')
+# Roughly what a Flickr API round trip costs from a home connection.
+FLICKR_LATENCY = 0.05
+
+
+class RecordedFlickr(object):
+    """Serves recorded Flickr responses slowly, counting requests."""
+
+    def __init__(self, latency=FLICKR_LATENCY):
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def request(self, path, parse):
+        """Stand in for joy._flickr_request."""
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+
+        if 'flickr.photos.search' in path:
+            if 'page=1&' not in path:
+                raise error.RecoverableCabbageException('No such page.')
+            name = 'search_cabbage_extras.xml'
+        else:
+            name = 'getinfo_%s.xml' % path.split('photo_id=')[1].split('&')[0]
+
+        with open(os.path.join(TESTDATA_DIR, name), 'rb') as response_file:
+            return parse([response_file.read()])
+
+
+def run():
+    """Run the vetting benchmark.
+
+  Returns:
+    A dictionary of results for each vetting mode.
+  """
+    results = {}
+    for mode in (joy.VETTING_WITH_GET_INFO, joy.VETTING_FROM_SEARCH):
+        flickr = RecordedFlickr()
+        cabbage_cache = joy.CabbageCache('key', vetting_mode=mode)
+        with mock.patch.object(joy, '_flickr_request', flickr.request):
+            started_at = time.perf_counter()
+            cabbage_cache.load_cabbages()
+            seconds = time.perf_counter() - started_at
+
+        results[mode] = {
+            'requests': flickr.requests,
+            'kept': len(cabbage_cache),
+            'refill_ms': seconds * 1000,
+        }
+        cabbage_cache.close()
+
+    return results
+
+
+def main():
+    """Print vetting benchmark results."""
+    print(json.dumps(run(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
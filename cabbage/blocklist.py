@@ -0,0 +1,150 @@
+"""Rules for spotting things which only pretend to be cabbage."""
+
+import os
+import re
+import threading
+
+DEFAULT_BLOCKLIST_PATH = os.path.join(os.path.dirname(__file__),
+                                      'blocklist.txt')
+
+WORDS_SECTION = 'words'
+OWNERS_SECTION = 'owners'
+SECTION_REGEX = re.compile(r'\[(\w+)\]')
+
+BROKEN_BLOCKLIST_FORMAT = (
+    'THE CABBAGE BLOCKLIST IS BROKEN, SO I AM KEEPING THE OLD ONE: {error}')
+
+# Matches nothing, for when a section is empty.
+NEVER_MATCH = re.compile(r'(?!)')
+
+
+def _trie_pattern(trie):
+    """Build a regex pattern from a character trie of keywords."""
+    alternatives = [
+        re.escape(character) + _trie_pattern(child)
+        for character, child in sorted(trie.items()) if character
+    ]
+    if not alternatives:
+        return ''
+
+    optional = '' in trie
+    if len(alternatives) == 1 and not optional:
+        return alternatives[0]
+
+    return '(?:%s)%s' % ('|'.join(alternatives), '?' if optional else '')
+
+
+def compile_alternation(keywords):
+    """Compile keywords into a single regex matching any of them anywhere.
+
+  Keywords sharing a prefix share a branch of the regex, so the regex engine
+  only tries each prefix once at every position.
+  """
+    if not keywords:
+        return NEVER_MATCH
+
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for character in keyword:
+            node = node.setdefault(character, {})
+        # An empty key marks the end of a keyword.
+        node[''] = {}
+
+    return re.compile(_trie_pattern(trie))
+
+
+def parse_blocklist(text):
+    """Parse blocklist text into its sections.
+
+  Args:
+    text: Blocklist file contents.
+
+  Returns:
+    A dictionary mapping each section name to a list of its entries.
+
+  Raises:
+    ValueError: An entry appeared outside of a section.
+  """
+    sections = {WORDS_SECTION: [], OWNERS_SECTION: []}
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        match = SECTION_REGEX.fullmatch(line)
+        if match:
+            section = sections.setdefault(match.group(1), [])
+            continue
+
+        if section is None:
+            raise ValueError('Blocklist entry outside of a section: ' + line)
+
+        section.append(line)
+
+    return sections
+
+
+class Blocklist(object):
+    """Word and owner rules, compiled once and reloaded when the file changes.
+
+  Rules are swapped in all at once, so refill threads never see a mix of old
+  and new rules.
+  """
+
+    def __init__(self, path=DEFAULT_BLOCKLIST_PATH):
+        self.path = path
+        self._mtime = None
+        self._reload_lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Read and compile the blocklist file."""
+        with self._reload_lock:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, encoding='utf-8') as blocklist_file:
+                sections = parse_blocklist(blocklist_file.read())
+
+            owners = frozenset(sections[OWNERS_SECTION])
+            self._rules = (compile_alternation(sections[WORDS_SECTION]),
+                           compile_alternation(owners), owners)
+            self._mtime = mtime
+
+    def reload_if_changed(self):
+        """Reload the blocklist if the file changed since it was last read.
+
+    If the changed file can't be read or parsed, the rules already compiled
+    are kept, and it isn't tried again until it changes again.
+
+    Returns:
+      Whether the blocklist was reloaded.
+    """
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self._mtime:
+                return False
+        except OSError as e:
+            print(BROKEN_BLOCKLIST_FORMAT.format(error=e))
+            return False
+
+        try:
+            self.reload()
+        except (OSError, ValueError) as e:
+            print(BROKEN_BLOCKLIST_FORMAT.format(error=e))
+            self._mtime = mtime
+            return False
+        return True
+
+    def blocks_text(self, text):
+        """Check text for blocked words, or blocked owners mentioned in it.
+
+    Owners have to be checked too, because Flickr tag markup names the
+    person who added the tag.
+    """
+        word_regex, owner_regex, _ = self._rules
+        return bool(word_regex.search(text) or owner_regex.search(text))
+
+    def blocks_owner(self, owner):
+        """Check whether a Flickr NSID belongs to a blocked owner."""
+        return owner in self._rules[2]
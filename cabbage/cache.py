@@ -0,0 +1,179 @@
+"""Compact storage for vetted cabbages with constant time random draws."""
+
+import array
+import random
+import sys
+import threading
+import time
+
+CABBAGE_IMAGE_FORMAT = (
+    'https://farm{farm}.staticflickr.com/{server}/{photo_id}_{secret}.jpg '
+    '(title: {title})')
+
+DIAGNOSTIC_FORMAT = (
+    'photo {photo_id} by {owner}, {verdict} in {latency_ms:.0f}ms at '
+    '{fetched_at} UTC. Tags: {tags}')
+
+
+class CabbageDiagnostic(object):
+    """The results of vetting a cabbage, minus the raw Flickr response."""
+
+    __slots__ = ('owner', 'tags', 'verdict', 'fetched_at', 'latency')
+
+    def __init__(self, owner, tags, verdict, fetched_at=None, latency=0.0):
+        """Record a vetting result.
+
+    Args:
+      owner: The Flickr NSID of the photo owner.
+      tags: An iterable of the photo's tags.
+      verdict: A short description of why the photo was kept.
+      fetched_at: When the photo was vetted, in seconds since the epoch.
+      latency: How long vetting took, in seconds.
+    """
+        self.owner = sys.intern(owner)
+        self.tags = tuple(sys.intern(tag) for tag in tags)
+        self.verdict = sys.intern(verdict)
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+        self.latency = latency
+
+    def describe(self, photo_id):
+        """Describe the vetting result for a photo in a diagnostic."""
+        fetched_at = time.strftime('%Y-%m-%d %H:%M:%S',
+                                   time.gmtime(self.fetched_at))
+        return DIAGNOSTIC_FORMAT.format(photo_id=photo_id,
+                                        owner=self.owner,
+                                        verdict=self.verdict,
+                                        latency_ms=self.latency * 1000,
+                                        fetched_at=fetched_at,
+                                        tags=' '.join(self.tags) or 'none')
+
+
+class CabbagePhoto(object):
+    """A vetted cabbage photo.
+
+  Only the fields needed to build the image link are kept. Links are built
+  when the cabbage is served rather than stored.
+  """
+
+    __slots__ = ('photo_id', 'secret', 'server', 'farm', 'title', 'diagnostic')
+
+    def __init__(self, photo_id, secret, server, farm, title, diagnostic=None):
+        self.photo_id = int(photo_id)
+        self.secret = secret
+        # Flickr only has a handful of servers and farms, so share them.
+        self.server = sys.intern(str(server))
+        self.farm = int(farm)
+        self.title = title
+        self.diagnostic = diagnostic
+
+    def __str__(self):
+        return CABBAGE_IMAGE_FORMAT.format(photo_id=self.photo_id,
+                                           secret=self.secret,
+                                           server=self.server,
+                                           farm=self.farm,
+                                           title=self.title)
+
+
+class CabbageColumns(object):
+    """A thread safe bag of vetted cabbages.
+
+  Cabbages are stored column by column, with numeric fields in arrays, rather
+  than as one object per photo. Random draws swap the drawn cabbage with the
+  last one, so both adding and drawing take constant time regardless of the
+  cache size. So does measuring it, since a running total of the cabbages'
+  sizes is kept.
+  """
+
+    def __init__(self, cabbages=()):
+        self._photo_ids = array.array('q')
+        self._secrets = []
+        self._servers = []
+        self._farms = array.array('l')
+        self._titles = []
+        self._diagnostics = []
+        self._columns = (self._photo_ids, self._secrets, self._servers,
+                         self._farms, self._titles, self._diagnostics)
+        self._lock = threading.Lock()
+        # The bytes used by the values in the columns, besides shared ones.
+        self._bytes = 0
+        self.extend(cabbages)
+
+    @staticmethod
+    def _size_of(secret, title, diagnostic):
+        """Estimate the bytes used by one cabbage's own values.
+
+    Interned values, like servers, owners and tags, are shared between
+    cabbages, so they aren't counted.
+    """
+        size = sys.getsizeof(secret) + sys.getsizeof(title)
+        if diagnostic is not None:
+            size += (sys.getsizeof(diagnostic) +
+                     sys.getsizeof(diagnostic.tags) +
+                     sys.getsizeof(diagnostic.fetched_at) +
+                     sys.getsizeof(diagnostic.latency))
+        return size
+
+    def _append(self, cabbage):
+        """Append a cabbage to every column. The lock must be held."""
+        self._bytes += self._size_of(cabbage.secret, cabbage.title,
+                                     cabbage.diagnostic)
+        self._photo_ids.append(cabbage.photo_id)
+        self._secrets.append(cabbage.secret)
+        self._servers.append(cabbage.server)
+        self._farms.append(cabbage.farm)
+        self._titles.append(cabbage.title)
+        self._diagnostics.append(cabbage.diagnostic)
+
+    def add(self, cabbage):
+        """Add a single vetted cabbage."""
+        with self._lock:
+            self._append(cabbage)
+
+    def extend(self, cabbages):
+        """Add several vetted cabbages at once."""
+        with self._lock:
+            for cabbage in cabbages:
+                self._append(cabbage)
+
+    def draw(self):
+        """Remove a random cabbage from the cache.
+
+    Returns:
+      A CabbagePhoto, or None if the cache is empty.
+    """
+        with self._lock:
+            if not self._photo_ids:
+                return None
+
+            index = random.randrange(len(self._photo_ids))
+            fields = [column[index] for column in self._columns]
+            self._bytes -= self._size_of(fields[1], fields[4], fields[5])
+            for column in self._columns:
+                last_value = column.pop()
+                if index < len(column):
+                    column[index] = last_value
+
+        return CabbagePhoto(*fields)
+
+    def clear(self):
+        """Forget every cached cabbage."""
+        with self._lock:
+            for column in self._columns:
+                del column[:]
+            self._bytes = 0
+
+    def footprint(self):
+        """Estimate the memory used by the cached cabbages.
+
+    Values shared between cabbages, like interned servers and tags, aren't
+    counted.
+
+    Returns:
+      The approximate size of the cache in bytes.
+    """
+        with self._lock:
+            return self._bytes + sum(
+                sys.getsizeof(column) for column in self._columns)
+
+    def __len__(self):
+        return len(self._photo_ids)
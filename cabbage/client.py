@@ -0,0 +1,338 @@
+"""An HTTP client for the Flickr API which rides out Flickr's bad days."""
+
+import email.utils
+import gzip
+import http.client
+import random
+import threading
+import time
+import urllib.parse
+import zlib
+
+from cabbage import error
+from cabbage import flickr
+from cabbage import metrics
+from cabbage import quota
+
+# Seconds to wait for a connection, and for each read of a response.
+REQUEST_TIMEOUT = 10
+# Attempts at each request before giving up on it.
+MAX_ATTEMPTS = 4
+# Retries back off exponentially from this many seconds, with full jitter, up
+# to BACKOFF_MAX. Flickr asking us to wait longer with Retry-After wins, up to
+# RETRY_AFTER_MAX.
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 8.0
+RETRY_AFTER_MAX = 60.0
+# Responses worth trying again, because Flickr is overloaded or rate limiting.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# Requests which failed every attempt, in a row, before the circuit breaker
+# opens and requests fail immediately for BREAKER_COOLDOWN seconds.
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN = 60.0
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half-open'
+
+BAD_FLICKR_RESPONSE_ERROR = (
+    'FLICKER HAS DENIED US OUR PRECIOUS CABBAGES. SHAME! SHAME!')
+FLICKR_UNAVAILABLE_ERROR = (
+    'FLICKR IS DOWN. I WILL TRY AGAIN WHEN IT HAS THOUGHT ABOUT WHAT IT DID.')
+QUOTA_EXHAUSTED_ERROR = (
+    'I HAVE ASKED FLICKR FOR TOO MANY CABBAGES THIS HOUR. PATIENCE.')
+
+
+class FlickrUnavailableException(error.RecoverableCabbageException):
+    """Flickr has been failing, so requests aren't even being tried."""
+
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class QuotaExhaustedException(error.RecoverableCabbageException):
+    """The API key is nearly out of calls, so requests aren't being sent."""
+
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class _RetryableResponse(error.RecoverableCabbageException):
+    """A response which is worth trying again, after a delay."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to Flickr while it is down.
+
+  Closed, requests go through. After enough failures in a row it opens, and
+  requests are refused without being sent. Once the cooldown is over it is
+  half open, and one trial request is let through: if it succeeds the
+  breaker closes, and if it fails the breaker opens again.
+  """
+
+    def __init__(self,
+                 failure_threshold=BREAKER_FAILURE_THRESHOLD,
+                 cooldown=BREAKER_COOLDOWN,
+                 clock=time.monotonic):
+        """Create a closed circuit breaker.
+
+    Args:
+      failure_threshold: Failures in a row which open the breaker.
+      cooldown: Seconds the breaker stays open before a trial request.
+      clock: Returns the current time in seconds.
+    """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        """BREAKER_CLOSED, BREAKER_OPEN or BREAKER_HALF_OPEN."""
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        """Get the state. The lock must be held."""
+        if self._opened_at is None:
+            return BREAKER_CLOSED
+        if self._clock() - self._opened_at < self.cooldown:
+            return BREAKER_OPEN
+        return BREAKER_HALF_OPEN
+
+    def allow(self):
+        """Check whether a request may be sent now."""
+        with self._lock:
+            state = self._state()
+            if state == BREAKER_CLOSED:
+                return True
+            if state == BREAKER_OPEN or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        """Note that Flickr answered a request."""
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+        metrics.FLICKR_CIRCUIT_OPEN.set(0)
+
+    def release(self):
+        """Note that a request was given up on before Flickr could answer.
+
+    That says nothing about whether Flickr is up, so only a trial request
+    is let through again.
+    """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        """Note that a request failed, even after retries."""
+        with self._lock:
+            self._failures += 1
+            if (self._trial_in_flight
+                    or self._failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    print('FLICKR IS DOWN. GIVING IT {seconds:.0f} SECONDS.'.
+                          format(seconds=self.cooldown))
+                self._opened_at = self._clock()
+            self._trial_in_flight = False
+            is_open = self._opened_at is not None
+        metrics.FLICKR_CIRCUIT_OPEN.set(int(is_open))
+
+
+def _parse_retry_after(value):
+    """Parse a Retry-After header into seconds, or None if there isn't one."""
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class FlickrClient(object):
+    """Makes Flickr API requests over keep-alive connections.
+
+  Each thread keeps its own connection, so a pool of worker threads is a
+  pool of connections. Responses are gzipped on the wire and parsed as they
+  arrive. Connection failures, timeouts and overloaded responses are retried
+  with jittered exponential backoff, and a circuit breaker stops requests
+  altogether while Flickr is down. Every attempt is counted against the API
+  key's quota, and requests stop short of using it all up.
+  """
+
+    def __init__(self,
+                 timeout=REQUEST_TIMEOUT,
+                 max_attempts=MAX_ATTEMPTS,
+                 backoff_base=BACKOFF_BASE,
+                 backoff_max=BACKOFF_MAX,
+                 breaker=None,
+                 quota_accountant=None,
+                 sleep=time.sleep):
+        """Configure the client.
+
+    Args:
+      timeout: Seconds to wait for a connection, and for each read.
+      max_attempts: Attempts at each request before giving up on it.
+      backoff_base: Average seconds to back off after the first failed
+        attempt. Each failed attempt after that doubles it.
+      backoff_max: The most seconds to back off between attempts.
+      breaker: The CircuitBreaker to use, or None for a new one.
+      quota_accountant: The QuotaAccountant to use, or None for a new one.
+      sleep: Waits for some seconds between attempts.
+    """
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.quota = (quota.QuotaAccountant()
+                      if quota_accountant is None else quota_accountant)
+        self._sleep = sleep
+        # The keep-alive connection for each thread, along with the
+        # (scheme, host) it is for.
+        self._connections = threading.local()
+
+    def _connection(self, scheme, host):
+        """Get this thread's connection to a host, connecting if needed."""
+        connection = getattr(self._connections, 'connection', None)
+        if connection is not None and self._connections.origin != (scheme,
+                                                                   host):
+            connection.close()
+            connection = None
+        if connection is None:
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(host,
+                                                         timeout=self.timeout)
+            else:
+                connection = http.client.HTTPConnection(host,
+                                                        timeout=self.timeout)
+            self._connections.connection = connection
+            self._connections.origin = (scheme, host)
+        return connection
+
+    def _backoff(self, attempt, retry_after=None):
+        """Get the seconds to wait before another attempt."""
+        if retry_after is not None:
+            return min(retry_after, RETRY_AFTER_MAX)
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2**(attempt + 1)))
+
+    def _attempt(self, scheme, host, path, method, parse):
+        """Make one attempt at a request.
+
+    Raises:
+      _RetryableResponse: Flickr is overloaded, or rate limiting us, or the
+        response was cut short.
+      RecoverableCabbageException: Flickr responded with something else
+        besides OK.
+    """
+        connection = self._connection(scheme, host)
+        status = 'error'
+        try:
+            with metrics.FLICKR_LATENCY.time(method=method):
+                connection.request('GET',
+                                   path,
+                                   headers={'Accept-Encoding': 'gzip'})
+                response = connection.getresponse()
+                status = response.status
+
+                if response.status in RETRY_STATUSES:
+                    raise _RetryableResponse(
+                        BAD_FLICKR_RESPONSE_ERROR,
+                        _parse_retry_after(response.getheader('Retry-After')))
+                # If the HTTP response code was anything other than OK, yell
+                # at Flickr.
+                if response.status != 200:
+                    raise error.RecoverableCabbageException(
+                        BAD_FLICKR_RESPONSE_ERROR)
+
+                body = response
+                if response.getheader('Content-Encoding') == 'gzip':
+                    body = gzip.GzipFile(fileobj=response)
+                try:
+                    return parse(flickr.iter_chunks(body))
+                except (EOFError, zlib.error):
+                    # The gzipped body ended early or arrived mangled.
+                    raise _RetryableResponse(BAD_FLICKR_RESPONSE_ERROR)
+        except Exception:
+            # Never reuse a connection that is in an unknown state.
+            connection.close()
+            self._connections.connection = None
+            raise
+        finally:
+            metrics.FLICKR_RESPONSES.inc(method=method, status=status)
+
+    def request(self, url, parse):
+        """Make a Flickr API request, retrying if it's worth retrying.
+
+    The response body is handed to the parser as it arrives, rather than
+    read into memory first. A failed attempt is parsed again from scratch.
+
+    Args:
+      url: The request URL, including the query string.
+      parse: Called with an iterator over the response body chunks. Must
+        consume the whole body.
+
+    Returns:
+      Whatever parse returned.
+
+    Raises:
+      FlickrUnavailableException: The circuit breaker is open.
+      QuotaExhaustedException: The API key is nearly out of calls.
+      RecoverableCabbageException: Flickr responded with something besides
+        OK, or said no in the response.
+      HTTPException, OSError: Flickr couldn't be reached.
+      Anything parse raises.
+    """
+        scheme, host, path, query, _ = urllib.parse.urlsplit(url)
+        path += '?' + query
+        method = query.partition('method=')[2].partition('&')[0]
+        if not self.quota.try_spend(method):
+            raise QuotaExhaustedException(QUOTA_EXHAUSTED_ERROR)
+        if not self.breaker.allow():
+            self.quota.refund(method)
+            raise FlickrUnavailableException(FLICKR_UNAVAILABLE_ERROR)
+
+        for attempt in range(self.max_attempts):
+            # Retries count against the quota too, and give up if it's gone.
+            # That's no fault of Flickr's, so the breaker doesn't count it.
+            if attempt and not self.quota.try_spend(method):
+                self.breaker.release()
+                raise QuotaExhaustedException(QUOTA_EXHAUSTED_ERROR)
+            try:
+                result = self._attempt(scheme, host, path, method, parse)
+            except (_RetryableResponse, http.client.HTTPException,
+                    OSError) as e:
+                if attempt + 1 == self.max_attempts:
+                    self.breaker.record_failure()
+                    raise
+                metrics.FLICKR_RETRIES.inc(method=method)
+                self._sleep(
+                    self._backoff(attempt, getattr(e, 'retry_after', None)))
+            except error.RecoverableCabbageException:
+                # Flickr is up, it just didn't like this request.
+                self.breaker.record_success()
+                raise
+            except Exception:
+                # The parser choked, which says nothing about Flickr, but a
+                # trial request must never be left in flight forever.
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
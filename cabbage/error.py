@@ -13,3 +13,10 @@ class RecoverableCabbageException(CabbageException):
 
     def __init__(self, message):
         super().__init__(message)
+
+
+class CabbageCacheEmptyException(RecoverableCabbageException):
+    """The cabbage cache has no cabbages to give right now."""
+
+    def __init__(self, message):
+        super().__init__(message)
@@ -0,0 +1,142 @@
+"""Streaming parsers for Flickr API responses."""
+
+import collections
+import xml.etree.ElementTree
+
+from cabbage import error
+
+READ_CHUNK_SIZE = 16 * 1024
+# Flickr only ever returns this many results for a search, however many it
+# says there are. Pages past them repeat the last of them.
+MAX_SEARCH_RESULTS = 4000
+
+FLICKR_FAILURE_FORMAT = 'FLICKR SAYS NO: {message} (error {code})'
+INVALID_RESPONSE_ERROR = 'FLICKR IS SPEAKING GIBBERISH. NO CABBAGES FOUND.'
+
+# How many pages and photos Flickr says a search has.
+SearchResults = collections.namedtuple('SearchResults', ['pages', 'total'])
+
+# A tag on a photo, along with the Flickr NSID of whoever added it.
+PhotoTag = collections.namedtuple('PhotoTag', ['author', 'raw', 'text'])
+
+# The parts of a flickr.photos.getInfo response used to vet cabbages.
+PhotoInfo = collections.namedtuple('PhotoInfo',
+                                   ['owner', 'title', 'description', 'tags'])
+
+
+def iter_chunks(response, chunk_size=READ_CHUNK_SIZE):
+    """Read a response body a chunk at a time.
+
+  Args:
+    response: A file-like HTTP response.
+    chunk_size: The maximum number of bytes to read at once.
+
+  Yields:
+    Chunks of the response body, as bytes.
+  """
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _parse_events(chunks):
+    """Incrementally parse a Flickr response.
+
+  Args:
+    chunks: An iterable of response body chunks.
+
+  Yields:
+    (event, element) tuples for element starts and ends.
+
+  Raises:
+    RecoverableCabbageException: The response was malformed, or Flickr
+      reported a failure.
+  """
+    parser = xml.etree.ElementTree.XMLPullParser(events=('start', 'end'))
+    try:
+        for chunk in chunks:
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if event == 'end' and element.tag == 'err':
+                    raise error.RecoverableCabbageException(
+                        FLICKR_FAILURE_FORMAT.format(
+                            message=element.get('msg', 'unknown'),
+                            code=element.get('code', '?')))
+                yield event, element
+
+        parser.close()
+        for event, element in parser.read_events():
+            yield event, element
+    except xml.etree.ElementTree.ParseError:
+        raise error.RecoverableCabbageException(INVALID_RESPONSE_ERROR)
+
+
+def parse_search(chunks, on_results=None):
+    """Parse a flickr.photos.search response as it arrives.
+
+  Photos are discarded from the parse tree as soon as they have been
+  yielded, so memory use doesn't grow with the page size.
+
+  Args:
+    chunks: An iterable of response body chunks.
+    on_results: Called with the SearchResults, if any, before the photos.
+
+  Yields:
+    A dictionary of attributes for each photo in the results. Extras which
+    Flickr sends as child elements, like descriptions, are included by tag
+    name.
+  """
+    photos = None
+    for event, element in _parse_events(chunks):
+        if event == 'start' and element.tag == 'photos':
+            photos = element
+            if on_results is not None:
+                try:
+                    on_results(
+                        SearchResults(int(element.get('pages')),
+                                      int(element.get('total'))))
+                except (TypeError, ValueError):
+                    pass
+        elif event == 'end' and element.tag == 'photo':
+            photo = dict(element.attrib)
+            for child in element:
+                photo.setdefault(child.tag, child.text or '')
+            yield photo
+            if photos is not None:
+                photos.remove(element)
+
+
+def parse_info(chunks):
+    """Parse a flickr.photos.getInfo response as it arrives.
+
+  Args:
+    chunks: An iterable of response body chunks.
+
+  Returns:
+    A PhotoInfo.
+  """
+    owner = None
+    title = ''
+    description = ''
+    tags = []
+    for event, element in _parse_events(chunks):
+        if event != 'end':
+            continue
+
+        if element.tag == 'owner':
+            owner = element.get('nsid')
+        elif element.tag == 'title':
+            title = element.text or ''
+        elif element.tag == 'description':
+            description = element.text or ''
+        elif element.tag == 'tag':
+            tags.append(
+                PhotoTag(element.get('author'), element.get('raw', ''),
+                         element.text or ''))
+
+    if owner is None:
+        raise error.RecoverableCabbageException(INVALID_RESPONSE_ERROR)
+
+    return PhotoInfo(owner, title, description, tags)
@@ -0,0 +1,112 @@
+"""A fixed-size memory of which cabbages have already been served."""
+
+import hashlib
+import math
+import struct
+
+# Photo ids remembered by each generation of the history. Between one and two
+# generations' worth of the most recent ids are remembered at any time.
+HISTORY_CAPACITY = 10000
+# Chance that a photo which was never served is mistaken for one that was,
+# for each generation.
+FALSE_POSITIVE_RATE = 0.01
+
+# Capacity, bit count, hash count and ids added to the current generation.
+HEADER = struct.Struct('<IIII')
+
+
+class ServedHistory(object):
+    """A rotating Bloom filter of served photo ids.
+
+  Memory use is fixed, about 12 KiB per generation by default. Ids are added
+  to the current generation. Once it holds its capacity, it becomes the
+  previous generation and the oldest ids are forgotten all at once. An id is
+  remembered if either generation has it.
+
+  There are no false negatives for remembered ids, so a recently served photo
+  is never served again. Occasionally a photo which was never served is
+  skipped anyway.
+  """
+
+    def __init__(self,
+                 capacity=HISTORY_CAPACITY,
+                 false_positive_rate=FALSE_POSITIVE_RATE):
+        """Create an empty history.
+
+    Args:
+      capacity: Photo ids remembered by each generation.
+      false_positive_rate: The chance of mistaking an id for a served one.
+    """
+        bit_count = math.ceil(-capacity * math.log(false_positive_rate) /
+                              math.log(2)**2)
+        hash_count = max(1, round(bit_count / capacity * math.log(2)))
+        self._setup(capacity, bit_count, hash_count)
+
+    def _setup(self, capacity, bit_count, hash_count, count=0):
+        """Set the filter parameters and clear both generations."""
+        self.capacity = capacity
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.count = count
+        self._current = bytearray((bit_count + 7) // 8)
+        self._previous = bytearray(len(self._current))
+
+    def _positions(self, photo_id):
+        """Get the bits for a photo id, by double hashing one digest."""
+        digest = hashlib.blake2b(str(photo_id).encode('ascii'),
+                                 digest_size=16).digest()
+        first, second = struct.unpack('<QQ', digest)
+        # An odd step never cycles early, whatever the bit count.
+        second |= 1
+        return [(first + i * second) % self.bit_count
+                for i in range(self.hash_count)]
+
+    def add(self, photo_id):
+        """Remember that a photo has been served."""
+        if self.count >= self.capacity:
+            self._previous = self._current
+            self._current = bytearray(len(self._previous))
+            self.count = 0
+
+        for position in self._positions(photo_id):
+            self._current[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, photo_id):
+        positions = self._positions(photo_id)
+        return any(
+            all(generation[position >> 3] & (1 << (position & 7))
+                for position in positions)
+            for generation in (self._current, self._previous))
+
+    def footprint(self):
+        """Get the memory used by both generations, in bytes."""
+        return len(self._current) + len(self._previous)
+
+    def to_bytes(self):
+        """Serialize the history, to be restored with from_bytes."""
+        return (HEADER.pack(self.capacity, self.bit_count, self.hash_count,
+                            self.count) + bytes(self._current) +
+                bytes(self._previous))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Restore a history serialized with to_bytes.
+
+    Raises:
+      ValueError: The data isn't a serialized history.
+    """
+        try:
+            capacity, bit_count, hash_count, count = HEADER.unpack_from(data)
+        except struct.error as e:
+            raise ValueError('Not a served history.') from e
+
+        size = (bit_count + 7) // 8
+        if not bit_count or len(data) != HEADER.size + 2 * size:
+            raise ValueError('Not a served history.')
+
+        history = cls.__new__(cls)
+        history._setup(capacity, bit_count, hash_count, count)
+        history._current[:] = data[HEADER.size:HEADER.size + size]
+        history._previous[:] = data[HEADER.size + size:]
+        return history
@@ -1,20 +1,89 @@
 """Simple functions to spread the joy of text based cabbage."""
 
+import asyncio
+import collections
+import concurrent.futures
 import http.client
+import json
+import os
 import random
-import re
-
+import socket
+import threading
+import time
+import traceback
+import urllib.parse
+import uuid
+
+from cabbage import blocklist
+from cabbage import cache
+from cabbage import client
 from cabbage import error
+from cabbage import flickr
+from cabbage import history
+from cabbage import metrics
+from cabbage import profiling
 
 # TODO(tunacom): Docstring cleanup.
-# TODO(tunacom): In general, the organization here is pretty craptastic.
-# Restructure it in a cleaner way, avoid hasattr/setattr.
 
 CABBAGE_IMAGE_PROBABILITY = 0.9
 SPECIAL_CABBAGE_PROBABILITY = 0.6
 
 CABBAGES_TO_REQUEST = 1500
 CABBAGES_PER_PAGE = 500
+PAGES_PER_REFILL = CABBAGES_TO_REQUEST // CABBAGES_PER_PAGE
+# What a search page is expected to bring in, and to cost in Flickr calls,
+# until refills have measured it. Guess low on cabbages and high on calls.
+KEPT_PER_PAGE_ESTIMATE = CABBAGES_PER_PAGE // 2
+CALLS_PER_PAGE_ESTIMATE = 1 + CABBAGES_PER_PAGE // 2
+# How much each finished page counts towards those estimates, against the
+# pages before it.
+PAGE_ESTIMATE_SMOOTHING = 0.3
+
+# Where each pool's served history, search cursor and refill checkpoint are
+# kept in the cabbage store, so they survive restarts and are shared with
+# other processes.
+SERVED_HISTORY_STATE = '{pool}:served_history'
+SEARCH_CURSOR_STATE = '{pool}:search_cursor'
+REFILL_CHECKPOINT_STATE = '{pool}:refill_checkpoint'
+
+# The pool of plain cabbages, and the Flickr tags it is searched by. Pools of
+# other varieties are set up in cabbage.pools.
+DEFAULT_POOL = 'cabbage'
+DEFAULT_TAGS = 'cabbage'
+
+# Size of the Flickr connection pool used while loading cabbages.
+FLICKR_CONNECTIONS = 4
+# Verification requests queued per connection, so no connection sits idle.
+FLICKR_REQUESTS_PER_CONNECTION = 2
+
+# Owners are skipped once this many of their photos, and this large a
+# fraction of them, have been rejected.
+OWNER_REJECTION_LIMIT = 5
+OWNER_REJECTION_RATIO = 0.8
+
+# Start refilling the cache in the background once it drops below this size.
+CABBAGE_LOW_WATERMARK = 300
+
+# When sharing a cabbage pool, only the process holding this lease refills
+# it. The lease is renewed by every refill, so the same process keeps
+# refilling until it stops, and another takes over once the lease expires.
+REFILL_LEASE = 'refill:{pool}'
+REFILL_LEASE_DURATION = 15 * 60
+
+# How the cache is doing. Warming until the first refill since startup is
+# done, though cabbages are served as soon as any are vetted. Degraded while
+# the latest refill failed, which is usually Flickr's fault.
+STATUS_WARMING = 'warming'
+STATUS_READY = 'ready'
+STATUS_DEGRADED = 'degraded'
+STATUSES = (STATUS_WARMING, STATUS_READY, STATUS_DEGRADED)
+
+# How candidates are vetted. From search, tags and descriptions come with the
+# search results and getInfo is only called when they are missing. With
+# getInfo, every candidate costs a getInfo call, as it always used to.
+VETTING_FROM_SEARCH = 'search'
+VETTING_WITH_GET_INFO = 'getinfo'
+VETTING_MODE = VETTING_FROM_SEARCH
 
 SPECIAL_CABBAGES = [
     'brassica oleracea',
@@ -27,180 +96,760 @@ SPECIAL_CABBAGES = [
     'キャベツ',
 ]
 
-BAD_FLICKR_RESPONSE_ERROR = (
-    'FLICKER HAS DENIED US OUR PRECIOUS CABBAGES. SHAME! SHAME!')
+EMPTY_CABBAGE_CACHE_ERROR = 'THE CABBAGE CACHE IS EMPTY. MORE ARE ON THE WAY!'
+FLICKR_API_URL = 'https://api.flickr.com'
 FLICKR_CABBAGE_REQUEST_FORMAT = (
-    '/services/rest/?method=flickr.photos.search&tags=cabbage&'
-    'page={page}&per_page={per_page}&api_key={api_key}')
+    '/services/rest/?method=flickr.photos.search&tags={tags}&tag_mode=all&'
+    'extras=description,tags&page={page}&per_page={per_page}&'
+    'api_key={api_key}')
 FLICKR_GET_INFO_FORMAT = ('/services/rest/?method=flickr.photos.getInfo&'
                           'photo_id={photo_id}&api_key={api_key}')
-FLICKR_CABBAGE_IMAGE_FORMAT = (
-    'https://farm{farm}.staticflickr.com/{server}/{photo_id}_{secret}.jpg '
-    '(title: {title})')
-FLICKR_PHOTO_REGEX = re.compile(
-    r'\s*<photo id="(\d+)" .* secret="(\w+)" server="(\w+)" farm="(\w+)" '
-    r'title="(\w+)" .*')
-
 
-def bootstrap(flickr_api_key):
-    """Perform initial cabbage setup, such as Flickr API key setup."""
-    setattr(get_flickr_api_key, 'flickr_api_key', flickr_api_key)
+# A search result which still needs vetting. Tags and description are None
+# when Flickr left them out of the results.
+FLICKR_PHOTO_FIELDS = [
+    'page', 'photo_id', 'owner', 'secret', 'server', 'farm', 'title', 'tags',
+    'description'
+]
+FlickrPhoto = collections.namedtuple('FlickrPhoto',
+                                     FLICKR_PHOTO_FIELDS,
+                                     defaults=(None, None))
 
+# Things which only pretend to be cabbage.
+cabbage_blocklist = blocklist.Blocklist()
 
-def get_flickr_api_key():
-    """Get the current Flickr API key for cabbage fetching."""
-    return getattr(get_flickr_api_key, 'flickr_api_key')
+# Talks to Flickr for every CabbageCache. Pipeline worker threads each get
+# their own keep-alive connection, and every refill shares these threads, so
+# there are at most FLICKR_CONNECTIONS connections however many pools are
+# refilling, and they stay open from one refill to the next.
+flickr_client = client.FlickrClient()
+flickr_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=FLICKR_CONNECTIONS, thread_name_prefix='flickr')
 
 
 def seems_like_cabbage(text):
     """Check to see if a some text sounds like cabbage text.
 
+  The rules live in blocklist.txt, and are compiled once per change to it.
+
   Args:
     text: The text to inspect potential cabbage likeness.
 
   Returns:
     Boolean indicating whether or not this seems like cabbage.
   """
-    non_cabbage_keywords = [
-        # Cabbage butterflies are the main source of non-cabbage sadness.
-        'butterfly',
-        'butterflies',
-        'chrysalis',  # Even baby butterflies are terrible. Maybe worse.
-        'cocoon',
-        'caterpillar',
-        'moth',  # Not a butterfly. Just as terrible.
-        'peris',
-        'rapae',
-        # Bands are the other primary source of non-cabbage sadness.
-        'band',  # Also not cabbage. You can't eat (most) bands.
-        'music',
-        'rock',
-        'concert',
-        'tour',
-        'broadbent',  # Dude seems pretty douchey.
-        # Nightmare fuel.
-        'doll',
-        'kid',
-        # Stuff that generally isn't as satisfying as cabbage.
-        'tree',  # Usually cabbage trees or tree collard.
-        'skunk',  # Usually skunk cabbage, which is toxic.
-        # People who are unqualified to identify cabbages (author ids).
-        '92795448@N08',
-        '156581561@N04',  # Weird non-cabbage food.
-        '147202485@N04',  # Landscapes.
-        '32203271@N08',  # Band without tags showing it's a band.
-        '86186358@N06',  # More nightmare fuel.
-    ]
-    for keyword in non_cabbage_keywords:
-        if keyword in text:
-            return False
+    return not cabbage_blocklist.blocks_text(text)
 
-    return True
 
+def _flickr_request(url, parse):
+    """Make a Flickr API request with the shared Flickr client.
 
-def load_cabbages(page=1):
-    """Preload cabbages into the cabbage cache."""
-    if page == 1:
-        print('REPOPULATING THE CABBAGE CACHE WITH AMAZING CABBAGES!')
+  Args:
+    url: The request URL, including the query string.
+    parse: Called with an iterator over the response body chunks. Must
+      consume the whole body.
 
-    # Connect to the Flickr API server.
-    # TODO(tunacom): Looks like Flickr isn't returning the right number of results
-    # per page, or the regex is screwing up on some things. Investigate this.
-    connection = http.client.HTTPSConnection('api.flickr.com')
-    path = FLICKR_CABBAGE_REQUEST_FORMAT.format(api_key=get_flickr_api_key(),
-                                                per_page=CABBAGES_PER_PAGE,
-                                                page=page)
-    connection.request('GET', path)
-    response = connection.getresponse()
-
-    # If the HTTP response code was anything other than OK, yell at Flickr.
-    if response.status != 200:
-        raise error.RecoverableCabbageException(BAD_FLICKR_RESPONSE_ERROR)
-
-    result = response.read().decode('utf-8')
-    photos = []
-    for line in result.splitlines():
-        # Proper xml parsing may be necessary at some point, but I'd rather not
-        # bring in an XML parsing library just for this.
-        match = FLICKR_PHOTO_REGEX.match(line)
-        if match:
-            photo_id = match.group(1)
-            secret = match.group(2)
-            server = match.group(3)
-            farm = match.group(4)
-            title = match.group(5).lower()
-            photo = FLICKR_CABBAGE_IMAGE_FORMAT.format(photo_id=photo_id,
-                                                       secret=secret,
-                                                       server=server,
-                                                       farm=farm,
-                                                       title=title)
-
-            if not seems_like_cabbage(title):
-                continue
+  Returns:
+    Whatever parse returned.
 
-            # At this point we seem like a cabbage. Try to be sure.
-            info_path = FLICKR_GET_INFO_FORMAT.format(
-                photo_id=photo_id, api_key=get_flickr_api_key())
-            connection.request('GET', info_path)
-            response = connection.getresponse()
+  Raises:
+    RecoverableCabbageException: Flickr responded with something besides OK,
+      or is down.
+  """
+    return flickr_client.request(url, parse)
 
-            # If the HTTP response code was anything other than OK, yell at Flickr.
-            if response.status != 200:
-                raise error.RecoverableCabbageException(
-                    BAD_FLICKR_RESPONSE_ERROR)
 
-            # TODO(tunacom): if this works, get the actual tag raw values.
-            result = response.read().decode('utf-8')
-            tags = []
-            for line in result.splitlines():
-                if '<tag ' in line or '<description ' in line:
-                    tags.append(line)
+def _filter_candidates(candidates):
+    """Title filter stage: drop candidates whose titles aren't cabbage."""
+    return [
+        candidate for candidate in candidates
+        if seems_like_cabbage(candidate.title)
+        and not cabbage_blocklist.blocks_owner(candidate.owner)
+    ]
 
-            if any([not seems_like_cabbage(tag) for tag in tags]):
-                continue
 
-            photos.append((photo, result))
+def _rejection_reason(info):
+    """Explain why a photo isn't cabbage.
 
-    # The parsing above is a bit brittle, so have some fallback.
-    if not photos:
-        raise error.RecoverableCabbageException(
-            'I HAD TROUBLE FIGURING OUT WHERE THE CABBAGE WAS. OOPS.')
+  Args:
+    info: The photo's PhotoInfo.
+
+  Returns:
+    The reason the photo was rejected, or None if it seems like cabbage.
+  """
+    # One pass of the compiled blocklist over every tag at once.
+    text = [info.description]
+    for tag in info.tags:
+        text += [tag.raw, tag.text]
+    if not seems_like_cabbage('\n'.join(text)):
+        return 'blocked words'
 
-    if not hasattr(get_cabbage, 'cabbage_cache'):
-        setattr(get_cabbage, 'cabbage_cache', [])
+    # Search results don't say who added each tag.
+    authors = {info.owner}.union(tag.author for tag in info.tags
+                                 if tag.author is not None)
+    if any(cabbage_blocklist.blocks_owner(author) for author in authors):
+        return 'blocked owner'
 
-    existing_cache = getattr(get_cabbage, 'cabbage_cache')
-    existing_cache += photos
+    return None
 
-    print('PAGE {page}: KEPT {total}/{max} POTENTIAL CABBAGES.'.format(
-        page=page, total=len(photos), max=CABBAGES_PER_PAGE))
 
-    last_page = CABBAGES_TO_REQUEST / CABBAGES_PER_PAGE
-    if page < last_page:
-        load_cabbages(page=page + 1)
+class CabbageCache(object):
+    """Vetted cabbages waiting to be served, and the means to get more.
 
+  Create one at startup and pass it to whatever serves cabbages. It is safe
+  to use from the event loop and from worker threads alike.
 
-def get_cabbage():
-    """Get a cabbage from the prepopulated cabbage cache, or populate it."""
-    cabbage_cache = getattr(get_cabbage, 'cabbage_cache', [])
-    if not cabbage_cache:
-        load_cabbages()
+  Refills are single-flight: however many callers ask for a refill while one
+  is already running, they all share it rather than each hitting Flickr.
 
-    cabbage_index = random.randint(0, len(cabbage_cache) - 1)
-    cabbage, diagnostic_info = cabbage_cache.pop(cabbage_index)
-    setattr(get_cabbage, 'diagnostic_info', diagnostic_info)
+  With a shared pool, cabbages are kept in the CabbageStore instead of in
+  memory, so every shard and process using the same store file draws from
+  one pool. Only one of them, elected with a lease, refills it.
 
-    return cabbage
+  Each CabbageCache is one pool of cabbages, found by searching Flickr for
+  photos with all of the pool's tags.
+  """
+
+    def __init__(self,
+                 flickr_api_key,
+                 low_watermark=CABBAGE_LOW_WATERMARK,
+                 cabbage_store=None,
+                 vetting_mode=VETTING_MODE,
+                 flickr_api_url=FLICKR_API_URL,
+                 shared=False,
+                 pool=DEFAULT_POOL,
+                 tags=DEFAULT_TAGS):
+        """Perform initial cabbage setup.
+
+    Args:
+      flickr_api_key: The Flickr API key used to fetch cabbages.
+      low_watermark: Cache size below which a background refill is started.
+      cabbage_store: Optional CabbageStore persisting vetted cabbages across
+        restarts.
+      vetting_mode: VETTING_FROM_SEARCH or VETTING_WITH_GET_INFO.
+      flickr_api_url: Where to find the Flickr API, without a trailing slash.
+      shared: Whether to draw from a pool shared through the cabbage store,
+        which is then required.
+      pool: The name of this pool of cabbages.
+      tags: Comma separated Flickr tags which every photo must have.
+    """
+        self.flickr_api_key = flickr_api_key
+        self.low_watermark = low_watermark
+        self.pool = pool
+        self.tags = tags
+        if cabbage_store is not None:
+            cabbage_store = cabbage_store.for_pool(pool)
+        self.cabbage_store = cabbage_store
+        self.vetting_mode = vetting_mode
+        self.flickr_api_url = flickr_api_url
+        self.shared = shared
+        if shared:
+            if cabbage_store is None:
+                raise ValueError(
+                    'A shared cabbage pool needs a cabbage store.')
+            self.cabbages = cabbage_store
+        else:
+            self.cabbages = cache.CabbageColumns()
+        self.last_cabbage = None
+        # Photos which were already cached, and the search results page the
+        # next refill starts from.
+        self.served_history = history.ServedHistory()
+        self.search_cursor = 1
+        # The last search results page Flickr will serve, once a search has
+        # said how many results there are.
+        self.last_search_page = None
+        # Pages from the search cursor onward which have been completely
+        # vetted, mapped to how many photos they had.
+        self.refill_checkpoint = {}
+        # Search pages fetched by each refill, which the scheduler in
+        # cabbage.pools adjusts to how fast the pool is draining, down to none
+        # while the Flickr quota is short.
+        self.pages_per_refill = PAGES_PER_REFILL
+        # Cabbages kept from each search page, and Flickr calls spent on it,
+        # measured by refills so the scheduler can size them.
+        self.kept_per_page = KEPT_PER_PAGE_ESTIMATE
+        self.calls_per_page = CALLS_PER_PAGE_ESTIMATE
+        # Draws from the pool, including those which found it empty.
+        self.draws = 0
+        self.last_drawn_at = None
+        self.status = None
+        self._set_status(STATUS_WARMING)
+        self.started_at = time.monotonic()
+        # Seconds from startup until there was a cabbage to serve.
+        self.time_to_first_cabbage = None
+        # Identifies this process when competing for the refill lease.
+        self.lease_holder = '{host}:{pid}:{token}'.format(
+            host=socket.gethostname(), pid=os.getpid(), token=uuid.uuid4().hex)
+
+        self._refill_lock = threading.Lock()
+        self._refill = None
+        self._refill_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='cabbage-refill')
+
+    def _set_status(self, status):
+        """Move to a new status, reporting the change."""
+        if status == self.status:
+            return
+
+        self.status = status
+        for other in STATUSES:
+            metrics.CACHE_STATUS.set(int(other == status),
+                                     pool=self.pool,
+                                     status=other)
+        print('{pool} CACHE STATUS: {status}.'.format(pool=self.pool.upper(),
+                                                      status=status.upper()))
+
+    def _note_first_cabbage(self):
+        """Record how long it took to have a cabbage to serve after startup."""
+        if self.time_to_first_cabbage is not None or not len(self.cabbages):
+            return
+
+        self.time_to_first_cabbage = time.monotonic() - self.started_at
+        metrics.TIME_TO_FIRST_CABBAGE.set(self.time_to_first_cabbage,
+                                          pool=self.pool)
+        print('FIRST {pool} READY AFTER {seconds:.2f} SECONDS.'.format(
+            pool=self.pool.upper(), seconds=self.time_to_first_cabbage))
+
+    def _load_search_state(self):
+        """Pick up where the last refill left off, even in another process."""
+        if self.cabbage_store is None:
+            return
+
+        data = self.cabbage_store.get_state(
+            SERVED_HISTORY_STATE.format(pool=self.pool))
+        if data is not None:
+            try:
+                self.served_history = history.ServedHistory.from_bytes(data)
+            except ValueError:
+                print('DISCARDED A MANGLED SERVED HISTORY.')
+        self.search_cursor = self.cabbage_store.get_state(
+            SEARCH_CURSOR_STATE.format(pool=self.pool), self.search_cursor)
+        checkpoint = self.cabbage_store.get_state(
+            REFILL_CHECKPOINT_STATE.format(pool=self.pool))
+        if checkpoint is not None:
+            self.refill_checkpoint = {
+                int(page): photos
+                for page, photos in json.loads(checkpoint).items()
+            }
+
+    def _save_search_state(self):
+        """Remember the served history, search cursor and refill checkpoint."""
+        if self.cabbage_store is None:
+            return
+
+        self.cabbage_store.set_state(
+            SERVED_HISTORY_STATE.format(pool=self.pool),
+            self.served_history.to_bytes())
+        self.cabbage_store.set_state(
+            SEARCH_CURSOR_STATE.format(pool=self.pool), self.search_cursor)
+        self.cabbage_store.set_state(
+            REFILL_CHECKPOINT_STATE.format(pool=self.pool),
+            json.dumps(self.refill_checkpoint))
+
+    def _search_page(self, page):
+        """Page producer stage: fetch one page of cabbage search results.
+
+    Args:
+      page: The search results page to fetch.
+
+    Returns:
+      A list of FlickrPhoto candidates found on the page.
+    """
+        url = self.flickr_api_url + FLICKR_CABBAGE_REQUEST_FORMAT.format(
+            tags=urllib.parse.quote(self.tags, safe=','),
+            api_key=self.flickr_api_key,
+            per_page=CABBAGES_PER_PAGE,
+            page=page)
+
+        def note_results(results):
+            self.last_search_page = max(
+                1,
+                min(results.pages,
+                    flickr.MAX_SEARCH_RESULTS // CABBAGES_PER_PAGE))
+
+        def parse(chunks):
+            candidates = []
+            for photo in flickr.parse_search(chunks, on_results=note_results):
+                tags = photo.get('tags')
+                candidates.append(
+                    FlickrPhoto(page, photo['id'], photo['owner'],
+                                photo['secret'], photo['server'],
+                                photo['farm'],
+                                photo.get('title', '').lower(),
+                                tags.split() if tags is not None else None,
+                                photo.get('description')))
+            return candidates
+
+        return _flickr_request(url, parse)
+
+    def _drop_served(self, candidates):
+        """Served history stage: drop photos which were served before.
+
+    Args:
+      candidates: FlickrPhotos from a page of search results.
+
+    Returns:
+      A (candidates, repeats) tuple, where candidates haven't been served and
+      repeats is how many were dropped.
+    """
+        fresh = [
+            candidate for candidate in candidates
+            if candidate.photo_id not in self.served_history
+        ]
+        return fresh, len(candidates) - len(fresh)
+
+    def _recall_verdicts(self, candidates, disreputable_owners):
+        """Verdict index stage: skip getInfo for photos vetted before.
+
+    Args:
+      candidates: FlickrPhotos which passed the title filter.
+      disreputable_owners: Owners whose photos are rarely cabbage.
+
+    Returns:
+      A (candidates, cabbages) tuple, where candidates still need verifying
+      and cabbages are CabbagePhotos which were accepted before.
+    """
+        if self.cabbage_store is None:
+            return candidates, []
+
+        verdicts = self.cabbage_store.get_verdicts(candidate.photo_id
+                                                   for candidate in candidates)
+        unvetted = []
+        cabbages = []
+        for candidate in candidates:
+            verdict = verdicts.get(int(candidate.photo_id))
+            if verdict is None:
+                if candidate.owner not in disreputable_owners:
+                    unvetted.append(candidate)
+            elif verdict.accepted:
+                diagnostic = cache.CabbageDiagnostic(owner=verdict.owner,
+                                                     tags=verdict.tags,
+                                                     verdict='remembered')
+                cabbages.append(
+                    cache.CabbagePhoto(candidate.photo_id,
+                                       candidate.secret,
+                                       candidate.server,
+                                       candidate.farm,
+                                       candidate.title,
+                                       diagnostic=diagnostic))
+
+        return unvetted, cabbages
+
+    def _get_info_url(self, photo_id):
+        """Get the Flickr API URL for a photo's getInfo request."""
+        return self.flickr_api_url + FLICKR_GET_INFO_FORMAT.format(
+            photo_id=photo_id, api_key=self.flickr_api_key)
+
+    def fetch_photo_info(self, photo_id):
+        """Fetch the full Flickr getInfo response for a photo.
+
+    This blocks on Flickr, so keep it off the event loop.
+
+    Args:
+      photo_id: The Flickr photo id.
+
+    Returns:
+      The raw getInfo response body.
+    """
+        return _flickr_request(self._get_info_url(photo_id),
+                               lambda chunks: b''.join(chunks).decode('utf-8'))
+
+    def _vet_from_search(self, candidates):
+        """Search vetting stage: vet candidates by their search extras.
+
+    Args:
+      candidates: FlickrPhotos which passed the title filter.
+
+    Returns:
+      A (candidates, cabbages) tuple, where candidates are too ambiguous to
+      vet without getInfo and cabbages are the accepted CabbagePhotos.
+    """
+        ambiguous = []
+        cabbages = []
+        for candidate in candidates:
+            # Every result was tagged cabbage, so no tags means no extras.
+            if not candidate.tags:
+                ambiguous.append(candidate)
+                continue
 
+            info = flickr.PhotoInfo(
+                candidate.owner, candidate.title, candidate.description or '',
+                [flickr.PhotoTag(None, '', tag) for tag in candidate.tags])
+            cabbage = self._judge(candidate, info, 'accepted from search')
+            if cabbage is not None:
+                cabbages.append(cabbage)
+
+        return ambiguous, cabbages
+
+    def _verify_candidate(self, candidate):
+        """Verifier stage: check a candidate's tags and description.
+
+    Args:
+      candidate: A FlickrPhoto which passed the title filter.
+
+    Returns:
+      A CabbagePhoto, or None if this isn't cabbage.
+    """
+        started_at = time.monotonic()
+        info = _flickr_request(self._get_info_url(candidate.photo_id),
+                               flickr.parse_info)
+        latency = time.monotonic() - started_at
+        return self._judge(candidate, info, 'accepted', latency)
+
+    def _judge(self, candidate, info, verdict, latency=0.0):
+        """Decide whether a candidate is cabbage, and remember the verdict.
+
+    Args:
+      candidate: The FlickrPhoto being vetted.
+      info: The candidate's PhotoInfo.
+      verdict: How to describe the candidate's acceptance in diagnostics.
+      latency: How long it took to fetch the PhotoInfo, in seconds.
+
+    Returns:
+      A CabbagePhoto, or None if this isn't cabbage.
+    """
+        tags = [tag.text for tag in info.tags]
+        reason = _rejection_reason(info)
+        if self.cabbage_store is not None:
+            self.cabbage_store.record_verdict(candidate.photo_id, info.owner,
+                                              reason, tags)
+
+        if reason is not None:
+            return None
+
+        # Keep a compact summary instead of the whole response. The full
+        # response can be fetched again with fetch_photo_info() if anyone asks.
+        diagnostic = cache.CabbageDiagnostic(owner=info.owner,
+                                             tags=tags,
+                                             verdict=verdict,
+                                             latency=latency)
+
+        return cache.CabbagePhoto(candidate.photo_id,
+                                  candidate.secret,
+                                  candidate.server,
+                                  candidate.farm,
+                                  candidate.title,
+                                  diagnostic=diagnostic)
+
+    def _add(self, cabbage):
+        """Cache sink stage: make a vetted cabbage available immediately."""
+        # A cached cabbage is as good as served. Vetting it again would only
+        # queue a duplicate.
+        self.served_history.add(cabbage.photo_id)
+        self.cabbages.add(cabbage)
+        metrics.CACHE_SIZE.set(len(self.cabbages), pool=self.pool)
+        self._note_first_cabbage()
+        if self.cabbage_store is not None and not self.shared:
+            self.cabbage_store.add(cabbage)
+
+    def load_stored_cabbages(self):
+        """Load cabbages vetted before the last restart.
+
+    Enough stored cabbages to stay above the low watermark mean there is no
+    warming up to do.
+
+    Returns:
+      The number of cabbages loaded from the cabbage store.
+    """
+        if self.cabbage_store is None:
+            return 0
+        if self.shared:
+            # Already there for the drawing.
+            loaded = len(self.cabbages)
+        else:
+            stored_cabbages = self.cabbage_store.load()
+            self.cabbages.extend(stored_cabbages)
+            metrics.CACHE_SIZE.set(len(self.cabbages), pool=self.pool)
+            loaded = len(stored_cabbages)
+            print('LOADED {total} STORED CABBAGES.'.format(total=loaded))
+
+        self._note_first_cabbage()
+        if loaded >= self.low_watermark:
+            self._set_status(STATUS_READY)
+
+        return loaded
+
+    def _measure_page(self, kept, calls):
+        """Fold a finished search page into the per-page estimates.
+
+    Args:
+      kept: Cabbages kept from the page.
+      calls: Flickr calls spent on the page, the search included.
+    """
+        self.kept_per_page = (
+            PAGE_ESTIMATE_SMOOTHING * kept +
+            (1 - PAGE_ESTIMATE_SMOOTHING) * self.kept_per_page)
+        self.calls_per_page = (
+            PAGE_ESTIMATE_SMOOTHING * calls +
+            (1 - PAGE_ESTIMATE_SMOOTHING) * self.calls_per_page)
+
+    def load_cabbages(self):
+        """Load more cabbages from Flickr, blocking until done.
+
+    Runs a streaming pipeline over a small pool of Flickr connections. All
+    search pages are requested at once, candidates passing the title filter
+    are verified with bounded concurrency as soon as their page arrives, and
+    each vetted cabbage is added to the cache as soon as it is verified.
+
+    Photos which were served before are dropped before anything else, using
+    the served history. Photos vetted on an earlier refill, and photos by
+    owners who are rarely right about cabbage, are settled from the verdict
+    index without asking Flickr again. When vetting from search, so are
+    photos whose tags and description came with the search results.
+
+    Search pages are fetched from the search cursor onward, and the cursor
+    moves past them afterwards, so every refill finds fresh cabbages further
+    into the results. Once the results run out it starts over from the
+    newest photos, whose old ones the served history skips.
+
+    A failed request only loses the page or photo it was for, and only
+    until the next refill. Each page is checkpointed once all of its photos
+    are vetted, and the cursor only moves once every page is, so the next
+    refill resumes with the pages which weren't. Their photos which were
+    vetted before are settled by the served history and the verdict index.
+
+    Raises:
+      QuotaExhaustedException: The scheduler in cabbage.pools left this pool
+        no pages to fetch, because the Flickr quota is running out.
+      RecoverableCabbageException: No cabbages at all could be loaded.
+    """
+        if not self.pages_per_refill:
+            raise client.QuotaExhaustedException(client.QUOTA_EXHAUSTED_ERROR)
 
-def create_cabbage_image():
+        print('REPOPULATING THE CABBAGE CACHE WITH AMAZING CABBAGES!')
+        if cabbage_blocklist.reload_if_changed():
+            print('RELOADED THE CABBAGE BLOCKLIST.')
+
+        disreputable_owners = frozenset()
+        if self.cabbage_store is not None:
+            disreputable_owners = self.cabbage_store.get_disreputable_owners(
+                OWNER_REJECTION_LIMIT, OWNER_REJECTION_RATIO)
+        self._load_search_state()
+
+        last_page = self.last_search_page
+        if last_page is not None and self.search_cursor > last_page:
+            self.search_cursor = 1
+            self.refill_checkpoint = {}
+        window = range(self.search_cursor,
+                       self.search_cursor + self.pages_per_refill)
+        if last_page is not None:
+            window = range(window.start, min(window.stop, last_page + 1))
+        pages = [page for page in window if page not in self.refill_checkpoint]
+        max_in_flight = FLICKR_CONNECTIONS * FLICKR_REQUESTS_PER_CONNECTION
+        backlog = collections.deque()
+        remaining = {}
+        found = {}
+        kept = collections.Counter()
+        repeats = collections.Counter()
+        verified = collections.Counter()
+        failed_pages = set()
+
+        pending = {
+            flickr_executor.submit(profiling.profiler.wrap(self._search_page),
+                                   page): page
+            for page in pages
+        }
+
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                work = pending.pop(future)
+                try:
+                    result = future.result()
+                except (error.RecoverableCabbageException,
+                        http.client.HTTPException, OSError) as e:
+                    print('FLICKR REQUEST FAILED: {error}'.format(error=e))
+                    result = None
+                    failed_pages.add(getattr(work, 'page', work))
+
+                if isinstance(work, FlickrPhoto):
+                    # A verification finished.
+                    if result is not None:
+                        self._add(result)
+                        kept[work.page] += 1
+                    page = work.page
+                    remaining[page] -= 1
+                else:
+                    # A search page arrived.
+                    page = work
+                    candidates, repeats[page] = self._drop_served(result or [])
+                    candidates, cabbages = self._recall_verdicts(
+                        _filter_candidates(candidates), disreputable_owners)
+                    if self.vetting_mode == VETTING_FROM_SEARCH:
+                        candidates, vetted = self._vet_from_search(candidates)
+                        cabbages += vetted
+                    for cabbage in cabbages:
+                        self._add(cabbage)
+                    kept[page] += len(cabbages)
+                    backlog.extend(candidates)
+                    verified[page] = len(candidates)
+                    remaining[page] = len(candidates)
+                    found[page] = len(result or [])
+
+                if not remaining[page]:
+                    metrics.PAGE_PHOTOS.inc(kept[page], outcome='kept')
+                    metrics.PAGE_PHOTOS.inc(repeats[page], outcome='repeat')
+                    metrics.PAGE_PHOTOS.inc(found[page] - kept[page] -
+                                            repeats[page],
+                                            outcome='rejected')
+                    metrics.PAGE_KEPT.observe(kept[page])
+                    print('PAGE {page}: KEPT {total}/{max} POTENTIAL '
+                          'CABBAGES, SKIPPED {repeats} REPEATS.'.format(
+                              page=page,
+                              total=kept[page],
+                              max=CABBAGES_PER_PAGE,
+                              repeats=repeats[page]))
+                    if page not in failed_pages:
+                        self.refill_checkpoint[page] = found[page]
+                        self._save_search_state()
+                        self._measure_page(kept[page], 1 + verified[page])
+
+            # Keep the verifier busy without queueing the whole backlog.
+            while backlog and len(pending) < max_in_flight:
+                candidate = backlog.popleft()
+                pending[flickr_executor.submit(
+                    profiling.profiler.wrap(self._verify_candidate),
+                    candidate)] = candidate
+
+        # Once every photo on these pages is cached, served or rejected, move
+        # on. A short page means the results ran out, and Flickr won't serve
+        # any past the last page.
+        if all(page in self.refill_checkpoint for page in window):
+            if (min(self.refill_checkpoint.values()) < CABBAGES_PER_PAGE
+                    or (self.last_search_page is not None
+                        and window.stop > self.last_search_page)):
+                self.search_cursor = 1
+            else:
+                self.search_cursor = window.stop
+            self.refill_checkpoint = {}
+        self._save_search_state()
+
+        # The parsing above is a bit brittle, so have some fallback.
+        if not sum(kept.values()):
+            if sum(repeats.values()):
+                raise error.RecoverableCabbageException(
+                    'EVERY CABBAGE I FOUND HAS BEEN SERVED BEFORE. TRY AGAIN '
+                    'LATER.')
+            raise error.RecoverableCabbageException(
+                'I HAD TROUBLE FIGURING OUT WHERE THE CABBAGE WAS. OOPS.')
+
+    def _refill_cabbages(self):
+        """Run one refill, reporting and swallowing failures.
+
+    The next low cache draw retries, and the cache is degraded until then.
+    With a shared pool, nothing happens unless this process holds the refill
+    lease.
+    """
+        if self.shared and not self.cabbage_store.acquire_lease(
+                REFILL_LEASE.format(pool=self.pool), self.lease_holder,
+                REFILL_LEASE_DURATION):
+            print('ANOTHER CABBAGEBOT IS IN CHARGE OF REFILLS.')
+            self._note_first_cabbage()
+            if len(self.cabbages):
+                self._set_status(STATUS_READY)
+            return
+
+        try:
+            with metrics.REFILL_DURATION.time():
+                self.load_cabbages()
+        except (error.RecoverableCabbageException, http.client.HTTPException,
+                OSError) as e:
+            print('CABBAGE REFILL FAILED: {error}'.format(error=e))
+            self._set_status(STATUS_DEGRADED)
+        except Exception:
+            # A bug, but nobody waits on a background refill to hear of it.
+            print('CABBAGE REFILL FAILED UNEXPECTEDLY:')
+            traceback.print_exc()
+            self._set_status(STATUS_DEGRADED)
+        else:
+            self._set_status(STATUS_READY)
+
+    def request_refill(self):
+        """Start a background refill unless one is already running.
+
+    Safe to call from any thread, including the event loop's, and never
+    blocks on Flickr.
+
+    Returns:
+      A concurrent.futures.Future for the refill in progress.
+    """
+        with self._refill_lock:
+            if self._refill is None or self._refill.done():
+                self._refill = self._refill_executor.submit(
+                    profiling.profiler.wrap(self._refill_cabbages))
+            return self._refill
+
+    async def refill(self):
+        """Refill the cache, sharing any refill already in progress."""
+        await asyncio.wrap_future(self.request_refill())
+
+    def maybe_refill(self):
+        """Start a background refill if the cache is running low."""
+        if len(self.cabbages) < self.low_watermark:
+            self.request_refill()
+
+    def get_cabbage(self):
+        """Get a cabbage from the cache.
+
+    Never waits on Flickr. If the cache is running low, a background refill
+    is started and the draw is served from whatever is already cached.
+
+    Raises:
+      CabbageCacheEmptyException: There are no cached cabbages right now.
+    """
+        self.draws += 1
+        self.maybe_refill()
+
+        cabbage = self.cabbages.draw()
+        metrics.CACHE_SIZE.set(len(self.cabbages), pool=self.pool)
+        if cabbage is None:
+            metrics.CACHE_DRAWS.inc(pool=self.pool, result='miss')
+            raise error.CabbageCacheEmptyException(EMPTY_CABBAGE_CACHE_ERROR)
+
+        metrics.CACHE_DRAWS.inc(pool=self.pool, result='hit')
+
+        self.last_cabbage = cabbage
+        self.last_drawn_at = time.monotonic()
+
+        # Served cabbages shouldn't come back after a restart. Shared draws
+        # already took them out of the store.
+        if self.cabbage_store is not None and not self.shared:
+            self.cabbage_store.remove(cabbage.photo_id)
+
+        return str(cabbage)
+
+    def footprint(self):
+        """Estimate the memory used by the cached cabbages, in bytes."""
+        return self.cabbages.footprint()
+
+    def close(self):
+        """Wait for any refill in progress, then stop refilling."""
+        self._refill_executor.shutdown()
+        if self.shared:
+            # Let another process take over refills straight away.
+            self.cabbage_store.release_lease(
+                REFILL_LEASE.format(pool=self.pool), self.lease_holder)
+
+    def __len__(self):
+        return len(self.cabbages)
+
+
+def create_cabbage_image(cabbage_cache):
     """Spread the joy of pictures of cabbages.
 
+  Args:
+    cabbage_cache: The CabbageCache to serve cabbages from.
+
   Returns:
     A link to some cabbage. Pure joy.
   """
     try:
-        return get_cabbage()
+        return cabbage_cache.get_cabbage()
+    except error.CabbageCacheEmptyException:
+        # Nothing cached yet. Text cabbage beats waiting on Flickr.
+        return create_cabbage_text()
     except error.RecoverableCabbageException as e:
         return str(e)
 
@@ -221,15 +870,18 @@ def create_cabbage_text():
     return ' '.join(cabbage_list)
 
 
-def spread_joy():
+def spread_joy(cabbage_cache):
     """Spread the joy of cabbage.
 
+  Args:
+    cabbage_cache: The CabbageCache to serve cabbages from.
+
   Returns:
      Joy.
   """
     roll = random.random()
     if roll < CABBAGE_IMAGE_PROBABILITY:
-        return create_cabbage_image()
+        return create_cabbage_image(cabbage_cache)
 
     # By default, we return text based cabbage.
     return create_cabbage_text()
@@ -0,0 +1,378 @@
+"""Lightweight metrics, exposed in the Prometheus text format."""
+
+import bisect
+import contextlib
+import threading
+import time
+
+# Default histogram buckets for latencies, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Histogram buckets for how many photos were kept from a page of results.
+PAGE_BUCKETS = (0, 10, 25, 50, 100, 200, 300, 400, 500)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    """Format a sample value the way Prometheus expects."""
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    """Escape a label value."""
+    value = str(value).replace('\\', r'\\')
+    return value.replace('\n', r'\n').replace('"', r'\"')
+
+
+class Registry(object):
+    """A collection of metrics which are rendered together."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add a metric to the registry."""
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """Render every registered metric in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        return ''.join(metric.render() for metric in metrics)
+
+
+# Where metrics are registered unless told otherwise.
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    """A named metric, with one value for each combination of labels."""
+
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        """Create and register a metric.
+
+    Args:
+      name: The metric name, like "cabbagebot_refill_seconds".
+      documentation: What the metric measures.
+      labelnames: The names of the labels every sample must have.
+      registry: The Registry to add the metric to, or None.
+    """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        """Get the key for a set of label values.
+
+    Raises:
+      ValueError: The labels don't match the metric's label names.
+    """
+        if len(labels) != len(self.labelnames) or not all(
+                name in labels for name in self.labelnames):
+            raise ValueError('{name} needs labels {labelnames}'.format(
+                name=self.name, labelnames=self.labelnames))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        """Format a label set for a sample line."""
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                                 for name, value in pairs)
+
+    def _samples(self):
+        """Yield (suffix, labels, value) tuples. The lock must be held."""
+        for key, value in sorted(self._values.items()):
+            yield '', self._format_labels(key), value
+
+    def render(self):
+        """Render the metric in the Prometheus text format."""
+        lines = [
+            '# HELP {name} {documentation}'.format(
+                name=self.name, documentation=self.documentation),
+            '# TYPE {name} {metric_type}'.format(name=self.name,
+                                                 metric_type=self.metric_type)
+        ]
+        with self._lock:
+            for suffix, labels, value in self._samples():
+                lines.append('{name}{suffix}{labels} {value}'.format(
+                    name=self.name,
+                    suffix=suffix,
+                    labels=labels,
+                    value=_format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    """A count which only ever goes up."""
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Add to the count."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Get the current count."""
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def total(self, **labels):
+        """Add up the counts for every value of the labels left out."""
+        with self._lock:
+            return sum(value for key, value in self._values.items() if all(
+                dict(zip(self.labelnames, key))[name] == str(label)
+                for name, label in labels.items()))
+
+
+class Gauge(Counter):
+    """A value which can go up and down."""
+
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the current value."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Observations counted into buckets, like request latencies."""
+
+    metric_type = 'histogram'
+
+    def __init__(self,
+                 name,
+                 documentation,
+                 labelnames=(),
+                 buckets=LATENCY_BUCKETS,
+                 registry=REGISTRY):
+        """Create and register a histogram.
+
+    Args:
+      name: The metric name, like "cabbagebot_refill_seconds".
+      documentation: What the metric measures.
+      labelnames: The names of the labels every observation must have.
+      buckets: The sorted upper bounds of the buckets.
+      registry: The Registry to add the metric to, or None.
+    """
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        """Record an observation."""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            empty = ([0] * (len(self.buckets) + 1), 0)
+            counts, total = self._values.get(key, empty)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how long a block of code takes, in seconds."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def count(self, **labels):
+        """Get the number of observations."""
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                return 0
+            return sum(self._values[key][0])
+
+    def quantile(self, q, **labels):
+        """Estimate a quantile from the buckets, like histogram_quantile().
+
+    Args:
+      q: The quantile, between 0 and 1.
+
+    Returns:
+      The estimated quantile, or None if nothing has been observed.
+    """
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                return None
+            counts = list(self._values[key][0])
+
+        rank = q * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if index == len(self.buckets):
+                    # Past the last bucket, so the best guess is its bound.
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+
+        return None
+
+    def label_values(self):
+        """Get every combination of label values observed so far."""
+        with self._lock:
+            return [
+                dict(zip(self.labelnames, key)) for key in sorted(self._values)
+            ]
+
+    def _samples(self):
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                yield '_bucket', self._format_labels(
+                    key, [('le', _format_value(bound))]), cumulative
+            yield '_sum', self._format_labels(key), total
+            yield '_count', self._format_labels(key), cumulative
+
+
+COMMAND_LATENCY = Histogram('cabbagebot_command_seconds',
+                            'Time spent handling each bot command.',
+                            ['command'])
+FLICKR_LATENCY = Histogram('cabbagebot_flickr_request_seconds',
+                           'Time spent on each Flickr API request.',
+                           ['method'])
+FLICKR_RESPONSES = Counter(
+    'cabbagebot_flickr_responses_total',
+    'Flickr API responses by HTTP status, or "error" if there was none.',
+    ['method', 'status'])
+FLICKR_RETRIES = Counter('cabbagebot_flickr_retries_total',
+                         'Flickr API requests tried again after a failure.',
+                         ['method'])
+FLICKR_CIRCUIT_OPEN = Gauge(
+    'cabbagebot_flickr_circuit_open',
+    'Whether Flickr requests are being refused because Flickr is down.')
+FLICKR_QUOTA_USED = Gauge(
+    'cabbagebot_flickr_quota_used',
+    'Flickr API calls counted against the key\'s quota in the last hour.')
+REFILL_DURATION = Histogram('cabbagebot_refill_seconds',
+                            'Time spent refilling the cabbage cache.')
+PAGE_PHOTOS = Counter(
+    'cabbagebot_page_photos_total',
+    'Photos in search results: kept, rejected, or a repeat.', ['outcome'])
+PAGE_KEPT = Histogram('cabbagebot_page_kept_photos',
+                      'Photos kept from each page of search results.',
+                      buckets=PAGE_BUCKETS)
+CACHE_DRAWS = Counter('cabbagebot_cache_draws_total',
+                      'Cabbage draws which found a cabbage, or didn\'t.',
+                      ['pool', 'result'])
+CACHE_SIZE = Gauge('cabbagebot_cache_size', 'Cabbages waiting to be served.',
+                   ['pool'])
+CACHE_STATUS = Gauge('cabbagebot_cache_status',
+                     'Whether a cabbage pool is in each status, 1 or 0.',
+                     ['pool', 'status'])
+TIME_TO_FIRST_CABBAGE = Gauge(
+    'cabbagebot_time_to_first_cabbage_seconds',
+    'Time from startup until there was a cabbage to serve.', ['pool'])
+POOL_DRAIN_RATE = Gauge('cabbagebot_pool_drain_rate',
+                        'Cabbages asked for from each pool, per second.',
+                        ['pool'])
+POOL_FORECAST = Gauge(
+    'cabbagebot_pool_forecast',
+    'Cabbages each pool is expected to serve before its '
+    'next refill lands.', ['pool'])
+POOL_PAGES = Gauge('cabbagebot_pool_refill_pages',
+                   'Search pages each pool refill is sized to.', ['pool'])
+RATE_LIMITED = Counter(
+    'cabbagebot_rate_limited_total',
+    'Commands over a rate limit, by the narrowest scope '
+    'whose limit they were over.', ['command', 'scope'])
+COALESCED_RESPONSES = Counter(
+    'cabbagebot_coalesced_responses_total',
+    'Responses sent for a burst of rate limited commands.', ['command'])
+COALESCED_REQUESTS = Counter(
+    'cabbagebot_coalesced_requests_total',
+    'Rate limited commands answered by a coalesced response.', ['command'])
+
+COMMAND_SUMMARY_FORMAT = '{command}: {count} calls, p50 {p50}, p95 {p95}'
+FLICKR_SUMMARY_FORMAT = ('Flickr {method}: {count} requests, {failures} '
+                         'failed, p50 {p50}, p95 {p95}')
+CACHE_SUMMARY_FORMAT = 'Cabbage draws: {hits} hits, {misses} misses'
+RATE_LIMIT_SUMMARY_FORMAT = ('Rate limited: {user} by user, {channel} by '
+                             'channel, {guild} by guild, in {responses} '
+                             'responses')
+REFILL_SUMMARY_FORMAT = ('Refills: {count}, p50 {p50}. Photos kept: {kept}, '
+                         'rejected: {rejected}, repeats: {repeats}')
+
+
+def render():
+    """Render every default metric in the Prometheus text format."""
+    return REGISTRY.render()
+
+
+def _format_seconds(seconds):
+    """Format a latency estimate for humans."""
+    if seconds is None:
+        return 'n/a'
+    if seconds < 1:
+        return '{:.0f}ms'.format(seconds * 1000)
+    return '{:.1f}s'.format(seconds)
+
+
+def summarize():
+    """Summarize the default metrics for humans.
+
+  Returns:
+    A list of lines.
+  """
+    lines = []
+    for labels in COMMAND_LATENCY.label_values():
+        lines.append(
+            COMMAND_SUMMARY_FORMAT.format(
+                count=COMMAND_LATENCY.count(**labels),
+                p50=_format_seconds(COMMAND_LATENCY.quantile(0.5, **labels)),
+                p95=_format_seconds(COMMAND_LATENCY.quantile(0.95, **labels)),
+                **labels))
+
+    for labels in FLICKR_LATENCY.label_values():
+        count = FLICKR_LATENCY.count(**labels)
+        lines.append(
+            FLICKR_SUMMARY_FORMAT.format(
+                count=count,
+                failures=count - FLICKR_RESPONSES.get(status=200, **labels),
+                p50=_format_seconds(FLICKR_LATENCY.quantile(0.5, **labels)),
+                p95=_format_seconds(FLICKR_LATENCY.quantile(0.95, **labels)),
+                **labels))
+
+    lines.append(
+        CACHE_SUMMARY_FORMAT.format(hits=CACHE_DRAWS.total(result='hit'),
+                                    misses=CACHE_DRAWS.total(result='miss')))
+    lines.append(
+        REFILL_SUMMARY_FORMAT.format(
+            count=REFILL_DURATION.count(),
+            p50=_format_seconds(REFILL_DURATION.quantile(0.5)),
+            kept=PAGE_PHOTOS.get(outcome='kept'),
+            rejected=PAGE_PHOTOS.get(outcome='rejected'),
+            repeats=PAGE_PHOTOS.get(outcome='repeat')))
+    lines.append(
+        RATE_LIMIT_SUMMARY_FORMAT.format(
+            user=RATE_LIMITED.total(scope='user'),
+            channel=RATE_LIMITED.total(scope='channel'),
+            guild=RATE_LIMITED.total(scope='guild'),
+            responses=COALESCED_RESPONSES.total()))
+    return lines
@@ -0,0 +1,481 @@
+"""Exact odds for polyhedral cabbage formulas."""
+
+import collections
+import functools
+import math
+import operator
+import re
+
+from cabbage import polyhedral
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Formulas costing more than this to solve exactly are approximated instead.
+# With NumPy the cost is the number of possible totals; without it, that times
+# the number of cabbages. Either way this keeps the worst case well under a
+# second per query.
+MAX_EXACT_COST = 1000000 if numpy is not None else 2000000
+# Formulas too costly to convolve may still be solved exactly by treating their
+# largest roll with its closed form. Each closed form term costs about the
+# square of the roll's cabbage count, plus a function call, and is needed for
+# every total of the rest of the formula.
+MAX_CLOSED_FORM_COST = 100000000
+CLOSED_FORM_CALL_COST = 100
+# Convolve with FFTs once both distributions have this many outcomes.
+FFT_THRESHOLD = 64
+DISTRIBUTION_CACHE_SIZE = 128
+# Only distributions with at most this many totals are memoized, which keeps
+# the cache to a few MB whatever players ask for. Larger ones are rebuilt from
+# their memoized parts each time.
+MAX_CACHED_OUTCOMES = 1000
+
+INVALID_QUERY_MESSAGE = (
+    'PATHETIC HUMAN, I CANNOT CALCULATE THAT. TRY "!odds 3c20+c6+4 >= 40".')
+ODDS_FORMAT = 'P({formula} {comparison} {target}) {equals} {probability}'
+SUMMARY_FORMAT = ('{formula}: min {min}, max {max}, mean {mean:.2f}, '
+                  'most likely {mode} ({probability})')
+APPROXIMATE_SUMMARY_FORMAT = ('{formula}: min {min}, max {max}, '
+                              'mean {mean:.2f}, standard deviation '
+                              '{deviation:.2f}')
+
+QUERY_REGEX = re.compile(
+    r'^(?P<formula>.*?)\s*(?:(?P<comparison>>=|<=|==|=|>|<)\s*'
+    r'(?P<target>[+-]?\d+))?\s*$', re.DOTALL)
+COMPARISONS = {
+    '>=': operator.ge,
+    '<=': operator.le,
+    '==': operator.eq,
+    '=': operator.eq,
+    '>': operator.gt,
+    '<': operator.lt,
+}
+# The comparison which holds for -x and -y whenever one holds for x and y.
+NEGATED_COMPARISONS = {
+    operator.ge: operator.le,
+    operator.le: operator.ge,
+    operator.eq: operator.eq,
+    operator.gt: operator.lt,
+    operator.lt: operator.gt,
+}
+
+# The distribution of a total from offset to offset + len(weights) - 1. The
+# probability of each total is its weight divided by the total weight. With
+# NumPy, weights are floats summing to one. Without it, weights are exact
+# counts of the ways to roll each total.
+Distribution = collections.namedtuple('Distribution',
+                                      ['offset', 'weights', 'total_weight'])
+
+
+def _convolve(first, second):
+    """Convolve two arrays of probabilities with NumPy.
+
+  Returns:
+    A read-only NumPy array.
+  """
+    if min(len(first), len(second)) < FFT_THRESHOLD:
+        result = numpy.convolve(first, second)
+    else:
+        size = len(first) + len(second) - 1
+        fft_size = 1 << (size - 1).bit_length()
+        result = numpy.fft.irfft(
+            numpy.fft.rfft(first, fft_size) * numpy.fft.rfft(second, fft_size),
+            fft_size)[:size]
+        # Rounding leaves tiny negative probabilities in the tails.
+        numpy.clip(result, 0, None, out=result)
+
+    result.flags.writeable = False
+    return result
+
+
+def _add(first, second):
+    """Get the distribution of the sum of two independent distributions."""
+    return Distribution(first.offset + second.offset,
+                        _convolve(first.weights, second.weights), 1)
+
+
+def _add_cabbage(distribution, sides, sign=1):
+    """Add one more cabbage to an exact distribution, in linear time.
+
+  The number of ways to roll each new total is a sliding window sum over the
+  ways to roll the old totals.
+  """
+    weights = distribution.weights
+    window = 0
+    new_weights = []
+    for i in range(len(weights) + sides - 1):
+        if i < len(weights):
+            window += weights[i]
+        if i >= sides:
+            window -= weights[i - sides]
+        new_weights.append(window)
+
+    offset = distribution.offset + (1 if sign > 0 else -sides)
+    return Distribution(offset, tuple(new_weights),
+                        distribution.total_weight * sides)
+
+
+def count_distribution(count, sides):
+    """Get the distribution of the total of rolling count cabbages.
+
+  With NumPy this uses repeated squaring, so only about log2(count) FFT
+  convolutions are needed, and every small intermediate distribution is
+  memoized too. Without NumPy, cabbages are added one at a time with exact
+  integer arithmetic.
+
+  Args:
+    count: The number of cabbages rolled.
+    sides: The number of sides each cabbage has.
+
+  Returns:
+    A Distribution. Its weights must not be modified.
+  """
+    if count * (sides - 1) + 1 <= MAX_CACHED_OUTCOMES:
+        return _cached_count_distribution(count, sides)
+    return _count_distribution(count, sides)
+
+
+@functools.lru_cache(maxsize=DISTRIBUTION_CACHE_SIZE)
+def _cached_count_distribution(count, sides):
+    """Memoize count_distribution for small distributions."""
+    return _count_distribution(count, sides)
+
+
+def _count_distribution(count, sides):
+    """Calculate count_distribution without memoizing the result."""
+    if numpy is None:
+        distribution = Distribution(0, (1, ), 1)
+        for _ in range(count):
+            distribution = _add_cabbage(distribution, sides)
+        return distribution
+
+    if count == 1:
+        weights = numpy.full(sides, 1 / sides)
+        weights.flags.writeable = False
+        return Distribution(1, weights, 1)
+
+    half = count_distribution(count // 2, sides)
+    result = _add(half, half)
+    if count % 2:
+        result = _add(result, count_distribution(1, sides))
+
+    return result
+
+
+def _negate(distribution):
+    """Get the distribution of the negated total."""
+    offset = -(distribution.offset + len(distribution.weights) - 1)
+    return Distribution(offset, distribution.weights[::-1],
+                        distribution.total_weight)
+
+
+def exact_cost(terms):
+    """Estimate the work needed to solve a compiled formula exactly."""
+    rolls = [
+        term for term in terms if term.term_type == polyhedral.TermType.roll
+    ]
+    outcomes = 1 + sum(term.cabbage_count * (term.sides - 1) for term in rolls)
+    if numpy is not None:
+        return outcomes
+
+    return outcomes * sum(term.cabbage_count for term in rolls)
+
+
+def formula_distribution(terms):
+    """Get the exact distribution of a compiled formula's total.
+
+  Args:
+    terms: A compiled formula, from polyhedral.compile_formula.
+
+  Returns:
+    A Distribution.
+  """
+    result = None
+    constant = 0
+    for term in terms:
+        if term.term_type == polyhedral.TermType.constant:
+            constant += term.sign * term.value
+        elif result is None:
+            result = count_distribution(term.cabbage_count, term.sides)
+            if term.sign < 0:
+                result = _negate(result)
+        elif numpy is not None:
+            distribution = count_distribution(term.cabbage_count, term.sides)
+            if term.sign < 0:
+                distribution = _negate(distribution)
+            result = _add(result, distribution)
+        else:
+            for _ in range(term.cabbage_count):
+                result = _add_cabbage(result, term.sides, term.sign)
+
+    if result is None:
+        return Distribution(constant, (1, ), 1)
+
+    return result._replace(offset=result.offset + constant)
+
+
+def _moments(terms):
+    """Get the mean and variance of a compiled formula's total."""
+    mean = 0
+    variance = 0
+    for term in terms:
+        if term.term_type == polyhedral.TermType.constant:
+            mean += term.sign * term.value
+        else:
+            mean += term.sign * term.cabbage_count * (term.sides + 1) / 2
+            variance += term.cabbage_count * (term.sides**2 - 1) / 12
+
+    return mean, variance
+
+
+def _range(terms):
+    """Get the lowest and highest possible totals of a compiled formula."""
+    low = 0
+    high = 0
+    for term in terms:
+        if term.term_type == polyhedral.TermType.constant:
+            low += term.sign * term.value
+            high += term.sign * term.value
+        elif term.sign > 0:
+            low += term.cabbage_count
+            high += term.cabbage_count * term.sides
+        else:
+            low -= term.cabbage_count * term.sides
+            high -= term.cabbage_count
+
+    return low, high
+
+
+def _exact_probability(distribution, comparison, target):
+    """Sum the probability of every total satisfying a comparison."""
+    weights = distribution.weights
+    index = target - distribution.offset
+    if comparison is operator.eq:
+        start, stop = index, index + 1
+    elif comparison is operator.ge:
+        start, stop = index, len(weights)
+    elif comparison is operator.gt:
+        start, stop = index + 1, len(weights)
+    elif comparison is operator.le:
+        start, stop = 0, index + 1
+    else:
+        start, stop = 0, index
+
+    start = max(0, start)
+    stop = min(len(weights), stop)
+    if start >= stop:
+        return 0.0
+
+    if numpy is not None:
+        return min(1.0, float(weights[start:stop].sum()))
+
+    # Exact integer weights, so this division is the only rounding.
+    return sum(weights[start:stop]) / distribution.total_weight
+
+
+def _ways_at_most(count, sides, total):
+    """Count the ways to roll a total of at most total with count cabbages.
+
+  By inclusion-exclusion over the cabbages which would have to roll more than
+  their sides, this is the sum of (-1)**k * C(count, k) * C(total - k * sides,
+  count) for every k with k * sides <= total - count. Totals above the mean
+  are counted from the other end instead, which needs fewer terms.
+  """
+    if total < count:
+        return 0
+    if total >= count * sides:
+        return sides**count
+
+    mirrored = count * (sides + 1) - total - 1
+    if mirrored < total:
+        return sides**count - _ways_at_most(count, sides, mirrored)
+
+    ways = 0
+    for k in range(min(count, (total - count) // sides) + 1):
+        ways += (-1)**k * math.comb(count, k) * math.comb(
+            total - k * sides, count)
+    return ways
+
+
+def _closed_form_terms(count, sides, total):
+    """Get the number of terms _ways_at_most needs for a total."""
+    if total < count or total >= count * sides:
+        return 0
+    total = min(total, count * (sides + 1) - total - 1)
+    return min(count, (total - count) // sides) + 1
+
+
+def _ways_satisfying(count, sides, comparison, target):
+    """Count the ways to roll count cabbages satisfying a comparison."""
+    if comparison is operator.eq:
+        return (_ways_at_most(count, sides, target) -
+                _ways_at_most(count, sides, target - 1))
+    if comparison is operator.le:
+        return _ways_at_most(count, sides, target)
+    if comparison is operator.lt:
+        return _ways_at_most(count, sides, target - 1)
+    if comparison is operator.ge:
+        return sides**count - _ways_at_most(count, sides, target - 1)
+    return sides**count - _ways_at_most(count, sides, target)
+
+
+def _closed_form_probability(terms, comparison, target):
+    """Calculate the probability of a comparison exactly, despite a huge roll.
+
+  The roll with the most possible totals is counted with its closed form,
+  and the rest of the formula is solved exactly as usual. Each total of the
+  rest then needs the huge roll to make up the difference.
+
+  Returns:
+    The probability, or None if this would cost too much too.
+  """
+    counts = collections.Counter()
+    for term in terms:
+        if term.term_type == polyhedral.TermType.roll:
+            counts[(term.sign, term.sides)] += term.cabbage_count
+    (sign, sides), count = max(counts.items(),
+                               key=lambda item: item[1] * (item[0][1] - 1))
+    rest = [
+        term for term in terms
+        if term.term_type == polyhedral.TermType.constant or
+        (term.sign, term.sides) != (sign, sides)
+    ]
+    if exact_cost(rest) > MAX_EXACT_COST:
+        return None
+
+    # The huge roll must satisfy the comparison with this, less the rest's
+    # total, or with its negation if the roll is subtracted.
+    if sign < 0:
+        comparison = NEGATED_COMPARISONS[comparison]
+    low, high = _range(rest)
+    differences = sorted([sign * (target - low), sign * (target - high)])
+    middle = min(max(count * (sides + 1) // 2, differences[0] - 1),
+                 differences[1])
+    most_terms = max(
+        _closed_form_terms(count, sides, total)
+        for total in (differences[0] - 1, differences[1], middle))
+    cost = (high - low + 1) * (
+        (most_terms + 1) * count**2 + CLOSED_FORM_CALL_COST)
+    if cost > MAX_CLOSED_FORM_COST:
+        return None
+
+    distribution = formula_distribution(rest)
+    ways = ((weight,
+             _ways_satisfying(count, sides, comparison,
+                              sign * (target - distribution.offset - i)))
+            for i, weight in enumerate(distribution.weights) if weight)
+    if numpy is not None:
+        scale = sides**count
+        probability = sum(
+            float(weight) * (roll_ways / scale) for weight, roll_ways in ways)
+        return min(1.0, probability)
+
+    # Exact integer counts, so this division is the only rounding.
+    return (sum(weight * roll_ways for weight, roll_ways in ways) /
+            (distribution.total_weight * sides**count))
+
+
+def _approximate_probability(terms, comparison, target):
+    """Approximate the odds of a comparison with a normal distribution."""
+    mean, variance = _moments(terms)
+    deviation = math.sqrt(variance)
+    low, high = _range(terms)
+
+    def at_most(total):
+        """P(formula <= total), with a continuity correction."""
+        if total < low:
+            return 0.0
+        if total >= high:
+            return 1.0
+        return 0.5 * math.erfc(
+            (mean - total - 0.5) / (deviation * math.sqrt(2)))
+
+    if comparison is operator.eq:
+        return at_most(target) - at_most(target - 1)
+    if comparison is operator.le:
+        return at_most(target)
+    if comparison is operator.lt:
+        return at_most(target - 1)
+    if comparison is operator.ge:
+        return 1.0 - at_most(target - 1)
+    return 1.0 - at_most(target)
+
+
+def format_probability(probability):
+    """Format a probability as a percentage for humans."""
+    if probability <= 0:
+        return '0%'
+    if probability >= 1:
+        return '100%'
+    return '{:.4g}%'.format(probability * 100)
+
+
+def describe_odds(query):
+    """Calculate the odds of a cabbage roll.
+
+  Exact whenever the formula costs at most MAX_EXACT_COST to solve, or its
+  largest roll can be counted with a closed form instead, and approximated
+  with a normal distribution otherwise.
+
+  Args:
+    query: A formula, optionally followed by a comparison like ">= 40".
+
+  Returns:
+    The odds, or an error message.
+  """
+    match = QUERY_REGEX.match(query or '')
+    if not match or not match.group('formula'):
+        return INVALID_QUERY_MESSAGE
+
+    formula = match.group('formula')
+    try:
+        terms = polyhedral.compile_formula(formula)
+    except polyhedral.FormulaException as e:
+        return str(e)
+
+    formula = polyhedral.normalize_formula(formula)
+    exact = exact_cost(terms) <= MAX_EXACT_COST
+    distribution = formula_distribution(terms) if exact else None
+
+    if match.group('comparison') is None:
+        low, high = _range(terms)
+        mean, variance = _moments(terms)
+        if not exact:
+            return APPROXIMATE_SUMMARY_FORMAT.format(
+                formula=formula,
+                min=low,
+                max=high,
+                mean=mean,
+                deviation=math.sqrt(variance))
+
+        weights = distribution.weights
+        if numpy is not None:
+            mode = int(numpy.argmax(weights))
+        else:
+            mode = max(range(len(weights)), key=weights.__getitem__)
+        probability = weights[mode] / distribution.total_weight
+        return SUMMARY_FORMAT.format(
+            formula=formula,
+            min=low,
+            max=high,
+            mean=mean,
+            mode=mode + distribution.offset,
+            probability=format_probability(probability))
+
+    comparison = COMPARISONS[match.group('comparison')]
+    target = int(match.group('target'))
+    if exact:
+        probability = _exact_probability(distribution, comparison, target)
+    else:
+        probability = _closed_form_probability(terms, comparison, target)
+        exact = probability is not None
+        if not exact:
+            probability = _approximate_probability(terms, comparison, target)
+
+    return ODDS_FORMAT.format(formula=formula,
+                              comparison=match.group('comparison'),
+                              target=target,
+                              equals='=' if exact else '≈',
+                              probability=format_probability(probability))
@@ -1,9 +1,18 @@
 """Utility functions for rolling polyhedral cabbages."""
 
+import collections
 import enum
+import functools
 import random
 import re
 
+from cabbage import error
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 DICE_HELP_MESSAGE = (
     'PATHETIC HUMAN, YOU SEEM TO BE ATTEMPTING TO ROLL DICE INSTEAD OF '
     'CABBAGES. TRY ROLLING CABBAGES!\n'
@@ -13,13 +22,35 @@ INVALID_FORMULA_MESSAGE = (
 
 DICE_REGEX = re.compile(r'd\d+')
 TOKEN_REGEX = re.compile(r'(\d+|c|\+|-)')
+REPEAT_REGEX = re.compile(r'(\d+)x(.*)')
 
 MAX_CABBAGE_SIDES = 1000000000
 MAX_FORMULA_LENGTH = 1000
-MAX_POLYHEDRAL_CABBAGES = 100
+# Bulk rolls are vectorized with NumPy. Without it, millions of cabbages take
+# seconds rather than milliseconds, so allow fewer.
+MAX_POLYHEDRAL_CABBAGES = 10000000 if numpy is not None else 1000000
+# Rolls of up to this many cabbages are listed individually, if they fit.
+MAX_LISTED_CABBAGES = 500
+# Histogram buckets for a whole formula, split between its rolls, so that
+# even five huge rolls summarize within one message.
+MAX_HISTOGRAM_BUCKETS = 20
+MAX_MESSAGE_LENGTH = 2000
 MAX_TERMS = 5
+# Rolls in one batch, counting each repetition.
+MAX_BATCH_ROLLS = 20
+FORMULA_CACHE_SIZE = 256
 ROLL_INDICATOR = 'c'
+BATCH_SEPARATOR = ';'
+BATCH_RESULT_FORMAT = '{formula}: {response}'
 SIGN_MAPPINGS = {'+': 1, '-': -1}
+SUMMARY_HEADER_FORMAT = (
+    '{result} (TOO MANY CABBAGES TO LIST. BEHOLD, STATISTICS!)')
+SUMMARY_FORMAT = (
+    '{sign}{count}c{sides}: total {total}, min {min}, max {max}, '
+    'mean {mean:.2f}')
+
+if numpy is not None:
+    _numpy_generator = numpy.random.default_rng()
 
 
 @enum.unique
@@ -36,47 +67,67 @@ class TermType(enum.Enum):
     roll = 1
 
 
-class Term(object):
+class Term(
+        collections.namedtuple(
+            'Term', ['term_type', 'sign', 'cabbage_count', 'sides', 'value'])):
+    """A single immutable term of a compiled cabbage formula."""
 
-    def __init__(self, term_type, sign, count=1, sides=0, value=0):
-        self.term_type = term_type
-        self.sign = sign
-        self.cabbage_count = count
-        self.sides = sides
-        self.value = value
+    __slots__ = ()
 
+    def __new__(cls, term_type, sign, count=1, sides=0, value=0):
+        return super().__new__(cls, term_type, sign, count, sides, value)
 
-def roll_polyhedral_cabbage(formula):
-    """Parse a polyhedral cabbage string.
+
+class FormulaException(error.CabbageException):
+    """A cabbage formula could not be compiled."""
+
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def normalize_formula(formula):
+    """Normalize a formula so that equivalent spellings share a cache entry."""
+    # Ignore all whitespace in the formula.
+    return re.sub(r'\s+', '', formula)
+
+
+def compile_formula(formula):
+    """Compile a polyhedral cabbage formula into an immutable term program.
 
   Expected to be in the form [A]cX[+BcY][+C]. Brackets denote optional terms.
 
-  Uninformed, pathetic humans may try to roll polyhedral dice, but we do not
-  support those. We should, however, let the humans know how uninformed and
-  pathetic they are if they attempt to roll dice. We roll polyhedral cabbages
-  in these parts.
+  Compiled formulas are cached, since players tend to roll the same few
+  formulas over and over.
 
   Args:
     formula: The unprocessed formula as a string.
 
-   Returns:
-     The roll result or error message.
+  Returns:
+    A tuple of validated Terms.
+
+  Raises:
+    FormulaException: The formula is invalid, with a message for the human.
   """
     if not formula:
-        return 'NO CABBAGE ROLL SPECIFIED. TRY HARDER!'
+        raise FormulaException('NO CABBAGE ROLL SPECIFIED. TRY HARDER!')
 
     # TODO(tunacom): All of these messages should address the requesting user.
     if DICE_REGEX.search(formula):
-        return DICE_HELP_MESSAGE
+        raise FormulaException(DICE_HELP_MESSAGE)
 
     if len(formula) > MAX_FORMULA_LENGTH:
-        return 'CABBAGE FORMULA TOO LONG. DOES NOT COMPUTE!'
+        raise FormulaException('CABBAGE FORMULA TOO LONG. DOES NOT COMPUTE!')
+
+    return _compile_normalized_formula(normalize_formula(formula))
 
-    # Ignore all whitespace in the formula.
-    formula = re.sub(r'\s+', '', formula)
 
+@functools.lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def _compile_normalized_formula(formula):
+    """Compile a normalized formula. See compile_formula."""
     # Split the formula into meaningful tokens (integers, "c", "+", and "-").
     tokens = [token for token in TOKEN_REGEX.split(formula) if token]
+    if not tokens:
+        raise FormulaException(INVALID_FORMULA_MESSAGE)
 
     # The first term is implied to be positive if unspecified.
     if tokens[0] != '-':
@@ -92,14 +143,15 @@ def roll_polyhedral_cabbage(formula):
 
     for token in tokens:
         if len(terms) > MAX_TERMS:
-            return 'TOO MANY TERMS IN CABBAGE FORMULA. DOES NOT COMPUTE!'
+            raise FormulaException(
+                'TOO MANY TERMS IN CABBAGE FORMULA. DOES NOT COMPUTE!')
 
         if state == ParseState.sign_required:
             state = ParseState.integer_or_roll_indicator
             try:
                 sign = SIGN_MAPPINGS[token]
             except KeyError:
-                return INVALID_FORMULA_MESSAGE
+                raise FormulaException(INVALID_FORMULA_MESSAGE)
 
         elif state == ParseState.integer_or_roll_indicator:
             # Check for the roll indicator first.
@@ -113,7 +165,7 @@ def roll_polyhedral_cabbage(formula):
             try:
                 left_value = int(token)
             except ValueError:
-                return INVALID_FORMULA_MESSAGE
+                raise FormulaException(INVALID_FORMULA_MESSAGE)
 
         elif state == ParseState.sign_or_roll_indicator:
             if token == ROLL_INDICATOR:
@@ -128,14 +180,14 @@ def roll_polyhedral_cabbage(formula):
             try:
                 sign = SIGN_MAPPINGS[token]
             except KeyError:
-                return INVALID_FORMULA_MESSAGE
+                raise FormulaException(INVALID_FORMULA_MESSAGE)
 
         elif state == ParseState.integer_required:
             state = ParseState.sign_required
             try:
                 right_value = int(token)
             except ValueError:
-                return INVALID_FORMULA_MESSAGE
+                raise FormulaException(INVALID_FORMULA_MESSAGE)
 
             # Finalize the current term. In this case, it's a roll.
             term = Term(TermType.roll,
@@ -144,35 +196,307 @@ def roll_polyhedral_cabbage(formula):
                         sides=right_value)
             terms.append(term)
 
-    # TODO(tunacom): Move to another function, easy to make mistakes by shadowing
-    # locals.
+    # Validate rolls up front, so evaluation never has to give up halfway.
     total_rolls = 0
+    for term in terms:
+        if term.term_type != TermType.roll:
+            continue
+
+        # Limit the total number of rolls to avoid spam.
+        total_rolls += term.cabbage_count
+        if total_rolls > MAX_POLYHEDRAL_CABBAGES:
+            raise FormulaException("I DON'T HAVE THAT MANY CABBAGES. SORRY!")
+        if term.sides < 1:
+            raise FormulaException(
+                "I DON'T EVEN KNOW WHAT A 0-SIDED CABBAGE IS!")
+        if term.sides > MAX_CABBAGE_SIDES:
+            raise FormulaException('NO CABBAGE HAS THAT MANY SIDES. SORRY!')
+        if term.cabbage_count < 1:
+            raise FormulaException(
+                'HOW TO ROLL NO CABBAGES? DOES NOT COMPUTE!')
+
+    return tuple(terms)
+
+
+def roll_cabbages(count, sides):
+    """Roll many cabbages with the same number of sides at once.
+
+  Uses NumPy when it is available, and random.choices otherwise.
+
+  Args:
+    count: The number of cabbages to roll.
+    sides: The number of sides each cabbage has.
+
+  Returns:
+    A sequence of rolls. A NumPy array if NumPy is available.
+  """
+    if numpy is not None:
+        return _numpy_generator.integers(1, sides, size=count, endpoint=True)
+
+    return random.choices(range(1, sides + 1), k=count)
+
+
+def _list_rolls(terms):
+    """Roll a formula small enough to list every individual cabbage.
+
+  Returns:
+    A (result, math) tuple.
+  """
     result = 0
-    math = ""
+    math = []
     for term in terms:
         sign_char = '+' if term.sign > 0 else '-'
         if term.term_type == TermType.constant:
             result += term.value * term.sign
-            math += '{sign}{value}'.format(sign=sign_char, value=term.value)
+            math.append('{sign}{value}'.format(sign=sign_char,
+                                               value=term.value))
         elif term.term_type == TermType.roll:
-            # Limit the total number of rolls to avoid spam.
-            total_rolls += term.cabbage_count
-            if total_rolls > MAX_POLYHEDRAL_CABBAGES:
-                return "I DON'T HAVE THAT MANY CABBAGES. SORRY!"
-            if term.sides < 1:
-                return "I DON'T EVEN KNOW WHAT A 0-SIDED CABBAGE IS!"
-            if term.sides > MAX_CABBAGE_SIDES:
-                return 'NO CABBAGE HAS THAT MANY SIDES. SORRY!'
-            if term.cabbage_count < 1:
-                return 'HOW TO ROLL NO CABBAGES? DOES NOT COMPUTE!'
-
             for _ in range(term.cabbage_count):
                 roll = random.randint(1, term.sides)
                 result += roll * term.sign
-                math += '{sign}[{value}]'.format(sign=sign_char, value=roll)
+                math.append('{sign}[{value}]'.format(sign=sign_char,
+                                                     value=roll))
+
+    math = ''.join(math)
 
     # Remove potential leading plus signs from the math for brevity.
     if math[0] == '+':
         math = math[1:]
 
-    return '{result} ({math})'.format(result=result, math=math)
+    return result, math
+
+
+def _histogram(rolls, sides, max_buckets=MAX_HISTOGRAM_BUCKETS):
+    """Count how often each face came up, in ranges of faces for big cabbages.
+
+  Returns:
+    A list of (lowest face, highest face, count) tuples.
+  """
+    buckets = min(sides, max_buckets)
+    if numpy is not None and isinstance(rolls, numpy.ndarray):
+        counts = numpy.bincount((rolls - 1) * buckets // sides,
+                                minlength=buckets).tolist()
+    else:
+        counter = collections.Counter(
+            (roll - 1) * buckets // sides for roll in rolls)
+        counts = [counter[bucket] for bucket in range(buckets)]
+
+    return [(bucket * sides // buckets + 1, (bucket + 1) * sides // buckets,
+             count) for bucket, count in enumerate(counts)]
+
+
+def _summarize_rolls(terms):
+    """Roll a formula, summarizing each term instead of listing cabbages.
+
+  Returns:
+    A (result, summary lines) tuple.
+  """
+    result = 0
+    lines = []
+    rolled_terms = sum(term.term_type == TermType.roll for term in terms)
+    max_buckets = max(1, MAX_HISTOGRAM_BUCKETS // rolled_terms)
+    for term in terms:
+        sign_char = '+' if term.sign > 0 else '-'
+        if term.term_type == TermType.constant:
+            result += term.value * term.sign
+            lines.append('{sign}{value}'.format(sign=sign_char,
+                                                value=term.value))
+            continue
+
+        rolls = roll_cabbages(term.cabbage_count, term.sides)
+        total = int(sum(rolls))
+        result += total * term.sign
+        lines.append(
+            SUMMARY_FORMAT.format(sign=sign_char,
+                                  count=term.cabbage_count,
+                                  sides=term.sides,
+                                  total=total,
+                                  min=int(min(rolls)),
+                                  max=int(max(rolls)),
+                                  mean=total / term.cabbage_count))
+
+        faces = []
+        for low, high, count in _histogram(rolls, term.sides, max_buckets):
+            label = str(low) if low == high else '%d-%d' % (low, high)
+            faces.append('[{label}] {count}'.format(label=label, count=count))
+        lines.append('  ' + ', '.join(faces))
+
+    # Remove potential leading plus signs from the summary for brevity.
+    if lines[0][0] == '+':
+        lines[0] = lines[0][1:]
+
+    return result, lines
+
+
+def evaluate_formula(terms):
+    """Roll the cabbages in a compiled formula and render the result.
+
+  Every cabbage is listed if that fits in a message. Otherwise each term is
+  summarized with its total, min, max, mean and a histogram of faces.
+
+  Args:
+    terms: A compiled formula, from compile_formula.
+
+  Returns:
+    The roll result, along with the math behind it.
+  """
+    total_rolls = sum(term.cabbage_count for term in terms
+                      if term.term_type == TermType.roll)
+    if total_rolls <= MAX_LISTED_CABBAGES:
+        result, math = _list_rolls(terms)
+        response = '{result} ({math})'.format(result=result, math=math)
+        if len(response) <= MAX_MESSAGE_LENGTH:
+            return response
+
+    # Too long to list, so roll again in bulk. Each roll is just as random.
+    result, lines = _summarize_rolls(terms)
+    lines.insert(0, SUMMARY_HEADER_FORMAT.format(result=result))
+    return '\n'.join(lines)
+
+
+def roll_polyhedral_cabbage(formula):
+    """Parse a polyhedral cabbage string.
+
+  Expected to be in the form [A]cX[+BcY][+C]. Brackets denote optional terms.
+
+  Uninformed, pathetic humans may try to roll polyhedral dice, but we do not
+  support those. We should, however, let the humans know how uninformed and
+  pathetic they are if they attempt to roll dice. We roll polyhedral cabbages
+  in these parts.
+
+  Args:
+    formula: The unprocessed formula as a string.
+
+   Returns:
+     The roll result or error message.
+  """
+    try:
+        terms = compile_formula(formula)
+    except FormulaException as e:
+        return str(e)
+
+    return evaluate_formula(terms)
+
+
+def compile_batch(batch):
+    """Compile a batch of cabbage formulas to be rolled together.
+
+  Formulas are separated by semicolons, and can be repeated with a prefix.
+  For example, "c20+5; 2c8+3" rolls each formula once, and "6x 4c6" rolls
+  4c6 six times.
+
+  Args:
+    batch: The unprocessed batch as a string.
+
+  Returns:
+    A list of (normalized formula, compiled formula) tuples, one per roll.
+
+  Raises:
+    FormulaException: A formula is invalid, or the batch is too big, with a
+      message for the human.
+  """
+    rolls = []
+    total_rolls = 0
+    for formula in batch.split(BATCH_SEPARATOR):
+        formula = normalize_formula(formula)
+        if not formula:
+            continue
+
+        repeats = 1
+        match = REPEAT_REGEX.fullmatch(formula)
+        if match:
+            repeats = int(match.group(1))
+            formula = match.group(2)
+        if repeats < 1:
+            raise FormulaException(
+                'HOW TO ROLL NO CABBAGES? DOES NOT COMPUTE!')
+        if len(rolls) + repeats > MAX_BATCH_ROLLS:
+            raise FormulaException(
+                'TOO MANY CABBAGE ROLLS AT ONCE. DOES NOT COMPUTE!')
+
+        terms = compile_formula(formula)
+        # Each roll is limited on its own, so limit the whole batch too.
+        total_rolls += repeats * sum(term.cabbage_count for term in terms
+                                     if term.term_type == TermType.roll)
+        if total_rolls > MAX_POLYHEDRAL_CABBAGES:
+            raise FormulaException("I DON'T HAVE THAT MANY CABBAGES. SORRY!")
+        rolls.extend([(formula, terms)] * repeats)
+
+    if not rolls:
+        raise FormulaException('NO CABBAGE ROLL SPECIFIED. TRY HARDER!')
+    return rolls
+
+
+def evaluate_batch(rolls):
+    """Roll a compiled batch of formulas and render each result.
+
+  Args:
+    rolls: A compiled batch, from compile_batch.
+
+  Returns:
+    A list of responses, one per roll. If there is more than one, each is
+    labelled with its formula.
+  """
+    if len(rolls) == 1:
+        return [evaluate_formula(rolls[0][1])]
+
+    return [
+        BATCH_RESULT_FORMAT.format(formula=formula,
+                                   response=evaluate_formula(terms))
+        for formula, terms in rolls
+    ]
+
+
+def pack_messages(responses, limit=MAX_MESSAGE_LENGTH):
+    """Pack responses into as few messages as they fit in.
+
+  Messages are filled a line at a time, in order. A line too long for a
+  message on its own is cut up.
+
+  Args:
+    responses: The responses, in order.
+    limit: The most characters in a message.
+
+  Returns:
+    A list of messages.
+  """
+    lines = []
+    for response in responses:
+        for line in response.split('\n'):
+            lines.extend(line[start:start + limit]
+                         for start in range(0, max(len(line), 1), limit))
+
+    messages = []
+    message = []
+    length = -1
+    for line in lines:
+        if message and length + 1 + len(line) > limit:
+            messages.append('\n'.join(message))
+            message = []
+            length = -1
+        message.append(line)
+        length += 1 + len(line)
+    if message:
+        messages.append('\n'.join(message))
+
+    return messages
+
+
+def roll_polyhedral_batch(batch):
+    """Roll a batch of polyhedral cabbage formulas, in as few messages as fit.
+
+  See compile_batch for the syntax, and roll_polyhedral_cabbage for the
+  formulas.
+
+  Args:
+    batch: The unprocessed batch as a string.
+
+  Returns:
+    A list of messages with the roll results, or with an error message.
+  """
+    try:
+        rolls = compile_batch(batch)
+    except FormulaException as e:
+        return [str(e)]
+
+    return pack_messages(evaluate_batch(rolls))
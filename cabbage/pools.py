@@ -0,0 +1,298 @@
+"""Pools of cabbages for each variety, refilled on one Flickr quota."""
+
+import math
+import time
+
+from cabbage import joy
+from cabbage import metrics
+
+# The Flickr tags searched for each pool, by the variety people ask for. A
+# photo must have every one of its pool's tags.
+POOL_TAGS = {
+    joy.DEFAULT_POOL: joy.DEFAULT_TAGS,
+    'savoy': 'savoy,cabbage',
+    'napa cabbage': 'napacabbage',
+    'bok choy': 'bokchoy',
+    'radicchio': 'radicchio',
+    'brussels sprouts': 'brusselssprouts',
+    'キャベツ': 'キャベツ',
+}
+# Other names people might ask for a pool by.
+POOL_ALIASES = {
+    'cabbages': joy.DEFAULT_POOL,
+    'brassica oleracea': joy.DEFAULT_POOL,
+    'napa': 'napa cabbage',
+    'sprouts': 'brussels sprouts',
+}
+
+# Each refill brings in what its pool is forecast to serve in this many
+# seconds, from its drain rate, between one and MAX_PAGES_PER_REFILL search
+# pages. When the Flickr quota left can't pay for every pool's refill, the
+# pages it can pay for are split between them by drain rate, and pools which
+# get none don't refill until the quota recovers.
+FORECAST_HORIZON = 30 * 60
+MAX_PAGES_PER_REFILL = 10
+# How often drain rates are measured and refills are planned again.
+REBALANCE_INTERVAL = 60
+# How much the latest measurement counts towards a pool's drain rate, against
+# the measurements before it.
+DRAIN_RATE_SMOOTHING = 0.3
+# A pool starts refilling when it has fewer cabbages than it serves in this
+# many seconds, so a refill has time to land before it runs out. Pools which
+# hardly drain at all wait until they are down to MIN_LOW_WATERMARK.
+REFILL_LEAD_TIME = 10 * 60
+MIN_LOW_WATERMARK = 20
+
+POOL_SUMMARY_FORMAT = (
+    '{pool}: {size} cabbages, {status}, {rate:.3f} draws/s, '
+    'forecast {forecast:.0f}, {pages} pages per refill')
+
+
+def _normalize(variety):
+    """Normalize a variety the way Flickr normalizes tags."""
+    return ''.join(variety.lower().split())
+
+
+def split_budget(budget, drain_rates, default_pool=joy.DEFAULT_POOL):
+    """Split a budget of search pages between pools by how fast they drain.
+
+  Args:
+    budget: The search pages to split.
+    drain_rates: A dictionary mapping pools to draws per second.
+    default_pool: Gets every page while nothing is draining.
+
+  Returns:
+    A dictionary mapping pools to search pages, which may be none.
+  """
+    pages = dict.fromkeys(drain_rates, 0)
+    total_rate = sum(drain_rates.values())
+    if budget <= 0:
+        return pages
+    if not total_rate:
+        pages[default_pool] = budget
+        return pages
+
+    shares = {
+        pool: budget * rate / total_rate
+        for pool, rate in drain_rates.items()
+    }
+    for pool, share in shares.items():
+        pages[pool] += int(share)
+
+    # Whatever rounding down left over goes to the largest remainders.
+    leftover = budget - sum(pages.values())
+    by_remainder = sorted(shares,
+                          key=lambda pool: shares[pool] - int(shares[pool]),
+                          reverse=True)
+    for pool in by_remainder[:leftover]:
+        pages[pool] += 1
+
+    return pages
+
+
+class CabbagePools(object):
+    """A CabbageCache for each variety, refilled on a shared Flickr quota.
+
+  Every REBALANCE_INTERVAL, how fast each pool is draining is measured, and
+  each pool's refills are sized to what it is forecast to serve in the
+  FORECAST_HORIZON, as long as the Flickr quota left can pay for them. Each
+  pool's low watermark is set to what it serves in REFILL_LEAD_TIME. Hot
+  pools start refilling early and bring back a lot, while cold pools sit
+  still and only fetch a page when they are nearly empty.
+  """
+
+    def __init__(self,
+                 caches,
+                 default_pool=joy.DEFAULT_POOL,
+                 quota_accountant=None,
+                 clock=time.monotonic):
+        """Schedule refills for some cabbage caches.
+
+    Until drain rates are known, the default pool keeps its usual refill
+    size, and the others fetch a page at a time.
+
+    Args:
+      caches: A dictionary mapping pool names to CabbageCaches.
+      default_pool: The pool to draw from when no variety is asked for.
+      quota_accountant: The QuotaAccountant counting Flickr calls, or None
+        for the one used to fetch cabbages.
+      clock: Returns the current time in seconds.
+    """
+        self.caches = dict(caches)
+        self.default_pool = default_pool
+        self.quota = (joy.flickr_client.quota
+                      if quota_accountant is None else quota_accountant)
+        self.drain_rates = dict.fromkeys(self.caches, 0.0)
+        self.forecasts = dict.fromkeys(self.caches, 0.0)
+        self._clock = clock
+        self._rebalanced_at = clock()
+        self._draws = {
+            pool: cabbage_cache.draws
+            for pool, cabbage_cache in self.caches.items()
+        }
+
+        self._names = {}
+        for pool, cabbage_cache in self.caches.items():
+            self._names[_normalize(pool)] = pool
+            self._names[_normalize(cabbage_cache.tags)] = pool
+        for alias, pool in POOL_ALIASES.items():
+            if pool in self.caches:
+                self._names.setdefault(_normalize(alias), pool)
+
+        for pool, cabbage_cache in self.caches.items():
+            if pool != default_pool:
+                cabbage_cache.pages_per_refill = 1
+            metrics.POOL_PAGES.set(cabbage_cache.pages_per_refill, pool=pool)
+
+    @property
+    def default(self):
+        """The CabbageCache for the default pool."""
+        return self.caches[self.default_pool]
+
+    def get(self, variety=''):
+        """Get the CabbageCache for a variety of cabbage.
+
+    Every REBALANCE_INTERVAL, the pools are rebalanced first. With shared
+    pools that means asking the cabbage store, so keep it off the event loop.
+
+    Args:
+      variety: The variety asked for, or nothing for the default pool.
+
+    Returns:
+      A CabbageCache, or None if there is no pool for the variety.
+    """
+        if self._clock() - self._rebalanced_at >= REBALANCE_INTERVAL:
+            self.rebalance()
+
+        if not variety.strip():
+            return self.default
+        pool = self._names.get(_normalize(variety))
+        return None if pool is None else self.caches[pool]
+
+    def _plan_refills(self):
+        """Size each pool's refills to its forecast, within the quota left."""
+        pages = {}
+        for pool, cabbage_cache in self.caches.items():
+            self.forecasts[pool] = self.drain_rates[pool] * FORECAST_HORIZON
+            metrics.POOL_FORECAST.set(self.forecasts[pool], pool=pool)
+            wanted = math.ceil(self.forecasts[pool] /
+                               max(1.0, cabbage_cache.kept_per_page))
+            pages[pool] = min(MAX_PAGES_PER_REFILL, max(1, wanted))
+
+        calls = sum(pages[pool] * cabbage_cache.calls_per_page
+                    for pool, cabbage_cache in self.caches.items())
+        remaining = self.quota.remaining()
+        if calls > remaining:
+            # Back off before the quota runs out, not after. The pages which
+            # can be paid for go to the pools draining fastest.
+            affordable = int(remaining * sum(pages.values()) / calls)
+            shares = split_budget(affordable, self.drain_rates,
+                                  self.default_pool)
+            pages = {pool: min(pages[pool], shares[pool]) for pool in pages}
+
+        for pool, cabbage_cache in self.caches.items():
+            cabbage_cache.pages_per_refill = pages[pool]
+            metrics.POOL_PAGES.set(pages[pool], pool=pool)
+
+    def rebalance(self):
+        """Measure how fast each pool drains, and plan its refills to match.
+
+    Pools which are draining and have dropped below their new low watermark
+    start refilling straight away.
+    """
+        now = self._clock()
+        elapsed = now - self._rebalanced_at
+        self._rebalanced_at = now
+        for pool, cabbage_cache in self.caches.items():
+            draws = cabbage_cache.draws - self._draws[pool]
+            self._draws[pool] = cabbage_cache.draws
+            rate = draws / elapsed if elapsed > 0 else 0.0
+            self.drain_rates[pool] = (
+                DRAIN_RATE_SMOOTHING * rate +
+                (1 - DRAIN_RATE_SMOOTHING) * self.drain_rates[pool])
+            metrics.POOL_DRAIN_RATE.set(self.drain_rates[pool], pool=pool)
+
+        self._plan_refills()
+        for pool, cabbage_cache in self.caches.items():
+            cabbage_cache.low_watermark = max(
+                MIN_LOW_WATERMARK,
+                math.ceil(self.drain_rates[pool] * REFILL_LEAD_TIME))
+            if self.drain_rates[pool]:
+                cabbage_cache.maybe_refill()
+
+    @property
+    def last_cabbage(self):
+        """The cabbage served most recently, from any pool."""
+        drawn = [
+            cabbage_cache for cabbage_cache in self.caches.values()
+            if cabbage_cache.last_drawn_at is not None
+        ]
+        if not drawn:
+            return None
+        return max(
+            drawn,
+            key=lambda cabbage_cache: cabbage_cache.last_drawn_at).last_cabbage
+
+    def describe(self):
+        """Describe each pool for humans.
+
+    Returns:
+      A list of lines.
+    """
+        return [
+            POOL_SUMMARY_FORMAT.format(pool=pool,
+                                       size=len(cabbage_cache),
+                                       status=cabbage_cache.status,
+                                       rate=self.drain_rates[pool],
+                                       forecast=self.forecasts[pool],
+                                       pages=cabbage_cache.pages_per_refill)
+            for pool, cabbage_cache in self.caches.items()
+        ]
+
+    def footprint(self):
+        """Estimate the memory used by the cached cabbages, in bytes."""
+        if self.default.shared:
+            # Every pool is in the same store, so they all share one size.
+            return self.default.footprint()
+        return sum(cabbage_cache.footprint()
+                   for cabbage_cache in self.caches.values())
+
+    def close(self):
+        """Wait for any refills in progress, then stop refilling."""
+        for cabbage_cache in self.caches.values():
+            cabbage_cache.close()
+
+    def __iter__(self):
+        return iter(self.caches.values())
+
+    def __len__(self):
+        return sum(
+            len(cabbage_cache) for cabbage_cache in self.caches.values())
+
+
+def create_pools(flickr_api_key, cabbage_store=None, **kwargs):
+    """Create a CabbageCache for every pool in POOL_TAGS.
+
+  The default pool starts out with the usual low watermark, and the others
+  with MIN_LOW_WATERMARK, until their drain rates are known.
+
+  Args:
+    flickr_api_key: The Flickr API key used to fetch cabbages.
+    cabbage_store: Optional CabbageStore, shared by every pool.
+    **kwargs: Passed on to every CabbageCache.
+
+  Returns:
+    CabbagePools.
+  """
+    caches = {}
+    for pool, tags in POOL_TAGS.items():
+        low_watermark = (joy.CABBAGE_LOW_WATERMARK
+                         if pool == joy.DEFAULT_POOL else MIN_LOW_WATERMARK)
+        caches[pool] = joy.CabbageCache(flickr_api_key,
+                                        low_watermark=low_watermark,
+                                        cabbage_store=cabbage_store,
+                                        pool=pool,
+                                        tags=tags,
+                                        **kwargs)
+
+    return CabbagePools(caches)
@@ -0,0 +1,291 @@
+"""On-demand profiling of the running bot: CPU, memory and event loop lag.
+
+Nothing here costs anything until it is switched on.
+"""
+
+import asyncio
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+from cabbage import error
+
+# Functions or lines listed in each report.
+TOP_ENTRIES = 30
+# The longest a profile may run, whether it is timed or counts commands.
+MAX_PROFILE_SECONDS = 10 * 60
+MAX_PROFILE_COMMANDS = 1000
+# Stack frames kept for each memory allocation.
+TRACEMALLOC_FRAMES = 1
+# How often the event loop is checked on while measuring its lag.
+LOOP_LAG_INTERVAL = 0.05
+
+CPU_REPORT = 'cpu'
+MEMORY_REPORT = 'memory'
+LAG_REPORT = 'lag'
+REPORT_FILENAME_FORMAT = '{kind}-{time}.txt'
+
+INVALID_DURATION_ERROR = (
+    'PROFILE FOR HOW LONG? TRY "30s" FOR SECONDS, OR "20" FOR COMMANDS.')
+PROFILE_RUNNING_ERROR = 'I AM ALREADY BEING PROFILED. ONE AT A TIME!'
+LAG_SUMMARY_FORMAT = ('Event loop lag over {seconds:g}s: {count} samples, '
+                      'p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms, '
+                      'max {max:.1f}ms')
+MEMORY_SUMMARY_FORMAT = ('Traced memory: {current:.1f} KiB now, {peak:.1f} '
+                         'KiB at peak')
+
+
+class ProfileException(error.CabbageException):
+    """A profile could not be started."""
+
+    def __init__(self, message):
+        super().__init__(message)
+
+
+def parse_duration(value):
+    """Parse how long to profile for: "30s" for seconds, or "20" for commands.
+
+  Returns:
+    A (seconds, commands) tuple, one of which is None.
+
+  Raises:
+    ProfileException: The duration is invalid.
+  """
+    try:
+        if value.endswith('s'):
+            seconds, commands = float(value[:-1]), None
+            valid = 0 < seconds <= MAX_PROFILE_SECONDS
+        else:
+            seconds, commands = None, int(value)
+            valid = 0 < commands <= MAX_PROFILE_COMMANDS
+    except ValueError:
+        valid = False
+    if not valid:
+        raise ProfileException(INVALID_DURATION_ERROR)
+    return seconds, commands
+
+
+class Profiler(object):
+    """cProfile for the event loop and the threads working for it.
+
+  While a profile is running, the event loop's thread is profiled
+  throughout, and work handed to other threads through wrap() is profiled
+  as it runs. The profiles are added up when it stops. While no profile is
+  running, wrap() hands back what it was given, so nothing is slowed down.
+  """
+
+    def __init__(self):
+        self.active = False
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._loop_profile = None
+        self._commands_left = None
+        self._done = None
+
+    def start(self, commands=None):
+        """Start profiling, from the event loop.
+
+    Args:
+      commands: Stop after this many commands have finished, or None to
+        stop when told to.
+
+    Raises:
+      ProfileException: A profile is already running.
+    """
+        with self._lock:
+            if self.active:
+                raise ProfileException(PROFILE_RUNNING_ERROR)
+            self.active = True
+            self._profiles = []
+        self._commands_left = commands
+        self._done = asyncio.Event()
+        self._loop_profile = cProfile.Profile()
+        self._loop_profile.enable()
+
+    def note_command(self):
+        """Count a finished command towards the profile's commands."""
+        if self._commands_left is None:
+            return
+        self._commands_left -= 1
+        if self._commands_left <= 0:
+            self._done.set()
+
+    async def wait(self, seconds=None):
+        """Wait until the profile is done, or for some seconds."""
+        timeout = MAX_PROFILE_SECONDS if seconds is None else seconds
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self, top=TOP_ENTRIES):
+        """Stop profiling, from the event loop.
+
+    Args:
+      top: How many functions to report.
+
+    Returns:
+      A report of the functions with the most cumulative time.
+    """
+        self._loop_profile.disable()
+        with self._lock:
+            self.active = False
+            profiles = [self._loop_profile] + self._profiles
+            self._profiles = []
+        self._loop_profile = None
+        self._commands_left = None
+
+        output = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=output)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        return output.getvalue()
+
+    def run(self, function, *args, **kwargs):
+        """Call a function in a thread of its own, profiled."""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Newer Pythons only allow one profiler at a time, so this thread
+            # goes unprofiled.
+            return function(*args, **kwargs)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                if self.active:
+                    self._profiles.append(profile)
+
+    def wrap(self, function):
+        """Wrap a function about to be run in another thread.
+
+    Returns:
+      The function, profiled if a profile is running.
+    """
+        if not self.active:
+            return function
+        return functools.partial(self.run, function)
+
+
+class MemoryTracker(object):
+    """Diffs tracemalloc snapshots, to show what keeps growing.
+
+  The first snapshot starts tracing allocations, and each one after that is
+  compared with the one before. Tracing slows down every allocation, so it
+  stays off until it is asked for, and can be stopped again.
+  """
+
+    def __init__(self):
+        self._snapshot = None
+
+    @property
+    def tracing(self):
+        """Whether allocations are being traced."""
+        return tracemalloc.is_tracing()
+
+    def _take_snapshot(self):
+        """Take a snapshot, leaving out tracemalloc's own allocations."""
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+
+    def snapshot(self, top=TOP_ENTRIES):
+        """Take a snapshot, and compare it with the one before.
+
+    Args:
+      top: How many lines of code to report.
+
+    Returns:
+      A report of the lines of code whose allocations grew the most.
+    """
+        if not self.tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._snapshot = None
+
+        snapshot = self._take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            MEMORY_SUMMARY_FORMAT.format(current=current / 1024,
+                                         peak=peak / 1024)
+        ]
+        if self._snapshot is None:
+            lines.append('Started tracing. Take another snapshot to see what '
+                         'grows.')
+        else:
+            lines.append('Growth since the last snapshot:')
+            lines.extend(
+                str(stat) for stat in snapshot.compare_to(
+                    self._snapshot, 'lineno')[:top])
+        self._snapshot = snapshot
+        return '\n'.join(lines)
+
+    def stop(self):
+        """Stop tracing, and forget the last snapshot."""
+        tracemalloc.stop()
+        self._snapshot = None
+
+
+def _percentile(values, quantile):
+    """Get a percentile of sorted values, without interpolation."""
+    return values[min(len(values) - 1, int(quantile * len(values)))]
+
+
+async def sample_loop_lag(seconds, interval=LOOP_LAG_INTERVAL):
+    """Measure how late the event loop wakes up from short sleeps.
+
+  Args:
+    seconds: How long to measure for.
+    interval: How long each sleep is.
+
+  Returns:
+    A report with a summary, then every sample in milliseconds.
+  """
+    loop = asyncio.get_running_loop()
+    lags = []
+    stop_at = loop.time() + seconds
+    while loop.time() < stop_at:
+        started_at = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - started_at - interval) * 1000)
+
+    ordered = sorted(lags)
+    summary = LAG_SUMMARY_FORMAT.format(seconds=seconds,
+                                        count=len(lags),
+                                        p50=_percentile(ordered, 0.5),
+                                        p95=_percentile(ordered, 0.95),
+                                        p99=_percentile(ordered, 0.99),
+                                        max=ordered[-1])
+    return '\n'.join([summary, ''] + ['%.2f' % lag for lag in lags])
+
+
+def save_report(directory, kind, report):
+    """Write a report to a local file.
+
+  Args:
+    directory: Where reports are kept. Created if needed.
+    kind: CPU_REPORT, MEMORY_REPORT or LAG_REPORT.
+    report: The report.
+
+  Returns:
+    The path of the file.
+  """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(
+        directory,
+        REPORT_FILENAME_FORMAT.format(kind=kind,
+                                      time=time.strftime('%Y%m%d-%H%M%S')))
+    with open(path, 'w') as report_file:
+        report_file.write(report)
+    return path
+
+
+# Shared by the bot and the refills, like the Flickr client.
+profiler = Profiler()
+memory_tracker = MemoryTracker()
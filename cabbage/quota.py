@@ -0,0 +1,140 @@
+"""Accounting for Flickr API calls against the API key's hourly limit."""
+
+import collections
+import threading
+import time
+
+from cabbage import metrics
+
+# Flickr allows each API key this many calls an hour.
+FLICKR_HOURLY_LIMIT = 3600
+QUOTA_WINDOW = 60 * 60
+# The fraction of the limit held back, so we stop before Flickr stops us.
+# Other processes using the same key, and Flickr counting a little
+# differently, come out of this.
+QUOTA_RESERVE = 0.1
+
+QUOTA_SUMMARY_FORMAT = ('Flickr quota: {used}/{limit} calls in the last '
+                        '{minutes:.0f} minutes ({methods}), {remaining} left '
+                        'before backing off')
+
+
+class QuotaAccountant(object):
+    """Counts Flickr API calls in a sliding window.
+
+  Every call is counted when it is made, retries included, and calls are
+  refused once the window holds the limit minus the reserve.
+
+  Calls are counted in memory, or in a CabbageStore so that every process
+  sharing it, and so the API key, shares one window.
+  """
+
+    def __init__(self,
+                 limit=FLICKR_HOURLY_LIMIT,
+                 window=QUOTA_WINDOW,
+                 reserve=QUOTA_RESERVE,
+                 clock=None,
+                 cabbage_store=None):
+        """Start counting.
+
+    Args:
+      limit: Calls allowed in each window.
+      window: The length of the window, in seconds.
+      reserve: The fraction of the limit never to use.
+      clock: Returns the current time in seconds. Defaults to
+        time.monotonic, or to time.time with a store, since every process
+        sharing it must agree on the time.
+      cabbage_store: Optional CabbageStore to count calls in.
+    """
+        self.limit = limit
+        self.window = window
+        self.soft_limit = int(limit * (1 - reserve))
+        if clock is None:
+            clock = time.monotonic if cabbage_store is None else time.time
+        self._clock = clock
+        self._store = cabbage_store
+        self._lock = threading.Lock()
+        # (time, method) for each call in the window, oldest first.
+        self._calls = collections.deque()
+
+    def _expire(self):
+        """Forget calls which have left the window. The lock must be held."""
+        expiry = self._clock() - self.window
+        while self._calls and self._calls[0][0] <= expiry:
+            self._calls.popleft()
+
+    def try_spend(self, method):
+        """Count a call, unless it would go over the soft limit.
+
+    Args:
+      method: The Flickr API method being called.
+
+    Returns:
+      Whether the call may be made.
+    """
+        if self._store is not None:
+            used = self._store.spend_call(method, self._clock(), self.window,
+                                          self.soft_limit)
+            if used is None:
+                return False
+        else:
+            with self._lock:
+                self._expire()
+                if len(self._calls) >= self.soft_limit:
+                    return False
+                self._calls.append((self._clock(), method))
+                used = len(self._calls)
+        metrics.FLICKR_QUOTA_USED.set(used)
+        return True
+
+    def refund(self, method):
+        """Stop counting the latest call to a method, because it wasn't made.
+
+    Args:
+      method: The Flickr API method which wasn't called after all.
+    """
+        if self._store is not None:
+            used = self._store.refund_call(method)
+        else:
+            with self._lock:
+                for i in range(len(self._calls) - 1, -1, -1):
+                    if self._calls[i][1] == method:
+                        del self._calls[i]
+                        break
+                used = len(self._calls)
+        metrics.FLICKR_QUOTA_USED.set(used)
+
+    def used(self):
+        """Get the number of calls in the window."""
+        if self._store is not None:
+            return sum(self.used_by_method().values())
+        with self._lock:
+            self._expire()
+            return len(self._calls)
+
+    def used_by_method(self):
+        """Get the number of calls in the window for each method."""
+        if self._store is not None:
+            return self._store.count_calls(self._clock() - self.window)
+        with self._lock:
+            self._expire()
+            return collections.Counter(method for _, method in self._calls)
+
+    def remaining(self):
+        """Get the number of calls left before the soft limit."""
+        return max(0, self.soft_limit - self.used())
+
+    def describe(self):
+        """Describe quota usage for humans."""
+        by_method = self.used_by_method()
+        methods = ', '.join(
+            '{method} {count}'.format(method=method.rpartition('.')[2],
+                                      count=count)
+            for method, count in sorted(by_method.items())) or 'none'
+        used = sum(by_method.values())
+        return QUOTA_SUMMARY_FORMAT.format(used=used,
+                                           limit=self.limit,
+                                           minutes=self.window / 60,
+                                           methods=methods,
+                                           remaining=max(
+                                               0, self.soft_limit - used))
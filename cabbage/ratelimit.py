@@ -0,0 +1,195 @@
+"""Rate limits for commands, per user, channel and guild."""
+
+import asyncio
+import collections
+import time
+
+from cabbage import metrics
+
+SCOPE_USER = 'user'
+SCOPE_CHANNEL = 'channel'
+SCOPE_GUILD = 'guild'
+SCOPES = (SCOPE_USER, SCOPE_CHANNEL, SCOPE_GUILD)
+
+# Commands allowed in a burst, and over how many seconds the burst refills,
+# for each scope.
+DEFAULT_LIMITS = {
+    SCOPE_USER: (5, 30.0),
+    SCOPE_CHANNEL: (10, 30.0),
+    SCOPE_GUILD: (30, 60.0),
+}
+# Idle buckets are forgotten once there are more than this many.
+MAX_BUCKETS = 10000
+# Commands over the limit in a channel within this many seconds of each other
+# get one response between them.
+COALESCE_WINDOW = 2.0
+
+INVALID_LIMIT_ERROR = 'A limit looks like COMMANDS/SECONDS, like 5/30.'
+
+
+class Limit(collections.namedtuple('Limit', ['burst', 'period'])):
+    """Commands allowed in a burst, and the seconds it takes to refill."""
+
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """Commands allowed per second, once the burst is spent."""
+        return self.burst / self.period
+
+    def __str__(self):
+        return '{burst}/{period:g}'.format(burst=self.burst,
+                                           period=self.period)
+
+
+def parse_limit(value):
+    """Parse a limit like "5/30", for five commands every thirty seconds.
+
+  Raises:
+    ValueError: The limit is invalid.
+  """
+    burst, _, period = value.partition('/')
+    try:
+        limit = Limit(int(burst), float(period))
+    except ValueError:
+        raise ValueError(INVALID_LIMIT_ERROR)
+    if limit.burst < 1 or limit.period <= 0:
+        raise ValueError(INVALID_LIMIT_ERROR)
+    return limit
+
+
+class TokenBucket(object):
+    """A bucket of tokens, spent one per command and refilled over time."""
+
+    def __init__(self, limit, now):
+        """Create a full bucket.
+
+    Args:
+      limit: The Limit to enforce.
+      now: The current time in seconds.
+    """
+        self.limit = limit
+        self.tokens = float(limit.burst)
+        self.updated_at = now
+
+    def refill(self, now):
+        """Add the tokens earned since the last refill."""
+        self.tokens = min(
+            self.limit.burst,
+            self.tokens + (now - self.updated_at) * self.limit.rate)
+        self.updated_at = now
+
+    @property
+    def full(self):
+        """Whether the bucket is full, as of its last refill."""
+        return self.tokens >= self.limit.burst
+
+
+class RateLimiter(object):
+    """Token bucket rate limits per user, channel and guild.
+
+  A command goes ahead only if every bucket it falls in has a token, and
+  then takes one from each. Buckets are only created for whoever is sending
+  commands, and forgotten once they are full again.
+  """
+
+    def __init__(self, limits=None, clock=time.monotonic):
+        """Set the limits.
+
+    Args:
+      limits: A dictionary mapping scopes to Limits. Scopes left out use
+        DEFAULT_LIMITS.
+      clock: Returns the current time in seconds.
+    """
+        self.limits = {
+            scope: Limit(*limit)
+            for scope, limit in DEFAULT_LIMITS.items()
+        }
+        self.limits.update(limits or {})
+        self._clock = clock
+        self._buckets = {}
+
+    def _bucket(self, scope, key, now):
+        """Get the refilled bucket for a user, channel or guild."""
+        bucket = self._buckets.get((scope, key))
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                self._forget_idle(now)
+            bucket = TokenBucket(self.limits[scope], now)
+            self._buckets[(scope, key)] = bucket
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def _forget_idle(self, now):
+        """Forget buckets which have filled back up."""
+        for scope_and_key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.full:
+                del self._buckets[scope_and_key]
+
+    def check(self, user, channel, guild=None):
+        """Check whether a command is allowed, and count it if it is.
+
+    Args:
+      user: The ID of the user who sent the command.
+      channel: The ID of the channel it was sent in.
+      guild: The ID of the guild it was sent in, or None for a DM.
+
+    Returns:
+      None if the command is allowed. Otherwise the first scope, from the
+      narrowest, whose limit it is over.
+    """
+        now = self._clock()
+        keys = {SCOPE_USER: user, SCOPE_CHANNEL: channel, SCOPE_GUILD: guild}
+        buckets = [(scope, self._bucket(scope, keys[scope], now))
+                   for scope in SCOPES if keys[scope] is not None]
+        for scope, bucket in buckets:
+            if bucket.tokens < 1:
+                return scope
+
+        for _, bucket in buckets:
+            bucket.tokens -= 1
+        return None
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class Coalescer(object):
+    """Answers requests arriving close together with one response.
+
+  The first request for a key waits out the window, gathering any others
+  for the same key, then responds to them all at once.
+  """
+
+    def __init__(self, window=COALESCE_WINDOW):
+        """Set the window.
+
+    Args:
+      window: Seconds to gather requests for before responding.
+    """
+        self.window = window
+        self._pending = {}
+
+    async def submit(self, key, item, respond, command=''):
+        """Gather a request, responding once the window is over.
+
+    Args:
+      key: Requests with the same key share a response.
+      item: Anything the response needs to know about this request.
+      respond: An async function called with the list of items gathered.
+      command: The command requested, for metrics.
+    """
+        if key in self._pending:
+            self._pending[key].append(item)
+            return
+
+        self._pending[key] = items = [item]
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            del self._pending[key]
+        metrics.COALESCED_RESPONSES.inc(command=command)
+        metrics.COALESCED_REQUESTS.inc(len(items), command=command)
+        await respond(items)
@@ -0,0 +1,478 @@
+"""Persistent on-disk storage for vetted cabbages."""
+
+import collections
+import copy
+import random
+import sqlite3
+import threading
+import time
+
+from cabbage import cache
+
+# Vetted cabbages older than this are refetched rather than served.
+CABBAGE_STORE_TTL = 7 * 24 * 60 * 60
+# Vetting verdicts older than this are forgotten, in case tags have changed.
+VERDICT_TTL = 30 * 24 * 60 * 60
+# Counting a pool's cabbages means scanning them, so the count is reused for
+# this many seconds, allowing for this process's own draws. Draws by other
+# processes sharing the store go unnoticed until then.
+SIZE_ESTIMATE_TTL = 5.0
+
+# The pool of cabbages a store works with, unless told otherwise.
+DEFAULT_POOL = 'cabbage'
+
+# Bump this whenever the tables below change. The store only holds data which
+# can be refetched from Flickr, so outdated stores are simply discarded.
+SCHEMA_VERSION = 9
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cabbages (
+    pool TEXT NOT NULL,
+    photo_id INTEGER NOT NULL,
+    secret TEXT NOT NULL,
+    server TEXT NOT NULL,
+    farm INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    owner TEXT,
+    tags TEXT,
+    verdict TEXT,
+    latency REAL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (pool, photo_id)
+);
+CREATE INDEX IF NOT EXISTS cabbages_by_pool ON cabbages (pool);
+CREATE TABLE IF NOT EXISTS verdicts (
+    photo_id INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    accepted INTEGER NOT NULL,
+    reason TEXT,
+    tags TEXT NOT NULL,
+    decided_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS verdicts_by_owner ON verdicts (owner);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value NOT NULL
+);
+CREATE TABLE IF NOT EXISTS quota_calls (
+    called_at REAL NOT NULL,
+    method TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS quota_calls_by_time ON quota_calls (called_at);
+"""
+TABLES = ('cabbages', 'verdicts', 'leases', 'state', 'quota_calls')
+CABBAGE_COLUMNS = ('photo_id, secret, server, farm, title, owner, tags, '
+                   'verdict, latency, fetched_at')
+INSERT_CABBAGE = ('INSERT OR REPLACE INTO cabbages (pool, ' + CABBAGE_COLUMNS +
+                  ') VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)')
+
+# Whether a photo was accepted by vetting, and why not if it wasn't.
+Verdict = collections.namedtuple(
+    'Verdict',
+    ['photo_id', 'owner', 'accepted', 'reason', 'tags', 'decided_at'])
+
+
+class CabbageStore(object):
+    """SQLite store of vetted cabbages.
+
+  One store can be shared by the event loop and worker threads, and several
+  processes can open the same file. Draws are atomic, so a cabbage is never
+  served twice, and leases let processes agree on who does what.
+
+  Cabbages are kept in pools, one for each variety. A store only works with
+  the cabbages in its own pool, but verdicts, leases, state and Flickr calls
+  are shared by every pool. Use for_pool() to work with another pool of the
+  same store.
+
+  The length of a store is an estimate, recounted every SIZE_ESTIMATE_TTL
+  seconds, so that checking it is cheap enough for every draw.
+  """
+
+    def __init__(self,
+                 path,
+                 ttl=CABBAGE_STORE_TTL,
+                 verdict_ttl=VERDICT_TTL,
+                 pool=DEFAULT_POOL):
+        """Open (or create) a cabbage store.
+
+    Args:
+      path: Path of the SQLite database file.
+      ttl: Seconds after which a stored cabbage is considered stale.
+      verdict_ttl: Seconds after which a vetting verdict is forgotten.
+      pool: The pool of cabbages to work with.
+    """
+        self.pool = pool
+        self.ttl = ttl
+        self.verdict_ttl = verdict_ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # (size, counted_at) for each pool, shared with views of other pools.
+        self._sizes = {}
+
+        with self._lock, self._connection:
+            # WAL without full syncs keeps writes cheap enough for the loop.
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+
+            version = self._connection.execute(
+                'PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                for table in TABLES:
+                    self._connection.execute('DROP TABLE IF EXISTS ' + table)
+                self._connection.execute('PRAGMA user_version = %d' %
+                                         SCHEMA_VERSION)
+            self._connection.executescript(SCHEMA)
+
+    def for_pool(self, pool):
+        """Get a view of this store which works with another pool.
+
+    The view shares this store's connection, so closing either closes both.
+    """
+        view = copy.copy(self)
+        view.pool = pool
+        return view
+
+    def add(self, cabbage, fetched_at=None):
+        """Store a vetted cabbage.
+
+    Args:
+      cabbage: The CabbagePhoto to store.
+      fetched_at: When the photo was fetched, defaulting to when it was
+        vetted.
+    """
+        with self._lock, self._connection:
+            row = (self.pool, ) + _cabbage_to_row(cabbage, fetched_at)
+            self._connection.execute(INSERT_CABBAGE, row)
+            self._sizes.pop(self.pool, None)
+
+    def extend(self, cabbages):
+        """Store several vetted cabbages in one transaction."""
+        rows = [(self.pool, ) + _cabbage_to_row(cabbage)
+                for cabbage in cabbages]
+        with self._lock, self._connection:
+            self._connection.executemany(INSERT_CABBAGE, rows)
+            self._sizes.pop(self.pool, None)
+
+    def remove(self, photo_id):
+        """Forget a cabbage, usually because it has been served."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM cabbages WHERE pool = ? AND photo_id = ?',
+                (self.pool, photo_id))
+            self._sizes.pop(self.pool, None)
+
+    def load(self):
+        """Load every fresh cabbage, discarding stale ones.
+
+    Returns:
+      A list of CabbagePhotos.
+    """
+        expiry = time.time() - self.ttl
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM cabbages WHERE pool = ? AND fetched_at < ?',
+                (self.pool, expiry))
+            rows = self._connection.execute(
+                'SELECT ' + CABBAGE_COLUMNS + ' FROM cabbages WHERE pool = ?',
+                (self.pool, )).fetchall()
+            self._sizes[self.pool] = (len(rows), time.monotonic())
+
+        return [_row_to_cabbage(row) for row in rows]
+
+    def draw(self):
+        """Atomically remove a random fresh cabbage.
+
+    Only one drawer can ever get a given cabbage, even across processes. The
+    cabbage is the first at or after a random rowid, so finding it only takes
+    a few index lookups however many cabbages there are. Stale cabbages are
+    discarded when one is drawn.
+
+    Returns:
+      A CabbagePhoto, or None if there are no fresh cabbages.
+    """
+        expiry = time.time() - self.ttl
+        with self._lock, self._connection:
+            # Take the write lock before reading the rowid bounds, so that no
+            # other drawer can empty the pool between reading and deleting.
+            self._connection.execute('BEGIN IMMEDIATE')
+            while True:
+                # Separate subqueries, since SQLite only looks up a MIN or MAX
+                # through the index when it is the only aggregate.
+                low, high = self._connection.execute(
+                    'SELECT (SELECT MIN(rowid) FROM cabbages WHERE pool = ?), '
+                    '(SELECT MAX(rowid) FROM cabbages WHERE pool = ?)',
+                    (self.pool, self.pool)).fetchone()
+                if low is None or high is None:
+                    self._sizes[self.pool] = (0, time.monotonic())
+                    return None
+                row = self._connection.execute(
+                    'DELETE FROM cabbages WHERE rowid = ('
+                    'SELECT rowid FROM cabbages WHERE pool = ? AND rowid >= ? '
+                    'ORDER BY rowid LIMIT 1) RETURNING ' + CABBAGE_COLUMNS,
+                    (self.pool, random.randint(low, high))).fetchone()
+                if row[-1] >= expiry:
+                    break
+
+                # Where there is one stale cabbage there are usually more.
+                self._connection.execute(
+                    'DELETE FROM cabbages WHERE pool = ? AND fetched_at < ?',
+                    (self.pool, expiry))
+                self._sizes.pop(self.pool, None)
+
+            size = self._sizes.get(self.pool)
+            if size is not None:
+                self._sizes[self.pool] = (max(0, size[0] - 1), size[1])
+
+        return _row_to_cabbage(row)
+
+    def clear(self):
+        """Forget every stored cabbage in the pool."""
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM cabbages WHERE pool = ?',
+                                     (self.pool, ))
+            self._sizes[self.pool] = (0, time.monotonic())
+
+    def record_verdict(self, photo_id, owner, reason, tags):
+        """Remember how vetting a photo went.
+
+    Args:
+      photo_id: The Flickr photo id.
+      owner: The Flickr NSID of the photo owner.
+      reason: Why the photo was rejected, or None if it was accepted.
+      tags: The photo's tags.
+    """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?)',
+                (int(photo_id), owner, reason is None, reason, ' '.join(tags),
+                 time.time()))
+
+    def get_verdicts(self, photo_ids):
+        """Look up the verdicts for some photos.
+
+    Args:
+      photo_ids: An iterable of Flickr photo ids.
+
+    Returns:
+      A dictionary mapping photo ids to Verdicts. Photos which haven't been
+      vetted recently are left out.
+    """
+        photo_ids = [int(photo_id) for photo_id in photo_ids]
+        expiry = time.time() - self.verdict_ttl
+        verdicts = {}
+
+        # Stay well under SQLite's limit on query parameters.
+        batch_size = 500
+        with self._lock:
+            for start in range(0, len(photo_ids), batch_size):
+                batch = photo_ids[start:start + batch_size]
+                rows = self._connection.execute(
+                    'SELECT * FROM verdicts WHERE decided_at >= ? AND '
+                    'photo_id IN (%s)' % ', '.join(['?'] * len(batch)),
+                    [expiry] + batch)
+                for row in rows:
+                    verdict = Verdict(*row)
+                    verdicts[verdict.photo_id] = verdict._replace(
+                        accepted=bool(verdict.accepted),
+                        tags=verdict.tags.split())
+
+        return verdicts
+
+    def get_owner_reputation(self, owner):
+        """Tally the recent verdicts for an owner's photos.
+
+    Returns:
+      An (accepted, rejected) tuple.
+    """
+        with self._lock:
+            accepted, rejected = self._connection.execute(
+                'SELECT TOTAL(accepted), TOTAL(NOT accepted) FROM verdicts '
+                'WHERE owner = ? AND decided_at >= ?',
+                (owner, time.time() - self.verdict_ttl)).fetchone()
+
+        return int(accepted), int(rejected)
+
+    def get_disreputable_owners(self, min_rejections, min_rejection_ratio):
+        """Find owners whose photos are rarely cabbage.
+
+    Args:
+      min_rejections: How many of an owner's photos must have been rejected.
+      min_rejection_ratio: The fraction of an owner's photos which must have
+        been rejected.
+
+    Returns:
+      A frozenset of Flickr NSIDs.
+    """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT owner FROM verdicts WHERE decided_at >= ? '
+                'GROUP BY owner HAVING TOTAL(NOT accepted) >= ? '
+                'AND AVG(NOT accepted) >= ?',
+                (time.time() - self.verdict_ttl, min_rejections,
+                 min_rejection_ratio)).fetchall()
+
+        return frozenset(row[0] for row in rows)
+
+    def acquire_lease(self, name, holder, duration):
+        """Take or renew a named lease, unless someone else holds it.
+
+    Args:
+      name: What the lease is for, like "refill".
+      holder: Who wants the lease. Must be unique to each process.
+      duration: Seconds until the lease expires if it isn't renewed.
+
+    Returns:
+      Whether the holder now holds the lease.
+    """
+        now = time.time()
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                'INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO '
+                'UPDATE SET holder = excluded.holder, '
+                'expires_at = excluded.expires_at '
+                'WHERE leases.holder = excluded.holder '
+                'OR leases.expires_at < ?',
+                (name, holder, now + duration, now))
+            return cursor.rowcount > 0
+
+    def release_lease(self, name, holder):
+        """Give up a lease, if the holder still holds it."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM leases WHERE name = ? AND holder = ?',
+                (name, holder))
+
+    def get_state(self, name, default=None):
+        """Get a named piece of state, like the served history.
+
+    Returns:
+      The value last set, or the default if it was never set.
+    """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value FROM state WHERE name = ?', (name, )).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, name, value):
+        """Set a named piece of state to some bytes, text or a number."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO state VALUES (?, ?)', (name, value))
+
+    def spend_call(self, method, now, window, limit):
+        """Count a Flickr call, unless the window already holds the limit.
+
+    Calls which have left the window are forgotten first.
+
+    Args:
+      method: The Flickr API method being called.
+      now: The current time in seconds since the epoch.
+      window: The length of the window, in seconds.
+      limit: The most calls allowed in the window.
+
+    Returns:
+      The number of calls in the window, this one included, or None if it
+      was refused.
+    """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM quota_calls WHERE called_at <= ?',
+                (now - window, ))
+            used = self._connection.execute(
+                'SELECT COUNT(*) FROM quota_calls').fetchone()[0]
+            if used >= limit:
+                return None
+            self._connection.execute('INSERT INTO quota_calls VALUES (?, ?)',
+                                     (now, method))
+        return used + 1
+
+    def refund_call(self, method):
+        """Stop counting the latest call to a Flickr method.
+
+    Returns:
+      The number of calls left in the window.
+    """
+        with self._lock, self._connection:
+            self._connection.execute(
+                'DELETE FROM quota_calls WHERE rowid = ('
+                'SELECT MAX(rowid) FROM quota_calls WHERE method = ?)',
+                (method, ))
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM quota_calls').fetchone()[0]
+
+    def count_calls(self, since):
+        """Count the Flickr calls made after some time, by method.
+
+    Args:
+      since: A time in seconds since the epoch.
+
+    Returns:
+      A Counter mapping Flickr methods to calls.
+    """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT method, COUNT(*) FROM quota_calls '
+                'WHERE called_at > ? GROUP BY method', (since, )).fetchall()
+        return collections.Counter(dict(rows))
+
+    def footprint(self):
+        """Get the size of the database, in bytes."""
+        with self._lock:
+            page_count = self._connection.execute(
+                'PRAGMA page_count').fetchone()[0]
+            page_size = self._connection.execute(
+                'PRAGMA page_size').fetchone()[0]
+        return page_count * page_size
+
+    def __len__(self):
+        with self._lock:
+            size = self._sizes.get(self.pool)
+            if size is None or (time.monotonic() - size[1] >
+                                SIZE_ESTIMATE_TTL):
+                size = (self._connection.execute(
+                    'SELECT COUNT(*) FROM cabbages WHERE pool = ?',
+                    (self.pool, )).fetchone()[0], time.monotonic())
+                self._sizes[self.pool] = size
+            return size[0]
+
+    def close(self):
+        """Close the underlying database."""
+        with self._lock:
+            self._connection.close()
+
+
+def _cabbage_to_row(cabbage, fetched_at=None):
+    """Convert a CabbagePhoto into a row of CABBAGE_COLUMNS.
+
+  Args:
+    cabbage: The CabbagePhoto to convert.
+    fetched_at: When the photo was fetched, defaulting to when it was vetted.
+  """
+    diagnostic = cabbage.diagnostic
+    if diagnostic is None:
+        diagnostic_row = (None, None, None, None)
+    else:
+        diagnostic_row = (diagnostic.owner, ' '.join(diagnostic.tags),
+                          diagnostic.verdict, diagnostic.latency)
+        if fetched_at is None:
+            fetched_at = diagnostic.fetched_at
+
+    if fetched_at is None:
+        fetched_at = time.time()
+
+    return (cabbage.photo_id, cabbage.secret, cabbage.server, cabbage.farm,
+            cabbage.title) + diagnostic_row + (fetched_at, )
+
+
+def _row_to_cabbage(row):
+    """Convert a row of CABBAGE_COLUMNS into a CabbagePhoto."""
+    owner, tags, verdict, latency, fetched_at = row[5:]
+    diagnostic = None
+    if verdict is not None:
+        diagnostic = cache.CabbageDiagnostic(owner, tags.split(), verdict,
+                                             fetched_at, latency)
+    return cache.CabbagePhoto(*row[:5], diagnostic=diagnostic)
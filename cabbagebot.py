@@ -1,17 +1,74 @@
 """Cabbagebot is a Discord bot that spreads the joy of cabbage."""
 
+import argparse
+import asyncio
+import http.client
+import io
 import os
+import time
+from aiohttp import web
 import discord
 from discord.ext import commands
 
+from cabbage import error
+from cabbage import odds
 from cabbage import polyhedral
 from cabbage import joy
+from cabbage import metrics
+from cabbage import pools
+from cabbage import profiling
+from cabbage import quota
+from cabbage import ratelimit
+from cabbage import store
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+UNKNOWN_VARIETY_FORMAT = (
+    'I KNOW OF NO SUCH CABBAGE AS "{variety}". TRY: {pools}.')
+RATE_LIMITED_FORMAT = '{mentions} PACE YOURSELVES, CABBAGE FIENDS. {joy}'
+PROFILE_SAVED_FORMAT = '{summary}\nSAVED TO {path}'
+
+# Prometheus scrapes metrics from here. Only reachable from this machine.
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9120
 
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='!',
-                   description='cabbage cabbage cabbages',
-                   intents=intents)
+bot = commands.AutoShardedBot(command_prefix='!',
+                              description='cabbage cabbage cabbages',
+                              intents=intents)
+
+
+async def serve_metrics(request):
+    """Serve every metric in the Prometheus text format."""
+    return web.Response(body=metrics.render().encode('utf-8'),
+                        headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+@bot.event
+async def setup_hook():
+    """Start the local metrics endpoint before connecting to Discord."""
+    app = web.Application()
+    app.router.add_get('/metrics', serve_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, bot.metrics_port).start()
+
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    """Note when a command started, for the latency histograms."""
+    ctx.command_started_at = time.perf_counter()
+
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    """Record how long a command took, whether or not it succeeded."""
+    metrics.COMMAND_LATENCY.observe(time.perf_counter() -
+                                    ctx.command_started_at,
+                                    command=ctx.command.qualified_name)
+    if profiling.profiler.active:
+        profiling.profiler.note_command()
 
 
 @bot.event
@@ -22,16 +79,98 @@ async def on_ready():
     print('CABBAGE CLIENT NAME: {name}'.format(name=bot.user.name))
 
 
+async def over_rate_limit(ctx):
+    """Check a command against the rate limits.
+
+  Commands over a limit get text cabbage instead of a photo, so they never
+  drain the cache. Those in the same channel are answered together, in one
+  message, once the burst is over.
+
+  Args:
+    ctx: The command context.
+
+  Returns:
+    Whether the command was over a limit, and has been answered.
+  """
+    guild = ctx.guild.id if ctx.guild is not None else None
+    scope = ctx.bot.rate_limiter.check(ctx.author.id, ctx.channel.id, guild)
+    if scope is None:
+        return False
+
+    command = ctx.command.qualified_name
+    metrics.RATE_LIMITED.inc(command=command, scope=scope)
+
+    async def respond(mentions):
+        # Everyone in the burst gets mentioned, once.
+        mentions = ' '.join(dict.fromkeys(mentions))
+        await ctx.send(
+            RATE_LIMITED_FORMAT.format(mentions=mentions,
+                                       joy=joy.create_cabbage_text()))
+
+    await ctx.bot.coalescer.submit(ctx.channel.id,
+                                   ctx.author.mention,
+                                   respond,
+                                   command=command)
+    return True
+
+
+async def spread_joy(cabbage_pools, variety=''):
+    """Spread the joy of cabbage, keeping shared pools off the event loop.
+
+  Drawing from a shared pool means a SQLite transaction, which may wait on
+  other processes, and so does the rebalance that getting a pool sometimes
+  sets off. Both run in a worker thread.
+
+  Args:
+    cabbage_pools: The CabbagePools to draw from.
+    variety: The variety asked for, or nothing for the default pool.
+
+  Returns:
+    The joy of cabbage, or None if there is no pool for the variety.
+  """
+
+    def draw():
+        cabbage_cache = cabbage_pools.get(variety)
+        if cabbage_cache is None:
+            return None
+        return joy.spread_joy(cabbage_cache)
+
+    if not cabbage_pools.default.shared:
+        return draw()
+    return await asyncio.to_thread(profiling.profiler.wrap(draw))
+
+
 @bot.command(description='Spread the joy of cabbage!')
-async def cabbage(ctx):
-    """Spread the joy of cabbage."""
-    await ctx.send(joy.spread_joy())
+async def cabbage(ctx, *variety: str):
+    """Spread the joy of cabbage.
+
+  For example, "!cabbage savoy" spreads the joy of savoy cabbage in
+  particular.
+
+  Args:
+    variety: The variety of cabbage, if any variety won't do.
+  """
+    if await over_rate_limit(ctx):
+        return
+
+    variety = ' '.join(variety)
+    response = await spread_joy(ctx.bot.cabbage_pools, variety)
+    if response is None:
+        await ctx.send(
+            UNKNOWN_VARIETY_FORMAT.format(variety=variety,
+                                          pools=', '.join(pools.POOL_TAGS)))
+        return
+
+    await ctx.send(response)
 
 
 @bot.command(description='キャベツ')
 async def キャベツ(ctx):
     """Spread the joy of キャベツ."""
-    await ctx.send(joy.spread_joy() + ' desu')
+    if await over_rate_limit(ctx):
+        return
+
+    await ctx.send(await spread_joy(ctx.bot.cabbage_pools, 'キャベツ') + ' desu')
 
 
 @bot.command(description='SPREAD THE JOY OF CABBAGE!')
@@ -42,19 +181,66 @@ async def CABBAGE(ctx):
 
 
 @bot.command(description='Run level 3 cabbage diagnostic.')
-async def diag(ctx):
-    """Run a level 3 cabbage diagnostic."""
-    info = getattr(joy.get_cabbage, 'diagnostic_info', 'Not available.')[:1400]
-    cache_size = len(getattr(joy.get_cabbage, 'cabbage_cache', []))
+async def diag(ctx, level: str = ''):
+    """Run a level 3 cabbage diagnostic.
+
+  Args:
+    level: Use "full" to include the raw Flickr response for the previous
+      cabbage. This has to be fetched from Flickr again, so it is slow.
+  """
+    cabbage_pools = ctx.bot.cabbage_pools
+    cabbage_cache = cabbage_pools.default
+    last_cabbage = cabbage_pools.last_cabbage
+    if last_cabbage is None or last_cabbage.diagnostic is None:
+        info = 'Not available.'
+    else:
+        info = last_cabbage.diagnostic.describe(last_cabbage.photo_id)
+
+    if level == 'full' and last_cabbage is not None:
+        try:
+            info += '\n' + await asyncio.to_thread(
+                profiling.profiler.wrap(cabbage_cache.fetch_photo_info),
+                last_cabbage.photo_id)
+        except (error.RecoverableCabbageException, http.client.HTTPException,
+                OSError) as e:
+            info += '\n' + str(e)
+
+    # Measuring a shared store means asking SQLite, so keep it off the loop.
+    def measure():
+        return (len(cabbage_pools), cabbage_pools.footprint(),
+                cabbage_pools.quota.describe(),
+                '\n'.join(cabbage_pools.describe()))
+
+    size, footprint, quota_summary, pool_summary = await asyncio.to_thread(
+        profiling.profiler.wrap(measure))
+
+    if cabbage_cache.time_to_first_cabbage is None:
+        first_cabbage = 'not yet'
+    else:
+        first_cabbage = '%.2fs' % cabbage_cache.time_to_first_cabbage
+    metrics_summary = '\n'.join(metrics.summarize())
+
+    # The previous cabbage comes first, since it is what people ask about,
+    # and everything is split over as many messages as it takes.
     diagnostic_message = ('BEEP BOOP. BORING LEVEL 3 DIAGNOSTIC RESULTS:\n\n'
+                          'Cabbage cache status: %s\n'
+                          'Time to first cabbage: %s\n'
                           'Current cabbage cache size: %d\n'
-                          'Previous cabbage response: %s') % (cache_size, info)
+                          'Cabbage cache memory footprint: %.1f KiB\n'
+                          'Previous cabbage response: %s\n'
+                          '%s\n'
+                          '%s\n'
+                          '%s') % (cabbage_cache.status, first_cabbage, size,
+                                   footprint / 1024, info, quota_summary,
+                                   pool_summary, metrics_summary)
 
-    await ctx.send(diagnostic_message)
+    for message in polyhedral.pack_messages([diagnostic_message],
+                                            DISCORD_MESSAGE_LIMIT):
+        await ctx.send(message)
 
 
 @bot.command(description='Roll polyhedral cabbages.')
-async def roll(ctx, formula: str):
+async def roll(ctx, *, formula: str):
     """Roll polyhedral cabbages based on a formula.
 
   For example, consider that you are wielding a cabbagebrand longsword in two 
@@ -68,21 +254,183 @@ async def roll(ctx, formula: str):
 
   This would look like "!roll 8c6"
 
+  Several formulas can be rolled at once, separated by semicolons, like
+  "!roll c20+5; 2c8+3", and a formula can be repeated, like "!roll 6x 4c6".
+
   Args:
-    formula: The formula for the roll.
+    formula: The formula for the roll, or several of them.
   """
-    response = polyhedral.roll_polyhedral_cabbage(formula)
+    # Big rolls take a while, so keep them off the event loop.
+    messages = await asyncio.to_thread(
+        profiling.profiler.wrap(polyhedral.roll_polyhedral_batch), formula)
+    for message in messages:
+        await ctx.send(message)
+
+
+@bot.command(name='odds', description='Calculate the odds of a cabbage roll.')
+async def roll_odds(ctx, *, query: str):
+    """Calculate the odds of a polyhedral cabbage roll.
+
+  For example, to find out how likely you are to hit an armor class 40
+  cabbage golem with "!roll 3c20+c6+4", use "!odds 3c20+c6+4 >= 40".
+
+  Without a comparison, this summarizes every possible total instead.
+
+  Args:
+    query: The formula for the roll, optionally followed by a comparison.
+  """
+    # Big formulas take a while, so keep them off the event loop.
+    response = await asyncio.to_thread(
+        profiling.profiler.wrap(odds.describe_odds), query)
     await ctx.send(response)
 
 
+@bot.group(invoke_without_command=True,
+           description='Look inside the running cabbagebot.')
+@commands.is_owner()
+async def profile(ctx):
+    """Look inside the running cabbagebot. Only its owner may.
+
+  "!profile cpu 30s" profiles everything for thirty seconds, and
+  "!profile cpu 20" for the next twenty commands. "!profile memory" takes a
+  snapshot of memory allocations and shows what grew since the last one,
+  and "!profile memory stop" stops tracing them. "!profile lag 10" measures
+  how late the event loop runs for ten seconds.
+
+  Reports are attached, and saved in the profiles directory.
+  """
+    await ctx.send_help(ctx.command)
+
+
+async def send_report(ctx, kind, report):
+    """Save a profiling report locally, and attach it to a reply.
+
+  Args:
+    ctx: The command context.
+    kind: profiling.CPU_REPORT, MEMORY_REPORT or LAG_REPORT.
+    report: The report.
+  """
+    path = await asyncio.to_thread(profiling.save_report,
+                                   ctx.bot.profile_directory, kind, report)
+    summary = report.strip().splitlines()[0]
+    await ctx.send(PROFILE_SAVED_FORMAT.format(summary=summary, path=path),
+                   file=discord.File(io.BytesIO(report.encode('utf-8')),
+                                     filename=os.path.basename(path)))
+
+
+@profile.command(name='cpu')
+async def profile_cpu(ctx, duration: str = '30s'):
+    """Profile for some seconds, like "30s", or some commands, like "20".
+
+  Args:
+    duration: How long to profile for.
+  """
+    try:
+        seconds, commands_to_profile = profiling.parse_duration(duration)
+        profiling.profiler.start(commands_to_profile)
+    except profiling.ProfileException as e:
+        await ctx.send(str(e))
+        return
+
+    await ctx.send('PROFILING. ACT NATURAL.')
+    try:
+        await profiling.profiler.wait(seconds)
+    finally:
+        report = profiling.profiler.stop()
+    await send_report(ctx, profiling.CPU_REPORT, report)
+
+
+@profile.command(name='memory')
+async def profile_memory(ctx, action: str = ''):
+    """Snapshot memory allocations, or "stop" tracing them.
+
+  Args:
+    action: "stop" to stop tracing, or nothing for a snapshot.
+  """
+    if action == 'stop':
+        profiling.memory_tracker.stop()
+        await ctx.send('NO LONGER TRACING MEMORY.')
+        return
+
+    report = await asyncio.to_thread(profiling.memory_tracker.snapshot)
+    await send_report(ctx, profiling.MEMORY_REPORT, report)
+
+
+@profile.command(name='lag')
+async def profile_lag(ctx, seconds: float = 10.0):
+    """Measure how late the event loop runs, for some seconds.
+
+  Args:
+    seconds: How long to measure for.
+  """
+    seconds = min(max(seconds, profiling.LOOP_LAG_INTERVAL),
+                  profiling.MAX_PROFILE_SECONDS)
+    report = await profiling.sample_loop_lag(seconds)
+    await send_report(ctx, profiling.LAG_REPORT, report)
+
+
+def parse_args():
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--shared',
+        action='store_true',
+        help='draw from a cabbage pool shared with other cabbagebot processes '
+        'using the same directory, instead of a private one')
+    parser.add_argument('--shard-count',
+                        type=int,
+                        help='total number of shards across all processes')
+    parser.add_argument('--shard-ids',
+                        type=lambda ids: [int(i) for i in ids.split(',')],
+                        help='comma separated shards for this process to run')
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        default=METRICS_PORT,
+                        help='local port to serve Prometheus metrics on')
+    for scope in ratelimit.SCOPES:
+        parser.add_argument(
+            '--{scope}-limit'.format(scope=scope),
+            type=ratelimit.parse_limit,
+            default=ratelimit.Limit(*ratelimit.DEFAULT_LIMITS[scope]),
+            help='cabbage photos allowed per {scope}, as COMMANDS/SECONDS '
+            '(default: %(default)s)'.format(scope=scope))
+    return parser.parse_args()
+
+
 def main():
     """Command line cabbages pass through here."""
+    args = parse_args()
+    bot.shard_count = args.shard_count
+    bot.shard_ids = args.shard_ids
+    bot.metrics_port = args.metrics_port
+    bot.rate_limiter = ratelimit.RateLimiter({
+        scope: getattr(args, '{scope}_limit'.format(scope=scope))
+        for scope in ratelimit.SCOPES
+    })
+    bot.coalescer = ratelimit.Coalescer()
+    bot.profile_directory = os.path.join(os.path.dirname(__file__), 'profiles')
+
     flickr_key_path = os.path.join(os.path.dirname(__file__), 'flickr_api_key')
     flickr_key = open(flickr_key_path).read().strip()
-    joy.bootstrap(flickr_key)
+    cabbage_store_path = os.path.join(os.path.dirname(__file__),
+                                      'cabbage_store.sqlite3')
+    cabbage_store = store.CabbageStore(cabbage_store_path)
+    if args.shared:
+        # Every process sharing the store uses the same API key, so they
+        # count their Flickr calls against one quota.
+        joy.flickr_client.quota = quota.QuotaAccountant(
+            cabbage_store=cabbage_store)
+    bot.cabbage_pools = pools.create_pools(flickr_key,
+                                           cabbage_store=cabbage_store,
+                                           shared=args.shared)
 
-    # Prepopulate the cabbage cache.
-    joy.load_cabbages()
+    # Serve whatever survived the last restart, and warm up the default pool
+    # in the background rather than keeping everyone waiting on Flickr. Until
+    # the first cabbages are vetted, text cabbage will have to do. The other
+    # pools only start refilling once someone asks for them.
+    for cabbage_cache in bot.cabbage_pools:
+        cabbage_cache.load_stored_cabbages()
+    bot.cabbage_pools.default.maybe_refill()
 
     discord_token_path = os.path.join(os.path.dirname(__file__),
                                       'discord_token')
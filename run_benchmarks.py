@@ -0,0 +1,55 @@
+"""Helper script to run all cabbagebot benchmarks and save the results.
+
+Results are written as JSON, so runs from different releases can be diffed
+to catch performance regressions.
+
+Usage: python run_benchmarks.py [pattern] [output path]
+"""
+
+import datetime
+import fnmatch
+import importlib
+import json
+import os
+import platform
+import sys
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark')
+DEFAULT_OUTPUT_PATH = 'benchmark_results.json'
+
+
+def discover(pattern):
+    """Find the names of the benchmark modules matching a pattern."""
+    return sorted(
+        os.path.splitext(name)[0] for name in os.listdir(BENCHMARK_DIR)
+        if fnmatch.fnmatch(name, pattern))
+
+
+def main():
+    """Run all benchmarks."""
+    pattern = '*_benchmark.py'
+    output_path = DEFAULT_OUTPUT_PATH
+    if len(sys.argv) > 1:
+        pattern = sys.argv[1]
+    if len(sys.argv) > 2:
+        output_path = sys.argv[2]
+
+    results = {
+        'started_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': {},
+    }
+    for name in discover(pattern):
+        print('RUNNING {name}...'.format(name=name))
+        module = importlib.import_module('benchmark.' + name)
+        results['benchmarks'][name] = module.run()
+
+    with open(output_path, 'w') as output_file:
+        json.dump(results, output_file, indent=2, ensure_ascii=False)
+    print('WROTE {path}'.format(path=output_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Unit tests for the non-cabbage blocklist."""
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from cabbage import blocklist
+
+BLOCKLIST_TEXT = """
+# Not cabbage.
+[words]
+butterfly
+band
+
+[owners]
+92795448@N08
+"""
+
+
+class BlocklistTest(unittest.TestCase):
+    """Blocklist tests."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'blocklist.txt')
+        with open(self.path, 'w') as blocklist_file:
+            blocklist_file.write(BLOCKLIST_TEXT)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_parse(self):
+        """Ensure that sections are kept separate."""
+        sections = blocklist.parse_blocklist(BLOCKLIST_TEXT)
+        self.assertEqual(sections['words'], ['butterfly', 'band'])
+        self.assertEqual(sections['owners'], ['92795448@N08'])
+
+        with self.assertRaises(ValueError):
+            blocklist.parse_blocklist('butterfly')
+
+    def test_blocks(self):
+        """Ensure that words match anywhere, but owners only match owners."""
+        rules = blocklist.Blocklist(self.path)
+        self.assertTrue(rules.blocks_text('cabbage white butterfly'))
+        self.assertTrue(rules.blocks_text('<tag author="92795448@N08">'))
+        self.assertFalse(rules.blocks_text('savoy cabbage'))
+
+        self.assertTrue(rules.blocks_owner('92795448@N08'))
+        self.assertFalse(rules.blocks_owner('band'))
+
+    def test_reload_if_changed(self):
+        """Ensure that blocklist changes are picked up without a restart."""
+        rules = blocklist.Blocklist(self.path)
+        self.assertFalse(rules.reload_if_changed())
+        self.assertFalse(rules.blocks_text('kale'))
+
+        with open(self.path, 'a') as blocklist_file:
+            blocklist_file.write('[words]\nkale\n')
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 1))
+
+        self.assertTrue(rules.reload_if_changed())
+        self.assertTrue(rules.blocks_text('kale'))
+        self.assertTrue(rules.blocks_text('butterfly'))
+
+    def test_broken_reload(self):
+        """Ensure that a broken edit keeps the rules which already worked."""
+        rules = blocklist.Blocklist(self.path)
+        with open(self.path, 'w') as blocklist_file:
+            blocklist_file.write('kale\n[words]\nbutterfly\n')
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 1))
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertFalse(rules.reload_if_changed())
+            self.assertFalse(rules.reload_if_changed())
+        self.assertEqual(output.getvalue().count('BLOCKLIST IS BROKEN'), 1)
+        self.assertTrue(rules.blocks_owner('92795448@N08'))
+        self.assertFalse(rules.blocks_text('kale'))
+
+    def test_default_blocklist(self):
+        """Ensure that the shipped blocklist parses and blocks butterflies."""
+        rules = blocklist.Blocklist()
+        self.assertTrue(rules.blocks_text('pieris rapae'))
+        self.assertTrue(rules.blocks_owner('32203271@N08'))
+        self.assertFalse(rules.blocks_text('brassica oleracea'))
@@ -0,0 +1,51 @@
+"""Unit tests for the cabbage cache."""
+
+import unittest
+
+from cabbage import cache
+
+
+class CabbageColumnsTest(unittest.TestCase):
+    """Cabbage column storage tests."""
+
+    def test_photo(self):
+        """Ensure that cabbage links are built properly."""
+        cabbage = cache.CabbagePhoto('123', 'abcdef', '65535', '66', 'savoy')
+        self.assertEqual(
+            str(cabbage),
+            'https://farm66.staticflickr.com/65535/123_abcdef.jpg '
+            '(title: savoy)')
+
+    def test_draw(self):
+        """Ensure that every cabbage is drawn exactly once."""
+        cabbage_cache = cache.CabbageColumns()
+        cabbage_cache.extend(
+            cache.CabbagePhoto(i, 'abcdef', 65535, 66, 'cabbage')
+            for i in range(100))
+        cabbage_cache.add(cache.CabbagePhoto(100, 'abcdef', 65535, 66, 'kale'))
+        self.assertEqual(len(cabbage_cache), 101)
+
+        photo_ids = []
+        while cabbage_cache:
+            photo_ids.append(cabbage_cache.draw().photo_id)
+
+        self.assertEqual(sorted(photo_ids), list(range(101)))
+        self.assertIsNone(cabbage_cache.draw())
+
+    def test_footprint(self):
+        """Ensure that the footprint follows cabbages in and out."""
+        cabbage_cache = cache.CabbageColumns()
+        empty = cabbage_cache.footprint()
+        diagnostic = cache.CabbageDiagnostic('owner', ['cabbage'], 'kept')
+        cabbage_cache.extend(
+            cache.CabbagePhoto(photo_id=i,
+                               secret='secret%d' % i,
+                               server=65535,
+                               farm=66,
+                               title='cabbage %d' % i,
+                               diagnostic=diagnostic) for i in range(100))
+        self.assertGreater(cabbage_cache.footprint(), empty + 100 * 100)
+
+        while cabbage_cache.draw() is not None:
+            pass
+        self.assertEqual(cabbage_cache._bytes, 0)
@@ -0,0 +1,196 @@
+"""Unit tests for the Flickr API client."""
+
+import contextlib
+import io
+import unittest
+
+from cabbage import client
+from cabbage import error
+from cabbage import quota
+from test import fake_clock
+from test import fake_flickr
+
+SEARCH_PATH = ('/services/rest/?method=flickr.photos.search&tags=cabbage&'
+               'page=1&per_page=10&api_key=key')
+
+
+def read_body(chunks):
+    """Parse a response by reading all of it."""
+    return b''.join(chunks)
+
+
+class FlickrClientTest(unittest.TestCase):
+    """Flickr client tests."""
+
+    def setUp(self):
+        # Circuit breaker reports would bury the test results.
+        self.enterContext(contextlib.redirect_stdout(io.StringIO()))
+        self.sleeps = []
+        self.flickr_client = client.FlickrClient(backoff_base=0.5,
+                                                 backoff_max=2,
+                                                 max_attempts=10,
+                                                 sleep=self.sleeps.append)
+
+    def test_gzip_keep_alive(self):
+        """Ensure that responses are gzipped and connections are reused."""
+        with fake_flickr.FakeFlickr(total=10) as server:
+            bodies = [
+                self.flickr_client.request(server.url + SEARCH_PATH, read_body)
+                for _ in range(3)
+            ]
+            connection = self.flickr_client._connections.connection
+
+        self.assertEqual(len(set(bodies)), 1)
+        self.assertIn(b'<photos page="1"', bodies[0])
+        self.assertEqual(server.gzipped, 3)
+        self.assertIsNotNone(connection.sock)
+
+    def test_retries(self):
+        """Ensure that overloaded responses are retried with backoff."""
+        with fake_flickr.FakeFlickr(total=10, error_rate=0.5) as server:
+            for _ in range(10):
+                self.flickr_client.request(server.url + SEARCH_PATH, read_body)
+
+        self.assertEqual(server.requests['flickr.photos.search'],
+                         10 + len(self.sleeps))
+        self.assertTrue(self.sleeps)
+        self.assertTrue(all(0 <= sleep <= 2 for sleep in self.sleeps))
+        self.assertEqual(self.flickr_client.breaker.state,
+                         client.BREAKER_CLOSED)
+
+    def test_truncated_responses(self):
+        """Ensure that gzipped responses cut short are retried."""
+        with fake_flickr.FakeFlickr(total=10, truncate_rate=0.5) as server:
+            bodies = [
+                self.flickr_client.request(server.url + SEARCH_PATH, read_body)
+                for _ in range(10)
+            ]
+
+        self.assertEqual(len(set(bodies)), 1)
+        self.assertEqual(server.requests['flickr.photos.search'],
+                         10 + len(self.sleeps))
+        self.assertTrue(self.sleeps)
+        self.assertEqual(self.flickr_client.breaker.state,
+                         client.BREAKER_CLOSED)
+
+    def test_no_retry_for_bad_requests(self):
+        """Ensure that requests Flickr will never answer aren't retried."""
+        with fake_flickr.FakeFlickr() as server:
+            with self.assertRaises(error.RecoverableCabbageException):
+                self.flickr_client.request(
+                    server.url + '/services/rest/?method=flickr.nope',
+                    read_body)
+
+        self.assertEqual(server.requests['flickr.nope'], 1)
+        self.assertFalse(self.sleeps)
+
+    def test_outage(self):
+        """Ensure that requests stop being sent while Flickr is down."""
+        flickr_client = client.FlickrClient(
+            max_attempts=2,
+            breaker=client.CircuitBreaker(failure_threshold=2),
+            sleep=self.sleeps.append)
+        with fake_flickr.FakeFlickr(error_rate=1.0) as server:
+            for _ in range(2):
+                with self.assertRaises(error.RecoverableCabbageException):
+                    flickr_client.request(server.url + SEARCH_PATH, read_body)
+            with self.assertRaises(client.FlickrUnavailableException):
+                flickr_client.request(server.url + SEARCH_PATH, read_body)
+
+        self.assertEqual(server.requests['flickr.photos.search'], 4)
+        self.assertEqual(flickr_client.breaker.state, client.BREAKER_OPEN)
+        # The request which was refused didn't count against the quota.
+        self.assertEqual(flickr_client.quota.used(), 4)
+
+    def test_quota(self):
+        """Ensure that requests stop before the quota runs out."""
+        flickr_client = client.FlickrClient(
+            quota_accountant=quota.QuotaAccountant(limit=4, reserve=0.5))
+        with fake_flickr.FakeFlickr(total=10) as server:
+            for _ in range(2):
+                flickr_client.request(server.url + SEARCH_PATH, read_body)
+            with self.assertRaises(client.QuotaExhaustedException):
+                flickr_client.request(server.url + SEARCH_PATH, read_body)
+
+        self.assertEqual(server.requests['flickr.photos.search'], 2)
+        self.assertEqual(flickr_client.breaker.state, client.BREAKER_CLOSED)
+
+    def test_quota_during_retries(self):
+        """Ensure that running out of quota isn't blamed on Flickr."""
+        flickr_client = client.FlickrClient(
+            breaker=client.CircuitBreaker(failure_threshold=1),
+            quota_accountant=quota.QuotaAccountant(limit=1, reserve=0),
+            sleep=self.sleeps.append)
+        with fake_flickr.FakeFlickr(error_rate=1.0) as server:
+            with self.assertRaises(client.QuotaExhaustedException):
+                flickr_client.request(server.url + SEARCH_PATH, read_body)
+
+        self.assertEqual(server.requests['flickr.photos.search'], 1)
+        self.assertEqual(flickr_client.breaker.state, client.BREAKER_CLOSED)
+
+    def test_parse_error(self):
+        """Ensure that a parser choking never wedges the circuit breaker."""
+        clock = fake_clock.FakeClock()
+        flickr_client = client.FlickrClient(breaker=client.CircuitBreaker(
+            failure_threshold=1, cooldown=60, clock=clock))
+        flickr_client.breaker.record_failure()
+        clock.now = 60
+
+        def choke(chunks):
+            read_body(chunks)
+            raise KeyError('id')
+
+        with fake_flickr.FakeFlickr(total=10) as server:
+            with self.assertRaises(KeyError):
+                flickr_client.request(server.url + SEARCH_PATH, choke)
+            self.assertEqual(flickr_client.breaker.state,
+                             client.BREAKER_HALF_OPEN)
+            flickr_client.request(server.url + SEARCH_PATH, read_body)
+
+        self.assertEqual(flickr_client.breaker.state, client.BREAKER_CLOSED)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    """Circuit breaker tests."""
+
+    def setUp(self):
+        # Circuit breaker reports would bury the test results.
+        self.enterContext(contextlib.redirect_stdout(io.StringIO()))
+
+    def test_circuit_breaker(self):
+        """Ensure that the breaker opens, cools down and tries again."""
+        clock = fake_clock.FakeClock()
+        breaker = client.CircuitBreaker(failure_threshold=3,
+                                        cooldown=60,
+                                        clock=clock)
+        for _ in range(2):
+            breaker.record_failure()
+        breaker.record_success()
+        for _ in range(2):
+            breaker.record_failure()
+        self.assertTrue(breaker.allow())
+
+        breaker.record_failure()
+        self.assertEqual(breaker.state, client.BREAKER_OPEN)
+        self.assertFalse(breaker.allow())
+
+        # One trial request at a time, once the cooldown is over.
+        clock.now = 60
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, client.BREAKER_OPEN)
+
+        # A trial given up on before Flickr answered lets another through.
+        clock.now = 120
+        self.assertTrue(breaker.allow())
+        breaker.release()
+        self.assertEqual(breaker.state, client.BREAKER_HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, client.BREAKER_CLOSED)
+        self.assertTrue(breaker.allow())
+
+
+if __name__ == '__main__':
+    unittest.main()
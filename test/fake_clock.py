@@ -0,0 +1,17 @@
+"""A fake clock for testing anything that measures time.
+
+Usage:
+  clock = fake_clock.FakeClock()
+  breaker = client.CircuitBreaker(clock=clock)
+  clock.now = 60
+"""
+
+
+class FakeClock(object):
+    """A clock which only moves when told to."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
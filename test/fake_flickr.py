@@ -0,0 +1,234 @@
+"""A local fake Flickr API server serving recorded responses.
+
+Search results are built from the photos in testdata/search_cabbage_extras.xml,
+repeated as often as needed to fill the requested page size. Each repeated
+photo gets a new id, and its getInfo response is the recorded one for the
+photo it copies. Like Flickr, only the first MAX_SEARCH_RESULTS photos are
+ever served, and pages past them repeat the last page.
+
+Usage:
+  with fake_flickr.FakeFlickr(latency=0.05) as server:
+    cabbage_cache = joy.CabbageCache('key', flickr_api_url=server.url)
+"""
+
+import collections
+import gzip
+import http.server
+import os
+import random
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), 'testdata')
+
+SEARCH_RESPONSE_FORMAT = """<?xml version="1.0" encoding="utf-8" ?>
+<rsp stat="ok">
+<photos page="{page}" pages="{pages}" perpage="{per_page}" total="{total}">
+{photos}
+</photos>
+</rsp>
+"""
+NOT_FOUND_RESPONSE = """<?xml version="1.0" encoding="utf-8" ?>
+<rsp stat="fail">
+\t<err code="1" msg="Photo not found" />
+</rsp>
+"""
+
+# Flickr serves at most this many results for a search, however many it says
+# there are.
+MAX_SEARCH_RESULTS = 4000
+
+# Fake photo ids are this multiple of a copy number, plus the index of the
+# recorded photo being copied.
+PHOTO_ID_STRIDE = 100
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    """A threaded HTTP server which doesn't mind clients hanging up."""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop their connection after any failed request.
+        pass
+
+
+def _load_recorded_photos():
+    """Load the recorded search results and their getInfo responses.
+
+  Returns:
+    A list of (photo element, getInfo response) tuples.
+  """
+    tree = xml.etree.ElementTree.parse(
+        os.path.join(TESTDATA_DIR, 'search_cabbage_extras.xml'))
+    recorded = []
+    for photo in tree.getroot().iter('photo'):
+        info_path = os.path.join(TESTDATA_DIR,
+                                 'getinfo_%s.xml' % photo.get('id'))
+        with open(info_path, encoding='utf-8') as info_file:
+            recorded.append((photo, info_file.read()))
+
+    return recorded
+
+
+class FakeFlickr(object):
+    """A fake Flickr API, running on a local port in a background thread."""
+
+    def __init__(self,
+                 latency=0.0,
+                 error_rate=0.0,
+                 truncate_rate=0.0,
+                 total=1500,
+                 include_extras=True,
+                 seed=0):
+        """Configure the fake Flickr API.
+
+    Args:
+      latency: Seconds to wait before each response.
+      error_rate: The fraction of requests answered with a 503.
+      truncate_rate: The fraction of gzipped responses cut short.
+      total: How many photos the search has in all, across every page.
+      include_extras: Whether search results have tags and descriptions.
+      seed: Seeds which requests fail.
+    """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.total = total
+        self.include_extras = include_extras
+        self.requests = collections.Counter()
+        # Responses sent gzipped, because the client asked for it.
+        self.gzipped = 0
+        # The address of every client connection which made a request.
+        self.connections = set()
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recorded = _load_recorded_photos()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        """The base URL to use in place of the real Flickr API."""
+        host, port = self._server.server_address[:2]
+        return 'http://{host}:{port}'.format(host=host, port=port)
+
+    def start(self):
+        """Start serving on an unused local port."""
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """Answers each request from the recorded responses."""
+
+            protocol_version = 'HTTP/1.1'
+            # Otherwise keep-alive responses stall on delayed ACKs.
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.connections.add(self.client_address)
+                status, body = fake.respond(self.path)
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body)
+                    self.send_header('Content-Encoding', 'gzip')
+                    with fake._lock:
+                        fake.gzipped += 1
+                        if (fake.truncate_rate and
+                                fake._random.random() < fake.truncate_rate):
+                            body = body[:len(body) // 2]
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _Server(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def respond(self, path):
+        """Build the response to a request.
+
+    Args:
+      path: The request path, including the query string.
+
+    Returns:
+      A (status, body) tuple.
+    """
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(path).query))
+        method = query.get('method', '')
+        with self._lock:
+            self.requests[method] += 1
+            failed = self._random.random() < self.error_rate
+
+        time.sleep(self.latency)
+        if failed:
+            return 503, 'Service Unavailable'
+
+        if method == 'flickr.photos.search':
+            return 200, self._search(int(query.get('page', 1)),
+                                     int(query.get('per_page', 100)))
+        if method == 'flickr.photos.getInfo':
+            return 200, self._get_info(query.get('photo_id', ''))
+
+        return 404, 'Not Found'
+
+    def _search(self, page, per_page):
+        """Build a page of search results."""
+        served_page = min(page, max(1, MAX_SEARCH_RESULTS // per_page))
+        first = (served_page - 1) * per_page
+        last = min(self.total, served_page * per_page)
+        photos = []
+        for number in range(first, last):
+            copy, index = divmod(number, len(self._recorded))
+            photo = xml.etree.ElementTree.Element(
+                'photo', self._recorded[index][0].attrib)
+            photo.set('id', str((copy + 1) * PHOTO_ID_STRIDE + index))
+            if self.include_extras:
+                photo.extend(self._recorded[index][0])
+            else:
+                photo.attrib.pop('tags', None)
+            photos.append(
+                '\t' +
+                xml.etree.ElementTree.tostring(photo, encoding='unicode'))
+
+        pages = max(1, -(-self.total // per_page))
+        return SEARCH_RESPONSE_FORMAT.format(page=page,
+                                             pages=pages,
+                                             per_page=per_page,
+                                             total=self.total,
+                                             photos='\n'.join(photos))
+
+    def _get_info(self, photo_id):
+        """Build the getInfo response for a photo."""
+        if not photo_id.isdigit():
+            return NOT_FOUND_RESPONSE
+
+        index = int(photo_id) % PHOTO_ID_STRIDE
+        if index >= len(self._recorded):
+            return NOT_FOUND_RESPONSE
+
+        photo, info = self._recorded[index]
+        return info.replace('id="%s"' % photo.get('id'), 'id="%s"' % photo_id,
+                            1)
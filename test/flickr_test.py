@@ -0,0 +1,121 @@
+"""Unit tests for Flickr response parsing."""
+
+import os
+import re
+import unittest
+
+from cabbage import error
+from cabbage import flickr
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), 'testdata')
+
+# How joy used to find photos in search results, before proper parsing.
+LEGACY_PHOTO_REGEX = re.compile(
+    r'\s*<photo id="(\d+)" .* secret="(\w+)" server="(\w+)" farm="(\w+)" '
+    r'title="(\w+)" .*')
+
+
+def read_testdata(name):
+    """Read a recorded Flickr response."""
+    with open(os.path.join(TESTDATA_DIR, name), 'rb') as response_file:
+        return response_file.read()
+
+
+def chunked(body, chunk_size):
+    """Split a response body into chunks, like a slow socket would."""
+    return [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+
+class FlickrTest(unittest.TestCase):
+    """Flickr parsing tests."""
+
+    def test_search(self):
+        """Ensure that every photo in a search page is found."""
+        body = read_testdata('search_cabbage.xml')
+        photos = list(flickr.parse_search([body]))
+        self.assertEqual(len(photos), 24)
+
+        titles = [photo['title'] for photo in photos]
+        self.assertIn('Savoy cabbage', titles)
+        self.assertIn('キャベツ', titles)
+        self.assertIn('Cabbage & carrots', titles)
+        self.assertIn('"The Cabbage"', titles)
+        self.assertIn('', titles)
+
+        # The regex this replaced missed most of these.
+        legacy_matches = [
+            line for line in body.decode('utf-8').splitlines()
+            if LEGACY_PHOTO_REGEX.match(line)
+        ]
+        self.assertLess(len(legacy_matches), len(photos))
+
+    def test_search_shapes(self):
+        """Ensure that attribute order, extras and line breaks don't matter."""
+        body = read_testdata('search_extras.xml')
+        photos = list(flickr.parse_search(chunked(body, 7)))
+        self.assertEqual([photo['id'] for photo in photos], [
+            '52809876501', '52809876502', '52809876503', '52809876504',
+            '52809876505'
+        ])
+        self.assertEqual(photos[0]['tags'], 'cabbage soup dinner')
+        self.assertEqual(photos[1]['secret'], 'a1b2c3d4e5')
+        self.assertEqual(photos[1]['title'], 'Kohl / Weißkohl')
+        self.assertEqual(photos[3]['title'], '"Cabbage" <3')
+
+    def test_search_results(self):
+        """Ensure that the number of pages and photos is reported."""
+        results = []
+        body = read_testdata('search_cabbage.xml')
+        photos = list(flickr.parse_search([body], on_results=results.append))
+        self.assertEqual(results, [flickr.SearchResults(3398, 81537)])
+        self.assertEqual(len(photos), 24)
+
+    def test_search_extras(self):
+        """Ensure that extras sent as child elements are found."""
+        body = read_testdata('search_cabbage_extras.xml')
+        photos = list(flickr.parse_search(chunked(body, 5)))
+        self.assertEqual(len(photos), 24)
+        self.assertEqual(photos[2]['description'], 'Pieris rapae on lavender')
+        self.assertEqual(photos[2]['tags'],
+                         'cabbagewhite butterfly pierisrapae insect')
+        self.assertEqual(photos[4]['description'], '')
+
+    def test_streaming(self):
+        """Ensure that tiny chunks parse the same as the whole response."""
+        body = read_testdata('search_cabbage.xml')
+        self.assertEqual(list(flickr.parse_search(chunked(body, 1))),
+                         list(flickr.parse_search([body])))
+
+        body = read_testdata('getinfo_52801234503.xml')
+        self.assertEqual(flickr.parse_info(chunked(body, 3)),
+                         flickr.parse_info([body]))
+
+    def test_info(self):
+        """Ensure that owners, descriptions and tags are found."""
+        info = flickr.parse_info([read_testdata('getinfo_52801234503.xml')])
+        self.assertEqual(info.owner, '98765432@N07')
+        self.assertEqual(info.title, 'Cabbage White')
+        self.assertEqual(info.description, 'Pieris rapae on lavender')
+        self.assertEqual(
+            [tag.text for tag in info.tags],
+            ['cabbagewhite', 'butterfly', 'pierisrapae', 'insect'])
+        self.assertEqual(info.tags[0].author, '98765432@N07')
+
+        info = flickr.parse_info([read_testdata('getinfo_52809876501.xml')])
+        self.assertEqual(info.tags, [])
+        self.assertIn('<a href="https://example.com/soup"', info.description)
+
+    def test_errors(self):
+        """Ensure that Flickr failures and broken responses are reported."""
+        body = read_testdata('error_invalid_api_key.xml')
+        with self.assertRaisesRegex(error.RecoverableCabbageException,
+                                    'Invalid API Key'):
+            list(flickr.parse_search([body]))
+
+        body = read_testdata('search_cabbage.xml')
+        with self.assertRaises(error.RecoverableCabbageException):
+            list(flickr.parse_search([body[:len(body) // 2]]))
+
+        body = read_testdata('getinfo_52801234501.xml')
+        with self.assertRaises(error.RecoverableCabbageException):
+            flickr.parse_info([body[:200]])
@@ -0,0 +1,56 @@
+"""Unit tests for the served history."""
+
+import unittest
+
+from cabbage import history
+
+
+class ServedHistoryTest(unittest.TestCase):
+    """Served history tests."""
+
+    def test_served(self):
+        """Ensure that served photos are remembered, and few others are."""
+        served_history = history.ServedHistory()
+        for photo_id in range(1000):
+            served_history.add(photo_id)
+
+        self.assertTrue(
+            all(photo_id in served_history for photo_id in range(1000)))
+        # Photo ids come back from Flickr as strings.
+        self.assertIn('123', served_history)
+
+        false_positives = sum(photo_id in served_history
+                              for photo_id in range(1000, 11000))
+        self.assertLess(false_positives, 100)
+
+    def test_rotation(self):
+        """Ensure that the oldest generation is forgotten, and only that."""
+        served_history = history.ServedHistory(capacity=100)
+        for photo_id in range(300):
+            served_history.add(photo_id)
+
+        self.assertEqual(served_history.footprint(),
+                         history.ServedHistory(capacity=100).footprint())
+        self.assertTrue(
+            all(photo_id in served_history for photo_id in range(200, 300)))
+        self.assertLess(
+            sum(photo_id in served_history for photo_id in range(100)), 10)
+
+    def test_serialization(self):
+        """Ensure that the history survives being saved and restored."""
+        served_history = history.ServedHistory(capacity=100)
+        for photo_id in range(150):
+            served_history.add(photo_id)
+
+        restored = history.ServedHistory.from_bytes(served_history.to_bytes())
+        self.assertEqual(restored.to_bytes(), served_history.to_bytes())
+        self.assertIn(149, restored)
+
+        with self.assertRaises(ValueError):
+            history.ServedHistory.from_bytes(b'cabbage')
+        with self.assertRaises(ValueError):
+            history.ServedHistory.from_bytes(served_history.to_bytes()[:-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,505 @@
+"""Unit tests for the joy of cabbage."""
+
+from unittest import mock
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import unittest
+
+from cabbage import cache
+from cabbage import client
+from cabbage import error
+from cabbage import history
+from cabbage import joy
+from cabbage import metrics
+from cabbage import store
+from test import fake_flickr
+
+SEARCH_RESPONSE_FORMAT = """<?xml version="1.0" encoding="utf-8" ?>
+<rsp stat="ok">
+<photos page="{page}" pages="100" perpage="500" total="50000">
+{photos}
+</photos>
+</rsp>
+"""
+PHOTO_FORMAT = ('\t<photo id="{photo_id}" owner="12345678@N00" '
+                'secret="abcdef" server="65535" farm="66" title="{title}" '
+                'ispublic="1" isfriend="0" isfamily="0" />')
+INFO_FORMAT = """<?xml version="1.0" encoding="utf-8" ?>
+<rsp stat="ok">
+<photo id="{photo_id}" secret="abcdef" server="65535" farm="66">
+\t<owner nsid="12345678@N00" username="cabbagefan" realname="" />
+\t<description>Delicious</description>
+\t<tags>
+\t\t<tag id="1" author="12345678@N00" raw="{tag}">{tag}</tag>
+\t</tags>
+</photo>
+</rsp>
+"""
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), 'testdata')
+
+
+def recorded_flickr_request(path, parse):
+    """Serve one page of recorded search results, and recorded photo info."""
+    if 'flickr.photos.search' in path:
+        if 'page=1&' not in path:
+            raise error.RecoverableCabbageException('No such page.')
+        name = 'search_cabbage_extras.xml'
+    else:
+        name = 'getinfo_%s.xml' % path.split('photo_id=')[1].split('&')[0]
+
+    with open(os.path.join(TESTDATA_DIR, name), 'rb') as response_file:
+        return parse([response_file.read()])
+
+
+def fake_flickr_request(path, parse):
+    """Serve three pages of two cabbages each, one of them a butterfly."""
+    return parse([fake_flickr_response(path).encode('utf-8')])
+
+
+def fake_flickr_response(path):
+    """Get the fake Flickr response body for a request path."""
+    if 'flickr.photos.search' in path:
+        page = int(path.split('page=')[1].split('&')[0])
+        photos = [
+            PHOTO_FORMAT.format(photo_id=page * 10 + 1, title='cabbage'),
+            PHOTO_FORMAT.format(photo_id=page * 10 + 2, title='savoy'),
+            PHOTO_FORMAT.format(photo_id=page * 10 + 3, title='butterfly'),
+        ]
+        return SEARCH_RESPONSE_FORMAT.format(page=page,
+                                             photos='\n'.join(photos))
+
+    photo_id = int(path.split('photo_id=')[1].split('&')[0])
+    tag = 'butterfly' if photo_id % 10 == 2 else 'cabbage'
+    return INFO_FORMAT.format(photo_id=photo_id, tag=tag)
+
+
+class JoyTest(unittest.IsolatedAsyncioTestCase):
+    """Cabbage cache tests."""
+
+    def setUp(self):
+        # Status reports and refill progress would bury the test results.
+        self.enterContext(contextlib.redirect_stdout(io.StringIO()))
+        self.cabbage_cache = joy.CabbageCache('key')
+        self.addCleanup(self.cabbage_cache.close)
+
+    def _fill_cache(self, count):
+        """Add some fake cabbages to the cache."""
+        self.cabbage_cache.cabbages.extend(
+            cache.CabbagePhoto(i, 'abcdef', 65535, 66, 'cabbage')
+            for i in range(count))
+
+    @mock.patch('cabbage.joy.create_cabbage_text', return_value='cabbage')
+    @mock.patch.object(joy.CabbageCache, 'load_cabbages')
+    async def test_empty_cache_falls_back_to_text(self, load_cabbages, _):
+        """Ensure that an empty cache never waits on Flickr."""
+        self.assertEqual(joy.create_cabbage_image(self.cabbage_cache),
+                         'cabbage')
+
+        # A refill was started in the background.
+        self.cabbage_cache.close()
+        load_cabbages.assert_called_once_with()
+
+    @mock.patch.object(joy.CabbageCache, 'load_cabbages')
+    async def test_single_flight_refill(self, load_cabbages):
+        """Ensure that concurrent refills share one trip to Flickr."""
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_load_cabbages():
+            started.set()
+            release.wait()
+
+        load_cabbages.side_effect = slow_load_cabbages
+
+        first_refill = self.cabbage_cache.request_refill()
+        started.wait()
+        refills = [
+            asyncio.create_task(self.cabbage_cache.refill()) for _ in range(10)
+        ]
+
+        # Refills may be requested from worker threads as well.
+        thread_refill = await asyncio.to_thread(
+            self.cabbage_cache.request_refill)
+        self.assertIs(thread_refill, first_refill)
+
+        release.set()
+        await asyncio.gather(*refills)
+        load_cabbages.assert_called_once_with()
+
+        # Once a refill is done, the next one goes to Flickr again.
+        await self.cabbage_cache.refill()
+        self.assertEqual(load_cabbages.call_count, 2)
+
+    @mock.patch.object(joy.CabbageCache, 'load_cabbages')
+    async def test_low_watermark(self, load_cabbages):
+        """Ensure that a refill only starts below the low watermark."""
+        self.cabbage_cache.low_watermark = 2
+        self._fill_cache(2)
+
+        self.assertIn('staticflickr', self.cabbage_cache.get_cabbage())
+        load_cabbages.assert_not_called()
+
+        self.cabbage_cache.get_cabbage()
+        self.cabbage_cache.close()
+        load_cabbages.assert_called_once_with()
+
+    @mock.patch.object(joy.CabbageCache, 'load_cabbages')
+    async def test_warm_restart(self, load_cabbages):
+        """Ensure that stored cabbages are served without waiting on Flickr."""
+        cabbage_store = store.CabbageStore(':memory:')
+        cabbage_store.add(cache.CabbagePhoto(1, 'abcdef', 65535, 66, 'savoy'))
+        cabbage_cache = joy.CabbageCache('key',
+                                         low_watermark=0,
+                                         cabbage_store=cabbage_store)
+
+        self.assertEqual(cabbage_cache.load_stored_cabbages(), 1)
+        self.assertEqual(cabbage_cache.status, joy.STATUS_READY)
+        self.assertEqual(
+            cabbage_cache.get_cabbage(),
+            'https://farm66.staticflickr.com/65535/1_abcdef.jpg '
+            '(title: savoy)')
+        self.assertEqual(cabbage_cache.last_cabbage.photo_id, 1)
+        load_cabbages.assert_not_called()
+
+        # Served cabbages are gone for good.
+        self.assertEqual(len(cabbage_store), 0)
+
+    @mock.patch.object(joy.CabbageCache,
+                       'load_cabbages',
+                       side_effect=OSError('Flickr is down.'))
+    async def test_refill_failure(self, load_cabbages):
+        """Ensure that refill failures don't escape the background refill."""
+        await self.cabbage_cache.refill()
+        self.assertEqual(self.cabbage_cache.status, joy.STATUS_DEGRADED)
+
+        # Recovering from a failure is just another refill.
+        load_cabbages.side_effect = None
+        await self.cabbage_cache.refill()
+        self.assertEqual(self.cabbage_cache.status, joy.STATUS_READY)
+
+    @mock.patch('traceback.print_exc')
+    @mock.patch.object(joy.CabbageCache,
+                       'load_cabbages',
+                       side_effect=KeyError('id'))
+    async def test_unexpected_refill_failure(self, load_cabbages, print_exc):
+        """Ensure that bugs in a refill are reported, not lost."""
+        await self.cabbage_cache.refill()
+        self.assertEqual(self.cabbage_cache.status, joy.STATUS_DEGRADED)
+        print_exc.assert_called_once()
+
+
+class LoadCabbagesTest(unittest.TestCase):
+    """Cabbage loading pipeline tests."""
+
+    def setUp(self):
+        # Status reports and refill progress would bury the test results.
+        self.enterContext(contextlib.redirect_stdout(io.StringIO()))
+        self.cabbage_cache = joy.CabbageCache('key')
+        self.addCleanup(self.cabbage_cache.close)
+
+    def _cached_photo_ids(self):
+        """Get the sorted photo ids in the cabbage cache."""
+        photo_ids = []
+        while self.cabbage_cache:
+            photo_ids.append(self.cabbage_cache.cabbages.draw().photo_id)
+        return sorted(photo_ids)
+
+    @mock.patch('cabbage.joy._flickr_request', side_effect=fake_flickr_request)
+    def test_load_cabbages(self, flickr_request):
+        """Ensure that every page is loaded and vetted."""
+        self.cabbage_cache.load_cabbages()
+        self.assertEqual(self._cached_photo_ids(), [11, 21, 31])
+
+        # Three search pages, and two verifications per page.
+        self.assertEqual(flickr_request.call_count, 9)
+
+        # Each page kept one cabbage for three calls, which the estimates
+        # used to size refills have moved towards.
+        decay = (1 - joy.PAGE_ESTIMATE_SMOOTHING)**3
+        self.assertAlmostEqual(self.cabbage_cache.kept_per_page,
+                               1 + decay * (joy.KEPT_PER_PAGE_ESTIMATE - 1))
+        self.assertAlmostEqual(self.cabbage_cache.calls_per_page,
+                               3 + decay * (joy.CALLS_PER_PAGE_ESTIMATE - 3))
+
+    @mock.patch('cabbage.joy._flickr_request', side_effect=fake_flickr_request)
+    def test_warming_up(self, _):
+        """Ensure that cabbages are served while the cache is still warming."""
+        self.assertEqual(self.cabbage_cache.status, joy.STATUS_WARMING)
+        self.assertIsNone(self.cabbage_cache.time_to_first_cabbage)
+
+        added = []
+
+        def add(cabbage):
+            added.append((self.cabbage_cache.status,
+                          self.cabbage_cache.time_to_first_cabbage))
+            original_add(cabbage)
+
+        original_add = self.cabbage_cache._add
+        with mock.patch.object(self.cabbage_cache, '_add', side_effect=add):
+            self.cabbage_cache.request_refill().result()
+
+        # The first cabbage was ready to serve before warming was done.
+        self.assertEqual(added[0], (joy.STATUS_WARMING, None))
+        self.assertEqual(added[1][0], joy.STATUS_WARMING)
+        self.assertIsNotNone(added[1][1])
+        self.assertEqual(self.cabbage_cache.status, joy.STATUS_READY)
+        self.assertEqual(
+            metrics.CACHE_STATUS.get(pool=joy.DEFAULT_POOL,
+                                     status=joy.STATUS_READY), 1)
+        self.assertEqual(
+            metrics.TIME_TO_FIRST_CABBAGE.get(pool=joy.DEFAULT_POOL),
+            self.cabbage_cache.time_to_first_cabbage)
+
+    @mock.patch('cabbage.joy._flickr_request', side_effect=fake_flickr_request)
+    def test_diagnostics(self, _):
+        """Ensure that only a compact diagnostic is kept for each cabbage."""
+        self.cabbage_cache.load_cabbages()
+        cabbage = self.cabbage_cache.cabbages.draw()
+        self.assertEqual(cabbage.diagnostic.owner, '12345678@N00')
+        self.assertEqual(cabbage.diagnostic.tags, ('cabbage', ))
+        self.assertIn('accepted',
+                      cabbage.diagnostic.describe(cabbage.photo_id))
+        self.assertGreater(self.cabbage_cache.footprint(), 0)
+
+    @mock.patch('cabbage.joy._flickr_request', side_effect=fake_flickr_request)
+    def test_verdicts_are_remembered(self, flickr_request):
+        """Ensure that photos are only vetted once."""
+        self.cabbage_cache.cabbage_store = store.CabbageStore(':memory:')
+        self.cabbage_cache.load_cabbages()
+        self.assertEqual(flickr_request.call_count, 9)
+        self.cabbage_cache.cabbages.clear()
+        self.cabbage_cache.cabbage_store.set_state(
+            joy.SERVED_HISTORY_STATE.format(pool=joy.DEFAULT_POOL),
+            history.ServedHistory().to_bytes())
+
+        # The second time around, only the search pages are needed.
+        self.cabbage_cache.load_cabbages()
+        self.assertEqual(flickr_request.call_count, 12)
+        self.assertEqual(self._cached_photo_ids(), [11, 21, 31])
+
+    @mock.patch('cabbage.joy._flickr_request', side_effect=fake_flickr_request)
+    def test_served_history(self, flickr_request):
+        """Ensure that served photos are skipped without being vetted again."""
+        cabbage_store = store.CabbageStore(':memory:')
+        self.cabbage_cache.cabbage_store = cabbage_store
+        self.cabbage_cache.load_cabbages()
+        self._cached_photo_ids()
+        flickr_request.reset_mock()
+
+        # Every page was short, so the cursor went back to the first page.
+        self.assertEqual(self.cabbage_cache.search_cursor, 1)
+        with self.assertRaisesRegex(error.RecoverableCabbageException,
+                                    'SERVED BEFORE'):
+            self.cabbage_cache.load_cabbages()
+        self.assertEqual(len(self.cabbage_cache), 0)
+        self.assertEqual(flickr_request.call_count, 3)
+
+        # Finding nothing new isn't ready.
+        self.cabbage_cache.request_refill().result()
+        self.assertEqual(self.cabbage_cache.status, joy.STATUS_DEGRADED)
+
+        # With full pages, the next refill looks further into the results,
+        # even after a restart.
+        with mock.patch.object(joy, 'CABBAGES_PER_PAGE', 3):
+            with self.assertRaises(error.RecoverableCabbageException):
+                self.cabbage_cache.load_cabbages()
+            self.assertEqual(self.cabbage_cache.search_cursor, 4)
+
+            restarted_cache = joy.CabbageCache('key',
+                                               cabbage_store=cabbage_store)
+            self.addCleanup(restarted_cache.close)
+            restarted_cache.load_cabbages()
+
+        self.assertEqual(restarted_cache.search_cursor, 7)
+        photo_ids = []
+        while restarted_cache:
+            photo_ids.append(restarted_cache.cabbages.draw().photo_id)
+        self.assertEqual(sorted(photo_ids), [41, 51, 61])
+
+    @mock.patch('cabbage.joy._flickr_request')
+    def test_failures_are_contained(self, flickr_request):
+        """Ensure that a failed request only loses what it was for."""
+
+        def flaky_flickr_request(path, parse):
+            if 'page=2' in path or 'photo_id=31' in path:
+                raise error.RecoverableCabbageException('Nope.')
+            return fake_flickr_request(path, parse)
+
+        flickr_request.side_effect = flaky_flickr_request
+        self.cabbage_cache.load_cabbages()
+        self.assertEqual(self._cached_photo_ids(), [11])
+        self.assertEqual(self.cabbage_cache.refill_checkpoint, {1: 3})
+
+        # The next refill picks up where this one left off.
+        flickr_request.reset_mock()
+        flickr_request.side_effect = fake_flickr_request
+        self.cabbage_cache.load_cabbages()
+        self.assertEqual(self._cached_photo_ids(), [21, 31])
+        searched = [
+            call.args[0].split('page=')[1].split('&')[0]
+            for call in flickr_request.call_args_list
+            if 'flickr.photos.search' in call.args[0]
+        ]
+        self.assertEqual(sorted(searched), ['2', '3'])
+        self.assertEqual(self.cabbage_cache.refill_checkpoint, {})
+
+    @mock.patch('cabbage.joy._flickr_request',
+                side_effect=recorded_flickr_request)
+    def test_vetting_modes(self, flickr_request):
+        """Ensure that vetting from search agrees with getInfo, for less."""
+        self.cabbage_cache.vetting_mode = joy.VETTING_WITH_GET_INFO
+        self.cabbage_cache.load_cabbages()
+        get_info_photo_ids = self._cached_photo_ids()
+        get_info_requests = flickr_request.call_count
+
+        flickr_request.reset_mock()
+        self.cabbage_cache.served_history = history.ServedHistory()
+        self.cabbage_cache.refill_checkpoint = {}
+        self.cabbage_cache.vetting_mode = joy.VETTING_FROM_SEARCH
+        self.cabbage_cache.load_cabbages()
+        self.assertEqual(self._cached_photo_ids(), get_info_photo_ids)
+        self.assertIn(52801234501, get_info_photo_ids)
+        self.assertNotIn(52801234503, get_info_photo_ids)
+
+        # Only the photo whose extras went missing needed getInfo.
+        get_info_paths = [
+            call.args[0] for call in flickr_request.call_args_list
+            if 'getInfo' in call.args[0]
+        ]
+        self.assertEqual(len(get_info_paths), 1)
+        self.assertIn('photo_id=52801234524', get_info_paths[0])
+        self.assertLess(flickr_request.call_count, get_info_requests)
+
+    @mock.patch('cabbage.joy._flickr_request', side_effect=fake_flickr_request)
+    def test_shared_pool(self, flickr_request):
+        """Ensure that processes share one pool, refilled by one of them."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'cabbages.sqlite3')
+        leader, follower = [
+            joy.CabbageCache('key',
+                             low_watermark=0,
+                             cabbage_store=store.CabbageStore(path),
+                             shared=True) for _ in range(2)
+        ]
+
+        leader.request_refill().result()
+        self.assertEqual(flickr_request.call_count, 9)
+        follower.request_refill().result()
+        self.assertEqual(flickr_request.call_count, 9)
+
+        photo_ids = sorted(
+            int(cabbage_cache.get_cabbage().split('/')[-1].split('_')[0])
+            for cabbage_cache in (leader, follower, follower))
+        self.assertEqual(photo_ids, [11, 21, 31])
+        # The leader's size estimate only allows for its own draw until it
+        # is recounted.
+        self.assertEqual(len(leader), 2)
+        with mock.patch.object(store, 'SIZE_ESTIMATE_TTL', -1):
+            self.assertEqual(len(leader), 0)
+
+        # Once the leader stops, the follower takes over refills. Verdicts
+        # are shared too, so only the search pages are needed.
+        leader.close()
+        follower.request_refill().result()
+        self.assertEqual(flickr_request.call_count, 12)
+        follower.close()
+
+    @mock.patch('cabbage.joy._flickr_request', side_effect=OSError('Down.'))
+    def test_no_cabbages(self, _):
+        """Ensure that a refill with no results at all is reported."""
+        with self.assertRaises(error.RecoverableCabbageException):
+            self.cabbage_cache.load_cabbages()
+
+    @mock.patch('cabbage.joy._flickr_request', side_effect=fake_flickr_request)
+    def test_no_pages(self, flickr_request):
+        """Ensure that a pool left no pages by the scheduler doesn't refill."""
+        self.cabbage_cache.pages_per_refill = 0
+        self.cabbage_cache.request_refill().result()
+        self.assertEqual(self.cabbage_cache.status, joy.STATUS_DEGRADED)
+        flickr_request.assert_not_called()
+
+
+class FakeFlickrTest(unittest.TestCase):
+    """Cabbage loading tests over HTTP, against a local fake Flickr."""
+
+    def setUp(self):
+        # Status reports and refill progress would bury the test results.
+        self.enterContext(contextlib.redirect_stdout(io.StringIO()))
+        # A fresh circuit breaker, and retries which don't slow tests down,
+        # or give up while Flickr is merely flaky.
+        patcher = mock.patch.object(
+            joy, 'flickr_client',
+            client.FlickrClient(backoff_base=0.001, max_attempts=10))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _load_cabbages(self, server, **kwargs):
+        """Load cabbages from the fake Flickr into a new cache."""
+        cabbage_cache = joy.CabbageCache('key',
+                                         flickr_api_url=server.url,
+                                         **kwargs)
+        self.addCleanup(cabbage_cache.close)
+        cabbage_cache.load_cabbages()
+        return cabbage_cache
+
+    def test_refill(self):
+        """Ensure that a whole refill works over real connections."""
+        with fake_flickr.FakeFlickr(total=96) as server:
+            cabbage_cache = self._load_cabbages(server)
+            self.assertEqual(len(cabbage_cache), 56)
+            self.assertEqual(server.requests['flickr.photos.search'], 3)
+            self.assertEqual(server.requests['flickr.photos.getInfo'], 4)
+
+            cabbage_cache = self._load_cabbages(
+                server, vetting_mode=joy.VETTING_WITH_GET_INFO)
+            self.assertEqual(len(cabbage_cache), 56)
+
+    def test_shared_connections(self):
+        """Ensure that refills of every pool share a few connections."""
+        with fake_flickr.FakeFlickr(total=96) as server:
+            for pool in ('cabbage', 'savoy'):
+                self._load_cabbages(server, pool=pool)
+
+        self.assertLessEqual(len(server.connections), joy.FLICKR_CONNECTIONS)
+
+    def test_search_limit(self):
+        """Ensure that refills wrap around at the last page Flickr serves."""
+        with fake_flickr.FakeFlickr(total=10000) as server:
+            # Past the limit, Flickr repeats the last page it serves.
+            last, past = [
+                server.respond('/?method=flickr.photos.search&per_page=10&'
+                               'page=%d' % page)[1] for page in (400, 401)
+            ]
+            self.assertEqual(last.replace('page="400"', 'page="401"'), past)
+
+            with mock.patch.object(joy, 'CABBAGES_PER_PAGE', 10):
+                cabbage_cache = self._load_cabbages(server)
+                self.assertEqual(cabbage_cache.last_search_page, 400)
+                self.assertEqual(cabbage_cache.search_cursor, 4)
+
+                cabbage_cache.search_cursor = 399
+                searches = server.requests['flickr.photos.search']
+                cabbage_cache.load_cabbages()
+
+        self.assertEqual(server.requests['flickr.photos.search'], searches + 2)
+        self.assertEqual(cabbage_cache.search_cursor, 1)
+
+    def test_flaky_flickr(self):
+        """Ensure that failed requests are retried and counted."""
+        errors = metrics.FLICKR_RESPONSES.get(method='flickr.photos.getInfo',
+                                              status=503)
+        with fake_flickr.FakeFlickr(total=96,
+                                    error_rate=0.2,
+                                    include_extras=False) as server:
+            cabbage_cache = self._load_cabbages(server)
+
+        self.assertEqual(len(cabbage_cache), 56)
+        self.assertGreater(
+            metrics.FLICKR_RESPONSES.get(method='flickr.photos.getInfo',
+                                         status=503), errors)
@@ -0,0 +1,78 @@
+"""Unit tests for cabbage metrics."""
+
+import unittest
+
+from cabbage import metrics
+
+
+class MetricsTest(unittest.TestCase):
+    """Metrics tests."""
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        """Ensure that counters are counted by label, and rendered."""
+        counter = metrics.Counter('cabbages_total',
+                                  'Cabbages.', ['kind'],
+                                  registry=self.registry)
+        counter.inc(kind='savoy')
+        counter.inc(2, kind='savoy')
+        counter.inc(kind='napa "cabbage"')
+        self.assertEqual(counter.get(kind='savoy'), 3)
+        self.assertEqual(counter.get(kind='radicchio'), 0)
+        self.assertEqual(counter.total(), 4)
+        self.assertEqual(counter.total(kind='savoy'), 3)
+        self.assertEqual(
+            self.registry.render(), '# HELP cabbages_total Cabbages.\n'
+            '# TYPE cabbages_total counter\n'
+            'cabbages_total{kind="napa \\"cabbage\\""} 1\n'
+            'cabbages_total{kind="savoy"} 3\n')
+
+        with self.assertRaises(ValueError):
+            counter.inc(flavor='savoy')
+
+    def test_gauge(self):
+        """Ensure that gauges go up and down."""
+        gauge = metrics.Gauge('cabbage_size', 'Size.', registry=self.registry)
+        gauge.set(10)
+        gauge.inc(-2.5)
+        self.assertEqual(gauge.get(), 7.5)
+        self.assertIn('cabbage_size 7.5\n', self.registry.render())
+
+    def test_histogram(self):
+        """Ensure that histograms are rendered cumulatively."""
+        histogram = metrics.Histogram('roll_seconds',
+                                      'Rolls.',
+                                      buckets=(0.1, 1),
+                                      registry=self.registry)
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value)
+
+        rendered = self.registry.render()
+        self.assertIn('roll_seconds_bucket{le="0.1"} 1\n', rendered)
+        self.assertIn('roll_seconds_bucket{le="1"} 3\n', rendered)
+        self.assertIn('roll_seconds_bucket{le="+Inf"} 4\n', rendered)
+        self.assertIn('roll_seconds_sum 6.05\n', rendered)
+        self.assertIn('roll_seconds_count 4\n', rendered)
+        self.assertEqual(histogram.count(), 4)
+
+    def test_quantile(self):
+        """Ensure that quantiles are interpolated within buckets."""
+        histogram = metrics.Histogram('roll_seconds',
+                                      'Rolls.',
+                                      buckets=(1, 2, 4),
+                                      registry=self.registry)
+        self.assertIsNone(histogram.quantile(0.5))
+
+        for value in (0.5, 1.5, 1.5, 3):
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.5), 1.5)
+        self.assertEqual(histogram.quantile(1), 4)
+
+        histogram.observe(100)
+        self.assertEqual(histogram.quantile(1), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
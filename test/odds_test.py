@@ -0,0 +1,117 @@
+"""Unit tests for polyhedral cabbage odds."""
+
+import itertools
+import operator
+import unittest
+
+from cabbage import odds
+from cabbage import polyhedral
+
+
+def brute_force_probability(formula, comparison, target):
+    """Calculate odds by rolling every possible combination of cabbages."""
+    terms = polyhedral.compile_formula(formula)
+    faces = []
+    constant = 0
+    for term in terms:
+        if term.term_type == polyhedral.TermType.constant:
+            constant += term.sign * term.value
+            continue
+        for _ in range(term.cabbage_count):
+            faces.append(
+                [term.sign * side for side in range(1, term.sides + 1)])
+
+    hits = 0
+    rolls = 0
+    for roll in itertools.product(*faces):
+        rolls += 1
+        hits += comparison(sum(roll) + constant, target)
+
+    return hits / rolls
+
+
+class OddsTest(unittest.TestCase):
+    """Polyhedral cabbage odds tests."""
+
+    def test_exact_odds(self):
+        """Ensure that exact odds match rolling every combination."""
+        for formula, comparison, target in (
+            ('3c20+c6+4', operator.ge, 40),
+            ('2c6', operator.eq, 7),
+            ('c8-c6+2', operator.lt, 0),
+            ('-2c4+c10', operator.le, 3),
+            ('4c6-3', operator.gt, 15),
+        ):
+            terms = polyhedral.compile_formula(formula)
+            distribution = odds.formula_distribution(terms)
+            self.assertAlmostEqual(
+                odds._exact_probability(distribution, comparison, target),
+                brute_force_probability(formula, comparison, target))
+
+    def test_describe_odds(self):
+        """Test the odds described to humans."""
+        self.assertEqual(odds.describe_odds('3c20+c6+4 >= 40'),
+                         'P(3c20+c6+4 >= 40) = 48.14%')
+        self.assertEqual(odds.describe_odds('2c6 = 7'), 'P(2c6 = 7) = 16.67%')
+        self.assertEqual(odds.describe_odds('c20 > 20'), 'P(c20 > 20) = 0%')
+        self.assertEqual(odds.describe_odds('c20 <= 20'),
+                         'P(c20 <= 20) = 100%')
+        self.assertEqual(
+            odds.describe_odds('2c6'),
+            '2c6: min 2, max 12, mean 7.00, most likely 7 (16.67%)')
+
+    def test_ways_at_most(self):
+        """Ensure that the closed form counts ways like convolving does."""
+        for count in range(1, 5):
+            for sides in range(1, 7):
+                # Counts without NumPy, but probabilities with it.
+                distribution = odds.count_distribution(count, sides)
+                weights = distribution.weights
+                for total in range(count * sides + 2):
+                    self.assertAlmostEqual(
+                        odds._ways_at_most(count, sides, total) / sides**count,
+                        sum(weights[:max(0, total - count + 1)]) /
+                        distribution.total_weight)
+
+    def test_closed_form_odds(self):
+        """Ensure that huge rolls are still exact, even in the tails."""
+        self.assertEqual(odds.describe_odds('c1000000000 >= 900000000'),
+                         'P(c1000000000 >= 900000000) = 10%')
+        self.assertEqual(odds.describe_odds('2c1000000000 <= 2'),
+                         'P(2c1000000000 <= 2) = 1e-16%')
+        # 1 + 2 + ... + 6 more ways than c1000000000 >= 999999990 alone.
+        self.assertEqual(odds.describe_odds('c1000000000+c6 >= 999999990'),
+                         'P(c1000000000+c6 >= 999999990) = 1.45e-06%')
+        self.assertEqual(odds.describe_odds('5-c1000000000 <= -999999990'),
+                         'P(5-c1000000000 <= -999999990) = 6e-07%')
+        self.assertEqual(odds.describe_odds('c1000000000 > 1000000000'),
+                         'P(c1000000000 > 1000000000) = 0%')
+
+    def test_distribution_cache(self):
+        """Ensure that only small distributions are memoized."""
+        small = odds.count_distribution(10, 6)
+        self.assertIs(odds.count_distribution(10, 6), small)
+
+        huge = odds.count_distribution(1, odds.MAX_CACHED_OUTCOMES + 1)
+        self.assertIsNot(
+            odds.count_distribution(1, odds.MAX_CACHED_OUTCOMES + 1), huge)
+
+    def test_approximate_odds(self):
+        """Ensure that enormous formulas are approximated, and say so."""
+        response = odds.describe_odds('1000000c1000000000 >= 500000000500000')
+        self.assertEqual(response,
+                         'P(1000000c1000000000 >= 500000000500000) ≈ 50%')
+
+        response = odds.describe_odds('5c1000000000+4')
+        self.assertIn('standard deviation', response)
+
+    def test_invalid_queries(self):
+        """Ensure that humans are scolded for nonsense."""
+        self.assertIn('TRY ROLLING CABBAGES', odds.describe_odds('1d20 > 3'))
+        self.assertIn('TRY HARDER!', odds.describe_odds('c20 >= cabbage'))
+        self.assertEqual(odds.describe_odds('>= 3'),
+                         odds.INVALID_QUERY_MESSAGE)
+
+
+if __name__ == '__main__':
+    unittest.main()
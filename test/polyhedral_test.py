@@ -41,10 +41,12 @@ class PolyhedralTest(unittest.TestCase):
 
     def test_cabbage_count(self):
         """Ensure that we don't roll invalid numbers of cabbages."""
-        response = polyhedral.roll_polyhedral_cabbage('101c6')
+        max_cabbages = polyhedral.MAX_POLYHEDRAL_CABBAGES
+        response = polyhedral.roll_polyhedral_cabbage('%dc6' %
+                                                      (max_cabbages + 1))
         self.assertIn("DON'T HAVE THAT MANY", response)
 
-        response = polyhedral.roll_polyhedral_cabbage('100c6+c4')
+        response = polyhedral.roll_polyhedral_cabbage('%dc6+c4' % max_cabbages)
         self.assertIn("DON'T HAVE THAT MANY", response)
 
         response = polyhedral.roll_polyhedral_cabbage('0c1')
@@ -87,3 +89,109 @@ class PolyhedralTest(unittest.TestCase):
         for formula, result in formulae_and_results.items():
             response = polyhedral.roll_polyhedral_cabbage(formula)
             self.assertEquals(response, result)
+
+    def test_compile_formula(self):
+        """Ensure that formulas compile to immutable, cached term programs."""
+        terms = polyhedral.compile_formula('2c6 + 4')
+        self.assertEqual(terms, (
+            polyhedral.Term(polyhedral.TermType.roll, 1, count=2, sides=6),
+            polyhedral.Term(polyhedral.TermType.constant, 1, value=4),
+        ))
+        with self.assertRaises(AttributeError):
+            terms[0].sides = 20
+
+        # Equivalent spellings share a cache entry.
+        self.assertIs(polyhedral.compile_formula('2c6+4'), terms)
+
+        with self.assertRaisesRegex(polyhedral.FormulaException, 'TRY HARDER'):
+            polyhedral.compile_formula('c20+')
+
+        with self.assertRaisesRegex(polyhedral.FormulaException, 'TRY HARDER'):
+            polyhedral.compile_formula('   ')
+
+    @mock.patch('random.randint', return_value=3)
+    def test_evaluate_formula(self, _):
+        """Ensure that compiled formulas can be rolled again and again."""
+        terms = polyhedral.compile_formula('-2c4+1')
+        self.assertEqual(polyhedral.evaluate_formula(terms), '-5 (-[3]-[3]+1)')
+        self.assertEqual(polyhedral.evaluate_formula(terms), '-5 (-[3]-[3]+1)')
+
+    def test_bulk_roll(self):
+        """Ensure that huge rolls are summarized instead of listed."""
+        response = polyhedral.roll_polyhedral_cabbage('100000c6+3')
+        lines = response.splitlines()
+        self.assertIn('STATISTICS', lines[0])
+        self.assertTrue(lines[1].startswith('100000c6: total '))
+        self.assertIn('min 1, max 6', lines[1])
+        self.assertEqual(lines[2].count('['), 6)
+        self.assertEqual(lines[3], '+3')
+        self.assertLessEqual(len(response), polyhedral.MAX_MESSAGE_LENGTH)
+
+        # The result is the sum of the summarized totals.
+        total = int(lines[1].split('total ')[1].split(',')[0])
+        self.assertEqual(int(lines[0].split()[0]), total + 3)
+
+    def test_bulk_roll_big_cabbages(self):
+        """Ensure that cabbages with many sides get a bucketed histogram."""
+        response = polyhedral.roll_polyhedral_cabbage('1000c1000000000')
+        lines = response.splitlines()
+        self.assertIn('STATISTICS', lines[0])
+        self.assertEqual(lines[2].count('['), polyhedral.MAX_HISTOGRAM_BUCKETS)
+        self.assertIn('[1-50000000]', lines[2])
+
+    def test_bulk_roll_many_big_cabbages(self):
+        """Ensure that the histograms of several huge rolls share a message."""
+        response = polyhedral.roll_polyhedral_cabbage(
+            '-100000c1000000000+100000c999999999-100000c999999998'
+            '+100000c999999997-100000c999999996')
+        lines = response.splitlines()
+        self.assertEqual(len(lines), 11)
+        self.assertEqual(lines[2].count('['),
+                         polyhedral.MAX_HISTOGRAM_BUCKETS // 5)
+        self.assertLessEqual(len(response), polyhedral.MAX_MESSAGE_LENGTH)
+
+    def test_long_listing(self):
+        """Ensure that listings too long for a message are summarized."""
+        response = polyhedral.roll_polyhedral_cabbage('400c1000000000')
+        self.assertIn('STATISTICS', response)
+        self.assertLessEqual(len(response), polyhedral.MAX_MESSAGE_LENGTH)
+
+    @mock.patch('random.randint', return_value=3)
+    def test_batch(self, _):
+        """Ensure that batches of formulas are rolled into one message."""
+        self.assertEqual(polyhedral.roll_polyhedral_batch('c20'), ['3 ([3])'])
+
+        messages = polyhedral.roll_polyhedral_batch('6x 4c6')
+        self.assertEqual(messages,
+                         ['\n'.join(['4c6: 12 ([3]+[3]+[3]+[3])'] * 6)])
+
+        messages = polyhedral.roll_polyhedral_batch('c20+5; 2c8+3;')
+        self.assertEqual(messages, ['c20+5: 8 ([3]+5)\n2c8+3: 9 ([3]+[3]+3)'])
+
+    def test_batch_invalid(self):
+        """Ensure that a bad formula, or too big a batch, is refused."""
+        roll = polyhedral.roll_polyhedral_batch
+        self.assertIn('TRY HARDER', roll('c20; c20+')[0])
+        self.assertIn('TRY ROLLING CABBAGES', roll('2x 1d20')[0])
+        self.assertIn('HOW TO ROLL', roll('0xc6')[0])
+        self.assertIn('NO CABBAGE ROLL', roll(';')[0])
+        self.assertIn('TOO MANY CABBAGE ROLLS',
+                      roll('%dx c6' % (polyhedral.MAX_BATCH_ROLLS + 1))[0])
+        self.assertIn("DON'T HAVE THAT MANY",
+                      roll('2x %dc6' % polyhedral.MAX_POLYHEDRAL_CABBAGES)[0])
+
+    def test_pack_messages(self):
+        """Ensure that responses are packed into as few messages as fit."""
+        self.assertEqual(
+            polyhedral.pack_messages(['aaa', 'bb', 'c', 'dddd'], limit=6),
+            ['aaa\nbb', 'c\ndddd'])
+        self.assertEqual(
+            polyhedral.pack_messages(['1\n22', 'abcdefgh'], limit=4),
+            ['1\n22', 'abcd', 'efgh'])
+
+        messages = polyhedral.roll_polyhedral_batch('20x 300c1000000000')
+        self.assertGreater(len(messages), 1)
+        for message in messages:
+            self.assertLessEqual(len(message), polyhedral.MAX_MESSAGE_LENGTH)
+        self.assertEqual(
+            sum(message.count('STATISTICS') for message in messages), 20)
@@ -0,0 +1,150 @@
+"""Unit tests for pools of cabbage varieties."""
+
+from unittest import mock
+import contextlib
+import io
+import unittest
+
+from cabbage import cache
+from cabbage import joy
+from cabbage import pools
+from cabbage import quota
+from cabbage import store
+from test import fake_clock
+
+
+class SplitBudgetTest(unittest.TestCase):
+    """Refill budget tests."""
+
+    def test_split_budget(self):
+        """Ensure that pages follow drain rates, down to none at all."""
+        self.assertEqual(
+            pools.split_budget(10, {
+                'cabbage': 0.0,
+                'savoy': 0.0,
+                'radicchio': 0.0
+            }), {
+                'cabbage': 10,
+                'savoy': 0,
+                'radicchio': 0
+            })
+        self.assertEqual(
+            pools.split_budget(10, {
+                'cabbage': 1.0,
+                'savoy': 0.5,
+                'radicchio': 0.0
+            }), {
+                'cabbage': 7,
+                'savoy': 3,
+                'radicchio': 0
+            })
+        self.assertEqual(
+            pools.split_budget(2, {
+                'cabbage': 1.0,
+                'savoy': 0.5,
+                'radicchio': 0.0
+            }), {
+                'cabbage': 1,
+                'savoy': 1,
+                'radicchio': 0
+            })
+        self.assertEqual(pools.split_budget(0, {
+            'cabbage': 1.0,
+            'savoy': 0.5
+        }), {
+            'cabbage': 0,
+            'savoy': 0
+        })
+
+
+class CabbagePoolsTest(unittest.TestCase):
+    """Cabbage pool tests."""
+
+    def setUp(self):
+        # Status reports and refill progress would bury the test results.
+        self.enterContext(contextlib.redirect_stdout(io.StringIO()))
+        self.clock = fake_clock.FakeClock()
+        self.quota = quota.QuotaAccountant(limit=1000, clock=self.clock)
+        self.cabbage_pools = pools.CabbagePools(
+            {
+                pool: joy.CabbageCache('key', pool=pool, tags=tags)
+                for pool, tags in pools.POOL_TAGS.items()
+            },
+            quota_accountant=self.quota,
+            clock=self.clock)
+        self.addCleanup(self.cabbage_pools.close)
+        for cabbage_cache in self.cabbage_pools:
+            cabbage_cache.calls_per_page = 10
+
+    def test_get(self):
+        """Ensure that pools can be asked for in different ways."""
+        get = self.cabbage_pools.get
+        self.assertIs(get(), self.cabbage_pools.default)
+        self.assertIs(get('cabbages'), self.cabbage_pools.default)
+        self.assertEqual(get('savoy').pool, 'savoy')
+        self.assertEqual(get('Napa  Cabbage').pool, 'napa cabbage')
+        self.assertEqual(get('napacabbage').pool, 'napa cabbage')
+        self.assertEqual(get('キャベツ').tags, 'キャベツ')
+        self.assertIsNone(get('kale'))
+
+    def drain_savoy(self):
+        """Draw 10 savoy cabbages a second for a rebalance interval."""
+        savoy = self.cabbage_pools.get('savoy')
+        savoy.cabbages.extend(
+            cache.CabbagePhoto(i, 'abcdef', 65535, 66, 'savoy')
+            for i in range(1000))
+        for _ in range(10 * pools.REBALANCE_INTERVAL):
+            savoy.get_cabbage()
+
+        self.clock.now = pools.REBALANCE_INTERVAL
+        self.cabbage_pools.get()
+        return savoy
+
+    @mock.patch.object(joy.CabbageCache, 'load_cabbages')
+    def test_rebalance(self, load_cabbages):
+        """Ensure that hot pools refill to their forecast, cold pools wait."""
+        savoy = self.drain_savoy()
+        self.assertAlmostEqual(self.cabbage_pools.drain_rates['savoy'], 3)
+        self.assertAlmostEqual(self.cabbage_pools.forecasts['savoy'],
+                               3 * pools.FORECAST_HORIZON)
+        self.assertEqual(savoy.pages_per_refill, pools.MAX_PAGES_PER_REFILL)
+        self.assertEqual(savoy.low_watermark, 3 * pools.REFILL_LEAD_TIME)
+        self.assertEqual(self.cabbage_pools.default.pages_per_refill, 1)
+        self.assertEqual(self.cabbage_pools.default.low_watermark,
+                         pools.MIN_LOW_WATERMARK)
+
+        # Savoy is now below its low watermark, so it started refilling.
+        # Nothing else did.
+        self.cabbage_pools.close()
+        load_cabbages.assert_called_once_with()
+        self.assertIs(self.cabbage_pools.last_cabbage, savoy.last_cabbage)
+
+    @mock.patch.object(joy.CabbageCache, 'load_cabbages')
+    def test_quota_backoff(self, _):
+        """Ensure that refills shrink to the quota left, hot pools first."""
+        for _ in range(self.quota.soft_limit - 60):
+            self.quota.try_spend('flickr.photos.getInfo')
+
+        # Enough for 6 of the 16 pages wanted, all of them for savoy.
+        savoy = self.drain_savoy()
+        self.cabbage_pools.close()
+        self.assertEqual(savoy.pages_per_refill, 6)
+        self.assertEqual(self.cabbage_pools.default.pages_per_refill, 0)
+
+    def test_shared_store(self):
+        """Ensure that pools keep their cabbages apart in a shared store."""
+        cabbage_store = store.CabbageStore(':memory:')
+        cabbage_pools = pools.create_pools('key',
+                                           cabbage_store=cabbage_store,
+                                           shared=True)
+        self.addCleanup(cabbage_pools.close)
+        cabbage_pools.get('savoy').cabbage_store.add(
+            cache.CabbagePhoto(1, 'abcdef', 65535, 66, 'savoy'))
+
+        self.assertEqual(len(cabbage_pools.get('savoy')), 1)
+        self.assertEqual(len(cabbage_pools.default), 0)
+        self.assertEqual(len(cabbage_store), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""Unit tests for on-demand profiling."""
+
+import os
+import tempfile
+import threading
+import unittest
+
+from cabbage import joy
+from cabbage import polyhedral
+from cabbage import profiling
+
+
+class ProfilerTest(unittest.IsolatedAsyncioTestCase):
+    """Profiler tests."""
+
+    def setUp(self):
+        self.profiler = profiling.Profiler()
+
+    def test_parse_duration(self):
+        """Ensure that profiles last some seconds, or some commands."""
+        self.assertEqual(profiling.parse_duration('30s'), (30.0, None))
+        self.assertEqual(profiling.parse_duration('20'), (None, 20))
+        for value in ('', 's', '0', '-5s', 'forever', '100000'):
+            with self.assertRaises(profiling.ProfileException):
+                profiling.parse_duration(value)
+
+    def test_idle(self):
+        """Ensure that nothing is wrapped while no profile is running."""
+        self.assertIs(self.profiler.wrap(joy.seems_like_cabbage),
+                      joy.seems_like_cabbage)
+
+    async def test_profile_commands(self):
+        """Ensure that the loop and worker threads are profiled together."""
+        self.profiler.start(commands=2)
+        with self.assertRaises(profiling.ProfileException):
+            self.profiler.start()
+
+        polyhedral.roll_polyhedral_cabbage('8c6')
+        wrapped = self.profiler.wrap(joy.seems_like_cabbage)
+        thread = threading.Thread(target=wrapped, args=('savoy cabbage', ))
+        thread.start()
+        thread.join()
+
+        self.profiler.note_command()
+        self.profiler.note_command()
+        await self.profiler.wait(seconds=1)
+        report = self.profiler.stop(top=1000)
+
+        self.assertFalse(self.profiler.active)
+        self.assertIn('roll_polyhedral_cabbage', report)
+        self.assertIn('seems_like_cabbage', report)
+
+
+class MemoryTrackerTest(unittest.TestCase):
+    """Memory tracker tests."""
+
+    def test_snapshots(self):
+        """Ensure that growth between snapshots is reported."""
+        memory_tracker = profiling.MemoryTracker()
+        self.addCleanup(memory_tracker.stop)
+
+        report = memory_tracker.snapshot()
+        self.assertTrue(memory_tracker.tracing)
+        self.assertIn('Started tracing', report)
+
+        cabbages = ['cabbage %d' % i for i in range(10000)]
+        report = memory_tracker.snapshot()
+        self.assertIn('profiling_test.py', report.splitlines()[2])
+        del cabbages
+
+        memory_tracker.stop()
+        self.assertFalse(memory_tracker.tracing)
+
+
+class LoopLagTest(unittest.IsolatedAsyncioTestCase):
+    """Event loop lag tests."""
+
+    async def test_sample_loop_lag(self):
+        """Ensure that lag is sampled for as long as asked."""
+        report = await profiling.sample_loop_lag(0.05, interval=0.01)
+        lines = report.splitlines()
+        self.assertIn('Event loop lag over 0.05s', lines[0])
+        self.assertGreaterEqual(len(lines) - 2, 3)
+
+    def test_save_report(self):
+        """Ensure that reports are saved where they can be found."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = profiling.save_report(os.path.join(directory, 'profiles'),
+                                         profiling.LAG_REPORT, 'lag report')
+            self.assertTrue(os.path.basename(path).startswith('lag-'))
+            with open(path) as report_file:
+                self.assertEqual(report_file.read(), 'lag report')
+
+
+if __name__ == '__main__':
+    unittest.main()
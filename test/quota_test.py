@@ -0,0 +1,85 @@
+"""Unit tests for Flickr quota accounting."""
+
+import unittest
+
+from cabbage import quota
+from cabbage import store
+from test import fake_clock
+
+
+class QuotaAccountantTest(unittest.TestCase):
+    """Quota accountant tests."""
+
+    def setUp(self):
+        self.clock = fake_clock.FakeClock()
+        self.quota = quota.QuotaAccountant(limit=10,
+                                           window=60,
+                                           reserve=0.2,
+                                           clock=self.clock)
+
+    def test_soft_limit(self):
+        """Ensure that calls stop short of the limit."""
+        for _ in range(8):
+            self.assertTrue(self.quota.try_spend('flickr.photos.search'))
+        self.assertFalse(self.quota.try_spend('flickr.photos.search'))
+        self.assertEqual(self.quota.used(), 8)
+        self.assertEqual(self.quota.remaining(), 0)
+
+    def test_sliding_window(self):
+        """Ensure that calls stop counting once they leave the window."""
+        self.quota.try_spend('flickr.photos.search')
+        self.clock.now = 30
+        for _ in range(3):
+            self.quota.try_spend('flickr.photos.getInfo')
+        self.assertEqual(self.quota.used_by_method(), {
+            'flickr.photos.search': 1,
+            'flickr.photos.getInfo': 3
+        })
+
+        self.clock.now = 60
+        self.assertEqual(self.quota.used(), 3)
+        self.assertEqual(self.quota.remaining(), 5)
+        self.assertIn('3/10 calls', self.quota.describe())
+        self.assertIn('getInfo 3', self.quota.describe())
+
+        self.clock.now = 90
+        self.assertEqual(self.quota.used(), 0)
+
+    def test_refund(self):
+        """Ensure that calls which weren't made stop counting."""
+        self.quota.try_spend('flickr.photos.search')
+        self.quota.try_spend('flickr.photos.getInfo')
+        self.quota.refund('flickr.photos.search')
+        self.assertEqual(self.quota.used_by_method(),
+                         {'flickr.photos.getInfo': 1})
+
+    def test_shared(self):
+        """Ensure that accountants sharing a store share one window."""
+        cabbage_store = store.CabbageStore(':memory:')
+        accountants = [
+            quota.QuotaAccountant(limit=10,
+                                  window=60,
+                                  reserve=0.2,
+                                  clock=self.clock,
+                                  cabbage_store=cabbage_store)
+            for _ in range(2)
+        ]
+        for i in range(8):
+            accountant = accountants[i % 2]
+            self.assertTrue(accountant.try_spend('flickr.photos.search'))
+        self.assertFalse(accountants[0].try_spend('flickr.photos.getInfo'))
+        self.assertEqual(accountants[1].used(), 8)
+
+        accountants[1].refund('flickr.photos.search')
+        self.assertTrue(accountants[0].try_spend('flickr.photos.getInfo'))
+        self.assertEqual(accountants[1].used_by_method(), {
+            'flickr.photos.search': 7,
+            'flickr.photos.getInfo': 1
+        })
+
+        self.clock.now = 60
+        self.assertEqual(accountants[0].remaining(), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
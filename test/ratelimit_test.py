@@ -0,0 +1,89 @@
+"""Unit tests for command rate limits."""
+
+import asyncio
+from unittest import mock
+import unittest
+
+from cabbage import metrics
+from cabbage import ratelimit
+from test import fake_clock
+
+
+class RateLimiterTest(unittest.TestCase):
+    """Rate limiter tests."""
+
+    def setUp(self):
+        self.clock = fake_clock.FakeClock()
+        self.rate_limiter = ratelimit.RateLimiter(
+            {
+                ratelimit.SCOPE_USER: ratelimit.Limit(2, 10),
+                ratelimit.SCOPE_CHANNEL: ratelimit.Limit(3, 10),
+                ratelimit.SCOPE_GUILD: ratelimit.Limit(4, 10),
+            },
+            clock=self.clock)
+
+    def test_limits(self):
+        """Ensure that each scope is limited, narrowest first."""
+        check = self.rate_limiter.check
+        self.assertIsNone(check('alice', 'garden', 'farm'))
+        self.assertIsNone(check('alice', 'garden', 'farm'))
+        self.assertEqual(check('alice', 'garden', 'farm'),
+                         ratelimit.SCOPE_USER)
+        self.assertIsNone(check('bob', 'garden', 'farm'))
+        self.assertEqual(check('carol', 'garden', 'farm'),
+                         ratelimit.SCOPE_CHANNEL)
+        self.assertIsNone(check('carol', 'kitchen', 'farm'))
+        self.assertEqual(check('dave', 'cellar', 'farm'),
+                         ratelimit.SCOPE_GUILD)
+
+        # Direct messages have no guild to limit.
+        self.assertIsNone(check('dave', 'dm'))
+
+        # Tokens come back over the period.
+        self.clock.now = 5
+        self.assertIsNone(check('alice', 'garden', 'farm'))
+        self.assertEqual(check('alice', 'garden', 'farm'),
+                         ratelimit.SCOPE_USER)
+
+    def test_forget_idle(self):
+        """Ensure that buckets are forgotten once they fill back up."""
+        with mock.patch.object(ratelimit, 'MAX_BUCKETS', 3):
+            self.rate_limiter.check('alice', 'garden', 'farm')
+            self.clock.now = 10
+            self.rate_limiter.check('bob', 'garden', 'farm')
+        self.assertEqual(len(self.rate_limiter), 3)
+
+    def test_parse_limit(self):
+        """Ensure that limits are parsed from the command line."""
+        self.assertEqual(ratelimit.parse_limit('5/30'), ratelimit.Limit(5, 30))
+        self.assertEqual(str(ratelimit.Limit(5, 30.0)), '5/30')
+        for value in ('5', 'five/30', '0/30', '5/0'):
+            with self.assertRaises(ValueError):
+                ratelimit.parse_limit(value)
+
+
+class CoalescerTest(unittest.IsolatedAsyncioTestCase):
+    """Coalescer tests."""
+
+    async def test_coalesce(self):
+        """Ensure that a burst gets one response, and the next its own."""
+        coalescer = ratelimit.Coalescer(window=0.01)
+        responses = []
+
+        async def respond(items):
+            responses.append(items)
+
+        before = metrics.COALESCED_REQUESTS.get(command='cabbage')
+        await asyncio.gather(*[
+            coalescer.submit('garden', name, respond, command='cabbage')
+            for name in ('alice', 'bob', 'alice')
+        ])
+        await coalescer.submit('garden', 'carol', respond)
+
+        self.assertEqual(responses, [['alice', 'bob', 'alice'], ['carol']])
+        self.assertEqual(metrics.COALESCED_REQUESTS.get(command='cabbage'),
+                         before + 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+"""Unit tests for persistent cabbage storage."""
+
+from unittest import mock
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from cabbage import cache
+from cabbage import store
+
+
+def make_cabbage(photo_id, title='cabbage'):
+    """Make a vetted cabbage for storage."""
+    diagnostic = cache.CabbageDiagnostic('12345678@N00', ['cabbage', 'kale'],
+                                         'accepted')
+    return cache.CabbagePhoto(photo_id,
+                              'abcdef',
+                              65535,
+                              66,
+                              title,
+                              diagnostic=diagnostic)
+
+
+class CabbageStoreTest(unittest.TestCase):
+    """Cabbage store tests."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cabbages.sqlite3')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_warm_restart(self):
+        """Ensure that stored cabbages survive reopening the store."""
+        cabbage_store = store.CabbageStore(self.path)
+        cabbage_store.add(make_cabbage(1))
+        cabbage_store.add(make_cabbage(2, title='savoy'))
+        cabbage_store.remove(2)
+        cabbage_store.close()
+
+        cabbage_store = store.CabbageStore(self.path)
+        cabbages = cabbage_store.load()
+        self.assertEqual(len(cabbages), 1)
+        self.assertEqual(str(cabbages[0]), str(make_cabbage(1)))
+        self.assertEqual(cabbages[0].diagnostic.tags, ('cabbage', 'kale'))
+        self.assertEqual(cabbages[0].diagnostic.owner, '12345678@N00')
+
+    def test_ttl(self):
+        """Ensure that stale cabbages are discarded."""
+        cabbage_store = store.CabbageStore(self.path, ttl=60)
+        cabbage_store.add(make_cabbage(1), fetched_at=time.time() - 61)
+        cabbage_store.add(make_cabbage(2))
+
+        self.assertEqual(
+            [cabbage.photo_id for cabbage in cabbage_store.load()], [2])
+        self.assertEqual(len(cabbage_store), 1)
+
+    def test_outdated_schema(self):
+        """Ensure that stores from other schema versions are discarded."""
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE cabbages (photo TEXT)')
+        connection.execute('INSERT INTO cabbages VALUES ("old cabbage")')
+        connection.commit()
+        connection.close()
+
+        cabbage_store = store.CabbageStore(self.path)
+        self.assertEqual(cabbage_store.load(), [])
+
+    def test_verdicts(self):
+        """Ensure that verdicts and owner reputations are remembered."""
+        cabbage_store = store.CabbageStore(self.path)
+        cabbage_store.record_verdict('1', 'gardener@N00', None, ['cabbage'])
+        cabbage_store.record_verdict(2, 'lepidopterist@N00', 'blocked words',
+                                     ['butterfly', 'cabbagewhite'])
+        cabbage_store.record_verdict(3, 'lepidopterist@N00', 'blocked words',
+                                     [])
+
+        verdicts = cabbage_store.get_verdicts(['1', '2', '4'])
+        self.assertEqual(sorted(verdicts), [1, 2])
+        self.assertTrue(verdicts[1].accepted)
+        self.assertEqual(verdicts[1].tags, ['cabbage'])
+        self.assertFalse(verdicts[2].accepted)
+        self.assertEqual(verdicts[2].reason, 'blocked words')
+
+        self.assertEqual(
+            cabbage_store.get_owner_reputation('lepidopterist@N00'), (0, 2))
+        self.assertEqual(cabbage_store.get_owner_reputation('gardener@N00'),
+                         (1, 0))
+        self.assertEqual(cabbage_store.get_disreputable_owners(2, 0.8),
+                         frozenset(['lepidopterist@N00']))
+        self.assertEqual(cabbage_store.get_disreputable_owners(3, 0.8),
+                         frozenset())
+
+    def test_verdict_ttl(self):
+        """Ensure that old verdicts are forgotten."""
+        cabbage_store = store.CabbageStore(self.path, verdict_ttl=-1)
+        cabbage_store.record_verdict(1, 'gardener@N00', None, ['cabbage'])
+        self.assertEqual(cabbage_store.get_verdicts([1]), {})
+
+    def test_shared_draws(self):
+        """Ensure that stores sharing a file never draw the same cabbage."""
+        stores = [store.CabbageStore(self.path) for _ in range(2)]
+        stores[0].extend(make_cabbage(photo_id) for photo_id in range(200))
+        stores[0].add(make_cabbage(200), fetched_at=0)
+
+        drawn = []
+        errors = []
+
+        def draw_everything(cabbage_store):
+            try:
+                while True:
+                    cabbage = cabbage_store.draw()
+                    if cabbage is None:
+                        return
+                    drawn.append(cabbage.photo_id)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=draw_everything, args=(stores[i % 2], ))
+            for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every fresh cabbage exactly once, and never the stale one.
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(drawn), list(range(200)))
+
+    def test_leases(self):
+        """Ensure that a lease has one holder until it expires."""
+        cabbage_store = store.CabbageStore(self.path)
+        other_store = store.CabbageStore(self.path)
+        self.assertTrue(cabbage_store.acquire_lease('refill', 'a', 60))
+        self.assertFalse(other_store.acquire_lease('refill', 'b', 60))
+        self.assertTrue(cabbage_store.acquire_lease('refill', 'a', -1))
+
+        # Expired, so up for grabs.
+        self.assertTrue(other_store.acquire_lease('refill', 'b', 60))
+        self.assertFalse(cabbage_store.acquire_lease('refill', 'a', 60))
+
+        other_store.release_lease('refill', 'a')
+        self.assertFalse(cabbage_store.acquire_lease('refill', 'a', 60))
+        other_store.release_lease('refill', 'b')
+        self.assertTrue(cabbage_store.acquire_lease('refill', 'a', 60))
+
+    def test_state(self):
+        """Ensure that named state survives reopening the store."""
+        cabbage_store = store.CabbageStore(self.path)
+        self.assertIsNone(cabbage_store.get_state('history'))
+        self.assertEqual(cabbage_store.get_state('cursor', 1), 1)
+        cabbage_store.set_state('history', b'\x00\x01')
+        cabbage_store.set_state('cursor', 4)
+        cabbage_store.close()
+
+        cabbage_store = store.CabbageStore(self.path)
+        self.assertEqual(cabbage_store.get_state('history'), b'\x00\x01')
+        self.assertEqual(cabbage_store.get_state('cursor', 1), 4)
+
+    def test_size_estimate(self):
+        """Ensure that sizes are estimated, allowing for this store's draws."""
+        cabbage_store = store.CabbageStore(self.path)
+        other_store = store.CabbageStore(self.path)
+        cabbage_store.extend(make_cabbage(photo_id) for photo_id in range(10))
+        self.assertEqual(len(cabbage_store), 10)
+        self.assertEqual(len(other_store), 10)
+
+        cabbage_store.draw()
+        other_store.draw()
+        self.assertEqual(len(cabbage_store), 9)
+        self.assertEqual(len(cabbage_store.for_pool('savoy')), 0)
+        with mock.patch.object(store, 'SIZE_ESTIMATE_TTL', -1):
+            self.assertEqual(len(cabbage_store), 8)
+
+        cabbage_store.clear()
+        self.assertEqual(len(cabbage_store), 0)
+        self.assertIsNone(cabbage_store.draw())